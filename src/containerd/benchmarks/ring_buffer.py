@@ -0,0 +1,111 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ringbuffer import BinaryRingBuffer
+
+
+class LegacyBinaryRingBuffer(object):
+    # Previous implementation, shifting the whole buffer on every push
+    def __init__(self, size):
+        self.data = bytearray(size)
+
+    def push(self, data):
+        del self.data[0:len(data)]
+        self.data += data
+
+    def read(self):
+        return self.data
+
+
+def push_all(buffer, chunks):
+    for chunk in chunks:
+        buffer.push(chunk)
+
+
+def read_many(fn, count):
+    for _ in range(count):
+        fn()
+
+
+def measure(fn, *args, rounds=3):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark console scrollback buffer implementations')
+    parser.add_argument('--size', type=int, default=20 * 1024, help='Scrollback size')
+    parser.add_argument('--bytes', type=int, default=16 * 1024 * 1024, help='Console output pushed per chunk size')
+    parser.add_argument('--reads', type=int, default=10000)
+    args = parser.parse_args()
+
+    for chunk_size in (1, 16, 128, 1024, 4096):
+        chunks = [os.urandom(chunk_size)] * (args.bytes // chunk_size)
+        results = []
+        for klass in (LegacyBinaryRingBuffer, BinaryRingBuffer):
+            buffer = klass(args.size)
+            elapsed = measure(push_all, buffer, chunks)
+            results.append(elapsed)
+
+        print('push, {0:>4} byte chunks: legacy {1:.3f}s, ring {2:.3f}s ({3:.0f} MB/s, {4:.1f}x)'.format(
+            chunk_size,
+            results[0],
+            results[1],
+            args.bytes / results[1] / 1024 / 1024,
+            results[0] / results[1]
+        ))
+
+    # Reconnecting console client which missed the last 100 bytes of output
+    legacy = LegacyBinaryRingBuffer(args.size)
+    ring = BinaryRingBuffer(args.size)
+    for buffer in (legacy, ring):
+        push_all(buffer, [os.urandom(1000)] * 50)
+
+    offset = ring.offset - 100
+    print('reconnect: legacy sends {0} bytes, ring sends {1} bytes'.format(len(legacy.read()), len(ring.read(offset))))
+    for name, fn in (
+        ('read whole scrollback', lambda: ring.read()),
+        ('read from offset', lambda: ring.read(offset)),
+        ('zero-copy tail of 100 bytes', lambda: ring.tail(100))
+    ):
+        print('{0}: {1:.2f}us'.format(name, measure(read_many, fn, args.reads) / args.reads * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -77,6 +77,7 @@ from freenas.utils import bool_to_truefalse, truefalse_to_bool, normalize, first
 from freenas.serviced import checkin
 from vnc import app
 from mgmt import ManagementNetwork
+from ringbuffer import BinaryRingBuffer
 from proxy import ReverseProxyServer
 
 
@@ -141,6 +142,8 @@ class ConsoleToken(object):
     def __init__(self, type, id):
         self.type = type
         self.id = id
+        self.scrollback = None
+        self.offset = None
 
 
 def generate_id():
@@ -214,18 +217,6 @@ def get_dhcp_lease(context, container_name, dockerhost_id, macaddr=None):
         raise RpcException(errno.EACCES, 'Failed to obtain DHCP lease: {0}'.format(c.error))
 
 
-class BinaryRingBuffer(object):
-    def __init__(self, size):
-        self.data = bytearray(size)
-
-    def push(self, data):
-        del self.data[0:len(data)]
-        self.data += data
-
-    def read(self):
-        return self.data
-
-
 class VirtualMachine(object):
     def __init__(self, context, name):
         self.context = context
@@ -591,6 +582,7 @@ class VirtualMachine(object):
 
         # Clear console
         gevent.kill(self.console_thread)
+        self.scrollback.push(b'\033[2J')
         for i in self.console_queues:
             i.put(b'\033[2J')
 
@@ -1993,6 +1985,8 @@ class ConsoleConnection(WebSocketApplication, EventEmitter):
         self.authenticated = False
         self.console_queue = None
         self.console_provider = None
+        self.token = None
+        self.offset = None
         self.rd = None
         self.wr = None
         self.inq = Queue()
@@ -2007,6 +2001,7 @@ class ConsoleConnection(WebSocketApplication, EventEmitter):
 
                 try:
                     self.ws.send(data.replace(b'\n\n', b'\r\n'))
+                    self.offset += len(data)
                 except WebSocketError as err:
                     self.logger.info('WebSocket connection terminated: {0}'.format(str(err)))
                     return
@@ -2035,6 +2030,11 @@ class ConsoleConnection(WebSocketApplication, EventEmitter):
         if self.console_provider:
             self.console_provider.console_unregister(self.console_queue)
 
+        if self.token and self.offset is not None:
+            # Remember what was delivered, so a reconnect with the same token gets only the rest
+            self.token.scrollback = self.console_provider.scrollback
+            self.token.offset = self.offset
+
     def on_message(self, message, *args, **kwargs):
         if message is None:
             return
@@ -2074,9 +2074,14 @@ class ConsoleConnection(WebSocketApplication, EventEmitter):
                         return
                     self.console_provider = self.context.vms[cid.id]
 
+            self.token = cid
             self.console_queue = self.console_provider.console_register()
+            scrollback = self.console_provider.scrollback
+            data = scrollback.read(cid.offset if cid.scrollback is scrollback else None)
+            self.offset = scrollback.offset
             self.ws.send(json.dumps({'status': 'ok'}))
-            self.ws.send(self.console_provider.scrollback.read())
+            if data:
+                self.ws.send(data)
 
             gevent.spawn(self.worker)
             return
@@ -0,0 +1,95 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+class BinaryRingBuffer(object):
+    """
+    Circular buffer keeping the last `size` bytes pushed to it.
+
+    Every byte pushed gets an absolute offset, counted from the creation of
+    the buffer, so readers can pick up from where they left off as long as
+    that data has not been overwritten yet.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.data = bytearray(size)
+        self.head = 0
+        self.offset = 0
+
+    def __len__(self):
+        return min(self.offset, self.size)
+
+    @property
+    def start(self):
+        return self.offset - len(self)
+
+    def push(self, data):
+        length = len(data)
+        head = self.head
+        end = head + length
+        self.offset += length
+
+        if end < self.size:
+            self.data[head:end] = data
+            self.head = end
+            return
+
+        if length >= self.size:
+            self.data[:] = data[length - self.size:]
+            self.head = 0
+            return
+
+        first = self.size - head
+        self.data[head:] = data[:first]
+        self.data[:length - first] = data[first:]
+        self.head = length - first
+
+    def segments(self, offset=None):
+        """
+        Returns memoryviews, in order, of data from `offset` on. Data which
+        has been overwritten already is skipped. Views are only valid until
+        the next push().
+        """
+        if offset is None or offset > self.offset or offset < self.start:
+            offset = self.start
+
+        length = self.offset - offset
+        if not length:
+            return []
+
+        view = memoryview(self.data)
+        begin = (self.head - length) % self.size
+        if begin + length <= self.size:
+            return [view[begin:begin + length]]
+
+        return [view[begin:], view[:self.head]]
+
+    def tail(self, length):
+        return self.segments(max(self.offset - length, self.start))
+
+    def read(self, offset=None):
+        return b''.join(self.segments(offset))
@@ -154,6 +154,7 @@ class MongodbDatastore(object):
         attributes = attributes or {}
         ttl_index = attributes.get('ttl_index')
         unique_indexes = attributes.get('unique_indexes', [])
+        indexes = attributes.get('indexes', [])
         cap = attributes.get('cap')
 
         if not self.db['collections'].find_one(name):
@@ -180,8 +181,18 @@ class MongodbDatastore(object):
 
             self.db[name].create_index([(i, pymongo.ASCENDING) for i in idx], unique=True)
 
+        for idx in indexes:
+            self.collection_ensure_index(name, idx)
+
         self.db[name].create_index([('$**', pymongo.TEXT)])
 
+    @auto_retry
+    def collection_ensure_index(self, name, fields, unique=False):
+        if isinstance(fields, str):
+            fields = [fields]
+
+        self._get_db(name).create_index([(i, pymongo.ASCENDING) for i in fields], unique=unique)
+
     @auto_retry
     def collection_exists(self, name):
         return self.db['collections'].find_one({"_id": name}) is not None
@@ -485,6 +496,39 @@ class MongodbDatastore(object):
         db = self._get_db(collection)
         db.delete_one({'_id': pkey})
 
+    @auto_retry
+    def upsert_many(self, collection, objs):
+        # Replaces whole documents, just like upsert() does
+        db = self._get_db(collection)
+        t = datetime.utcnow()
+        docs = {}
+
+        for obj in objs:
+            obj = copy.deepcopy(obj)
+            docs[obj.pop('id')] = obj
+
+        if not docs:
+            return
+
+        created = {
+            i['_id']: i.get('created_at')
+            for i in db.find({'_id': {'$in': list(docs)}}, {'created_at': 1})
+        }
+
+        requests = []
+        for pkey, obj in docs.items():
+            obj['updated_at'] = t
+            obj['created_at'] = created.get(pkey) or t
+            requests.append(pymongo.ReplaceOne({'_id': pkey}, obj, upsert=True))
+
+        db.bulk_write(requests, ordered=False)
+
+    @auto_retry
+    def delete_many(self, collection, pkeys):
+        pkeys = list(pkeys)
+        if pkeys:
+            self._get_db(collection).delete_many({'_id': {'$in': pkeys}})
+
     def lock(self):
         self.conn_db.fsync(lock=True)
 
@@ -126,6 +126,9 @@ class PostgresDatastore(object):
     def collection_set_attrs(self, collection, attributes):
         self.update('__collections', collection, attributes)
 
+    def collection_ensure_index(self, collection, fields, unique=False):
+        pass
+
     def collection_exists(self, collection):
         with self.conn.cursor() as cur:
             cur.execute("SELECT exists(SELECT * FROM information_schema.tables " +
@@ -258,5 +261,14 @@ class PostgresDatastore(object):
 
             self.conn.commit()
 
+    def upsert_many(self, collection, objs):
+        for obj in objs:
+            obj = dict(obj)
+            self.upsert(collection, obj.pop('id'), obj)
+
+    def delete_many(self, collection, pkeys):
+        for pkey in pkeys:
+            self.delete(collection, pkey)
+
     def exists(self, collection, *args):
         return self.get_one(collection, *args) is not None
@@ -0,0 +1,139 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from cache import CacheStore, DerivedCacheView
+
+
+def generate_snapshot(idx):
+    dataset = 'tank/dataset{0}'.format(idx % 100)
+    name = 'auto-{0}'.format(idx)
+    props = {
+        prop: {'value': str(idx), 'rawvalue': str(idx), 'parsed': idx, 'source': 'NONE'}
+        for prop in ('used', 'referenced', 'compressratio', 'clones', 'creation', 'createtxg', 'written')
+    }
+
+    props.update({
+        prop: {'value': 'yes', 'rawvalue': 'yes', 'parsed': 'yes', 'source': 'LOCAL'}
+        for prop in ('org.freenas:replicable', 'org.freenas:hidden', 'org.freenas:uuid')
+    })
+
+    return {
+        'id': '{0}@{1}'.format(dataset, name),
+        'name': '{0}@{1}'.format(dataset, name),
+        'dataset': dataset,
+        'pool': 'tank',
+        'snapshot_name': name,
+        'holds': {},
+        'properties': props
+    }
+
+
+def convert_snapshot(snapshot):
+    # Same shape as VolumePlugin's convert_snapshot()
+    dataset, _, name = snapshot['name'].partition('@')
+    props = snapshot['properties']
+    return {
+        'id': snapshot['name'],
+        'volume': dataset.partition('/')[0],
+        'dataset': dataset,
+        'name': name,
+        'lifetime': None,
+        'replicable': props['org.freenas:replicable']['value'] == 'yes',
+        'hidden': props['org.freenas:hidden']['value'] == 'yes',
+        'properties': {k: props[k] for k in ('used', 'referenced', 'compressratio', 'clones', 'creation')},
+        'holds': snapshot['holds'],
+        'metadata': {k: v['value'] for k, v in props.items() if ':' in k}
+    }
+
+
+def build_source(count):
+    store = CacheStore()
+    store.update(**{s['id']: s for s in map(generate_snapshot, range(count))})
+    return store
+
+
+def measure(fn):
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    ret = fn()
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return ret, used
+
+
+def scan_time(store, rounds):
+    started_at = time.monotonic()
+    for i in range(rounds):
+        store.query()
+
+    return (time.monotonic() - started_at) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare memory use and scan time of copied and derived snapshot caches')
+    parser.add_argument('--snapshots', type=int, default=100000)
+    parser.add_argument('--rounds', type=int, default=5, help='Repeated full scans to time')
+    args = parser.parse_args()
+
+    source, source_size = measure(lambda: build_source(args.snapshots))
+
+    def copied():
+        store = CacheStore()
+        store.update(**{k: convert_snapshot(v) for k, v in source.itervalid()})
+        return store
+
+    def derived():
+        view = DerivedCacheView(None, 'volume.snapshot', source, convert_snapshot)
+        # Full scan, as a volume.snapshot.query without filters would do
+        assert len(view.query()) == args.snapshots
+        return view
+
+    copied_store, copied_size = measure(copied)
+    derived_view, derived_size = measure(derived)
+
+    print('zfs.snapshot cache: {0:.1f} MiB'.format(source_size / 2 ** 20))
+    print('volume.snapshot copy: {0:.1f} MiB'.format(copied_size / 2 ** 20))
+    print('volume.snapshot derived view: {0:.1f} MiB'.format(derived_size / 2 ** 20))
+    print('saved: {0:.1f} MiB ({1:.0f}% of total)'.format(
+        (copied_size - derived_size) / 2 ** 20,
+        100 * (copied_size - derived_size) / (source_size + copied_size)
+    ))
+
+    # Records converted by the first scan are kept on the source items
+    print('full scan of copy: {0:.1f} ms'.format(scan_time(copied_store, args.rounds) * 1000))
+    print('full scan of derived view: {0:.1f} ms'.format(scan_time(derived_view, args.rounds) * 1000))
+
+if __name__ == '__main__':
+    main()
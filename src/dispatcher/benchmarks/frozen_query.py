@@ -0,0 +1,91 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from cache import CacheStore, copy_result
+
+
+def generate_snapshot(idx):
+    dataset = 'tank/dataset{0}'.format(idx % 100)
+    name = 'auto-{0}'.format(idx)
+    return {
+        'id': '{0}@{1}'.format(dataset, name),
+        'name': '{0}@{1}'.format(dataset, name),
+        'dataset': dataset,
+        'pool': 'tank',
+        'snapshot_name': name,
+        'holds': {},
+        'properties': {
+            prop: {'value': str(idx), 'rawvalue': str(idx), 'parsed': idx, 'source': 'NONE'}
+            for prop in ('used', 'referenced', 'compressratio', 'clones', 'creation', 'createtxg')
+        }
+    }
+
+
+def internal_call(store, frozen):
+    # Mimics what DispatcherRpcContext.call_sync does with streamed query results
+    count = 0
+    for item in store.query(stream=True, frozen=frozen):
+        item = copy_result(item)
+        count += len(item['properties']['creation']['value'])
+
+    return count
+
+
+def measure(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark in-process query throughput with and without frozen views')
+    parser.add_argument('--snapshots', type=int, default=200000)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    store = CacheStore()
+    store.update(**{s['id']: s for s in map(generate_snapshot, range(args.snapshots))})
+
+    for frozen in (False, True):
+        best = min(measure(internal_call, store, frozen) for _ in range(args.rounds))
+        print('{0}: {1:.3f}s, {2:.0f} items/s'.format(
+            'frozen' if frozen else 'deepcopy',
+            best,
+            args.snapshots / best
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from lib.replication import group_remote_snapshots, group_local_snapshots, find_common_snapshot, find_deleted_snapshots
+
+
+def generate_history(localds, remoteds, datasets, snapshots, replicated):
+    local = []
+    remote = [{'name': remoteds, 'snapshot_name': None}]
+    names = [localds] + ['{0}/child{1}'.format(localds, i) for i in range(datasets - 1)]
+
+    for ds in names:
+        remotefs = ds.replace(localds, remoteds, 1)
+        if ds != localds:
+            remote.append({'name': remotefs, 'snapshot_name': None})
+
+        for i in range(snapshots):
+            snap = {
+                'name': '{0}@auto-{1}'.format(ds, i),
+                'snapshot_name': 'auto-{0}'.format(i),
+                'created_at': 1000000 + i * 60,
+                'txg': i
+            }
+
+            local.append(snap)
+            if i < replicated:
+                remote.append(dict(snap, name='{0}@auto-{1}'.format(remotefs, i)))
+
+    random.shuffle(remote)
+    return names, local, remote
+
+
+def legacy_delta(localds, remoteds, datasets, local, remote):
+    # Reimplementation of the matching previously done by replication.calculate_delta
+    result = {}
+    for ds in datasets:
+        remotefs = ds.replace(localds, remoteds, 1)
+        local_snapshots = sorted([s for s in local if s['name'].split('@')[0] == ds], key=lambda x: x['txg'])
+        remote_snapshots = [s for s in remote if s['name'].startswith(remotefs + '@')]
+        pairs = []
+        for i in local_snapshots:
+            match = next((s for s in remote_snapshots if (
+                i['snapshot_name'] == s['snapshot_name'] and i['created_at'] == s['created_at']
+            )), None)
+            if match:
+                pairs.append((i, match))
+
+        pairs.sort(key=lambda p: p[0]['created_at'], reverse=True)
+        delete = [
+            s['snapshot_name'] for s in remote_snapshots
+            if not next((l for l in local_snapshots if l['snapshot_name'] == s['snapshot_name']), None)
+        ]
+
+        result[ds] = (local_snapshots.index(pairs[0][0]) if pairs else None, delete)
+
+    return result
+
+
+def indexed_delta(localds, remoteds, datasets, local, remote):
+    result = {}
+    _, remote_by_ds = group_remote_snapshots(remote)
+    local_by_ds = group_local_snapshots(local)
+
+    for ds in datasets:
+        remotefs = ds.replace(localds, remoteds, 1)
+        local_snapshots = sorted(local_by_ds.get(ds, []), key=lambda x: x['txg'])
+        remote_snapshots = remote_by_ds.get(remotefs, [])
+        result[ds] = (
+            find_common_snapshot(local_snapshots, remote_snapshots),
+            find_deleted_snapshots(local_snapshots, remote_snapshots)
+        )
+
+    return result
+
+
+def measure(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark replication delta calculation')
+    parser.add_argument('--datasets', type=int, default=50)
+    parser.add_argument('--snapshots', type=int, default=2000)
+    parser.add_argument('--replicated', type=int, default=1900)
+    parser.add_argument('--skip-legacy', action='store_true')
+    args = parser.parse_args()
+
+    datasets, local, remote = generate_history('tank/src', 'backup/dst', args.datasets, args.snapshots, args.replicated)
+    print('{0} datasets, {1} local snapshots, {2} remote entries'.format(len(datasets), len(local), len(remote)))
+
+    indexed, elapsed = measure(indexed_delta, 'tank/src', 'backup/dst', datasets, local, remote)
+    print('indexed: {0:.3f}s'.format(elapsed))
+
+    if not args.skip_legacy:
+        legacy, elapsed = measure(legacy_delta, 'tank/src', 'backup/dst', datasets, local, remote)
+        print('legacy: {0:.3f}s'.format(elapsed))
+        assert legacy == indexed, 'Results differ'
+
+
+if __name__ == '__main__':
+    main()
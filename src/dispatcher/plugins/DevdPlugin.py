@@ -37,7 +37,6 @@ import logging
 import contextlib
 import usb1
 from xml.etree import ElementTree
-from bsd import geom
 from bsd import devinfo
 from bsd import sysctl
 from event import EventSource
@@ -47,6 +46,7 @@ from freenas.dispatcher.rpc import accepts, returns, description
 from freenas.dispatcher.rpc import RpcException, SchemaHelper as h
 from gevent import socket
 from lib.freebsd import get_sysctl
+from lib.geom import geom_snapshot
 from lib.system import system, SubprocessException
 from freenas.utils import exclude, query as q
 
@@ -102,8 +102,8 @@ class DeviceInfoProvider(Provider):
 
     def _get_class_disk(self):
         result = []
-        geom.scan()
-        for child in geom.class_by_name('DISK').geoms:
+        topology = geom_snapshot.get()
+        for child in topology.class_by_name('DISK').geoms:
             result.append({
                 "path": os.path.join("/dev", child.name),
                 "name": child.name,
@@ -115,8 +115,7 @@ class DeviceInfoProvider(Provider):
 
     def _get_class_multipath(self):
         result = []
-        geom.scan()
-        cls = geom.class_by_name('MULTIPATH')
+        cls = geom_snapshot.get().class_by_name('MULTIPATH')
         if not cls:
             return []
 
@@ -411,6 +410,9 @@ class DevdEventSource(EventSource):
                         # WTF
                         continue
 
+                    if event["system"] in ("DEVFS", "GEOM"):
+                        geom_snapshot.invalidate()
+
                     if event["system"] == "DEVFS":
                         self.__process_devfs(event)
 
@@ -503,6 +505,9 @@ def _init(dispatcher, plugin):
         }
     })
 
+    # Parse confxml off the event loop
+    geom_snapshot.executor = dispatcher.threaded
+
     plugin.register_event_source('system.device', DevdEventSource)
     plugin.register_provider('system.device', DeviceInfoProvider)
     plugin.register_provider('system.dmi', DMIDataProvider)
@@ -239,7 +239,10 @@ def _init(dispatcher, plugin):
             },
             'cache_ttl': {'type': 'integer'},
             'cache_enumerations': {'type': 'boolean'},
-            'cache_lookups': {'type': 'boolean'}
+            'cache_lookups': {'type': 'boolean'},
+            'cache_size': {'type': 'integer', 'minimum': 1},
+            'cache_negative_ttl': {'type': 'integer', 'minimum': 0},
+            'lookup_timeout': {'type': 'integer', 'minimum': 1}
         }
     })
 
@@ -285,6 +288,7 @@ def _init(dispatcher, plugin):
                         'type': 'string',
                         'enum': ['DISABLED', 'JOINING', 'FAILURE', 'BOUND', 'EXITING']
                     },
+                    'degraded': {'type': 'boolean'},
                     'status_code': {'type': 'integer'},
                     'status_message': {'type': 'string'}
                 }
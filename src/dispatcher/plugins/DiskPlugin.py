@@ -35,16 +35,17 @@ import logging
 import tempfile
 import base64
 import gevent
+import gevent.pool
 import time
 import libzfs
 import contextlib
-from xml.etree import ElementTree
-from bsd import geom, getswapinfo
+from bsd import getswapinfo
 from datetime import datetime, timedelta
+from gevent.threadpool import ThreadPool
 from freenas.utils import first_or_default, remove_non_printable, query as q
 from cam import CamDevice, CamEnclosure, EnclosureStatus, ElementStatus
 from cache import CacheStore
-from lib.geom import confxml
+from lib.geom import geom_snapshot
 from lib.system import system, SubprocessException
 from task import (
     Provider, Task, ProgressTask, TaskStatus, TaskException, VerifyException,
@@ -58,6 +59,8 @@ from pySMART import Device
 
 EXPIRE_TIMEOUT = timedelta(hours=24)
 SMART_CHECK_INTERVAL = 600  # in seconds (i.e. 10 minutes)
+SMART_POLL_THREADS = 8
+SMART_PROBE_TIMEOUT = 120
 SMART_ALERT_MAP = {
     'WARN': ('SmartWarn', 'S.M.A.R.T status warning'),
     'FAIL': ('SmartFail', 'S.M.A.R.T status failing')
@@ -69,8 +72,97 @@ ZFS_TYPE_IDS = (
     '85d5e45d-237c-11e1-b4b3-e89a8f7fc3a7'   # MidnightBSD
 )
 
-diskinfo_cache = CacheStore()
 logger = logging.getLogger('DiskPlugin')
+smart_poller = None
+
+
+class DiskCacheStore(CacheStore):
+    """
+    Disk cache with secondary indexes on device paths, partition paths, GPT
+    UUIDs and serial numbers. Disk entries are re-indexed on every put().
+    """
+    def __init__(self):
+        super(DiskCacheStore, self).__init__()
+        self.by_path = {}
+        self.by_partition = {}
+        self.by_serial = {}
+        self.indexed = {}
+
+    def index_keys(self, disk):
+        paths = {disk.get('path')}
+        if disk.get('is_multipath'):
+            paths.update(q.get(disk, 'multipath.members') or {})
+
+        partitions = {disk.get('data_partition_path'), disk.get('swap_partition_path')}
+        for part in disk.get('partitions') or []:
+            partitions.update(part['paths'])
+            partitions.add(part['uuid'])
+
+        serials = {disk.get('serial')}
+        return [
+            (self.by_path, paths - {None}),
+            (self.by_partition, partitions - {None}),
+            (self.by_serial, serials - {None})
+        ]
+
+    def unindex(self, key):
+        for index, keys in self.indexed.pop(key, []):
+            for k in keys:
+                if index.get(k) == key:
+                    del index[k]
+
+    def index(self, key, disk):
+        self.unindex(key)
+        self.indexed[key] = self.index_keys(disk)
+        for index, keys in self.indexed[key]:
+            for k in keys:
+                index[k] = key
+
+    def put(self, key, data):
+        with self.lock:
+            self.index(key, data)
+            return super(DiskCacheStore, self).put(key, data)
+
+    def update(self, **kwargs):
+        with self.lock:
+            for k, v in kwargs.items():
+                self.index(k, v)
+
+            return super(DiskCacheStore, self).update(**kwargs)
+
+    def remove(self, key):
+        with self.lock:
+            self.unindex(key)
+            return super(DiskCacheStore, self).remove(key)
+
+    def remove_many(self, keys):
+        with self.lock:
+            for k in keys:
+                self.unindex(k)
+
+            return super(DiskCacheStore, self).remove_many(keys)
+
+    def clear(self):
+        with self.lock:
+            self.by_path.clear()
+            self.by_partition.clear()
+            self.by_serial.clear()
+            self.indexed.clear()
+            return super(DiskCacheStore, self).clear()
+
+    def get_by_path(self, path):
+        key = self.by_path.get(path)
+        return self.get(key) if key else None
+
+    def resolve(self, path):
+        key = self.by_path.get(path) or self.by_partition.get(path) or self.by_serial.get(path)
+        if not key and path.startswith('/dev/gptid/'):
+            key = self.by_partition.get(os.path.basename(path).replace('.eli', ''))
+
+        return self.get(key) if key else None
+
+
+diskinfo_cache = DiskCacheStore()
 
 
 class AcousticLevel(enum.IntEnum):
@@ -145,10 +237,8 @@ class DiskProvider(Provider):
 
     @accepts(str)
     def get_partition_config(self, part_name):
-        for name, disk in diskinfo_cache.itervalid():
-            if 'partitions' not in disk:
-                continue
-
+        disk = diskinfo_cache.resolve(part_name)
+        if disk and 'partitions' in disk:
             for part in disk['partitions']:
                 if part_name in part['paths']:
                     result = part.copy()
@@ -186,11 +276,31 @@ class DiskProvider(Provider):
         except OSError as err:
             raise RpcException(err.errno, err.strerror)
 
+    @accepts()
+    @returns(h.ref('DiskSmartPollStatus'))
+    def get_smart_poll_status(self):
+        return smart_poller.status()
+
     @private
     def update_disk_cache(self, disk):
         with self.dispatcher.get_lock('diskcache:{0}'.format(disk)):
+            # Callers have just modified GEOM configuration of the disk
+            geom_snapshot.get(fresh=True)
             update_disk_cache(self.dispatcher, disk)
 
+    @accepts(h.array(str))
+    @returns(h.object(additionalProperties=h.one_of(
+        h.object(properties={'id': str, 'path': str}),
+        None
+    )))
+    def resolve_paths(self, paths):
+        result = {}
+        for path in paths:
+            disk = diskinfo_cache.resolve(path)
+            result[path] = {'id': disk['id'], 'path': disk['path']} if disk else None
+
+        return result
+
     @accepts(str)
     def path_to_id(self, path):
         disk_info = self.dispatcher.call_sync(
@@ -214,15 +324,22 @@ class DiskProvider(Provider):
     )))
     def key_slots_by_paths(self, paths):
         result = []
-        geom.scan()
+        # Called right after geli attach, the debounced snapshot may not have the ELI geoms yet
+        topology = geom_snapshot.get(fresh=True)
         for p in paths:
             provider_path = self.dispatcher.call_sync(
                 'disk.query',
                 [('path', '=', p)],
                 {'select': 'status.data_partition_path', 'single': True}
             )
-            vdev_config = geom.geom_by_name('ELI', provider_path.strip('/dev')).config
-            result.append({'path': p, 'key_slot': int(vdev_config.get('UsedKey'))})
+            if not provider_path:
+                raise RpcException(errno.ENOENT, 'Disk {0} not found'.format(p))
+
+            eli = topology.geom_by_name('ELI', provider_path.strip('/dev'))
+            if not eli:
+                raise RpcException(errno.ENOENT, 'Disk {0} is not attached as a GELI provider'.format(p))
+
+            result.append({'path': p, 'key_slot': int(eli.config.get('UsedKey'))})
 
         return result
 
@@ -237,8 +354,7 @@ class DiskProvider(Provider):
             {'select': 'status.data_partition_path', 'single': True}
         )
         if provider_path:
-            geom.scan()
-            return bool(geom.geom_by_name('ELI', provider_path.strip('/dev')))
+            return geom_snapshot.get(fresh=True).geom_by_name('ELI', provider_path.strip('/dev')) is not None
         else:
             return False
 
@@ -1094,8 +1210,10 @@ def get_twcli(controller):
     return units
 
 
-def device_to_identifier(name, serial=None):
-    gdisk = geom.geom_by_name('DISK', name)
+def device_to_identifier(name, serial=None, topology=None):
+    # Disks get identified right after being partitioned or labeled
+    topology = topology or geom_snapshot.get(fresh=True)
+    gdisk = topology.geom_by_name('DISK', name)
     if not gdisk:
         return None
 
@@ -1111,13 +1229,13 @@ def device_to_identifier(name, serial=None):
     if serial:
         return "serial:{0}".format(serial)
 
-    gpart = geom.geom_by_name('PART', name)
+    gpart = topology.geom_by_name('PART', name)
     if gpart:
         for i in gpart.providers:
             if i.config['rawtype'] in ZFS_TYPE_IDS:
                 return "uuid:{0}".format(i.config['rawuuid'])
 
-    glabel = geom.geom_by_name('LABEL', name)
+    glabel = topology.geom_by_name('LABEL', name)
     if glabel and glabel.provider:
         return "label:{0}".format(glabel.provider.name)
 
@@ -1125,15 +1243,7 @@ def device_to_identifier(name, serial=None):
 
 
 def get_disk_by_path(path):
-    for disk in diskinfo_cache.validvalues():
-        if disk['path'] == path:
-            return disk
-
-        if disk['is_multipath']:
-            if path in q.get(disk, 'multipath.members'):
-                return disk
-
-    return None
+    return diskinfo_cache.get_by_path(path)
 
 
 def get_disk_by_lunid_and_serial(lunid, serial):
@@ -1141,8 +1251,7 @@ def get_disk_by_lunid_and_serial(lunid, serial):
 
 
 def clean_multipaths(dispatcher):
-    dispatcher.threaded(geom.scan)
-    cls = geom.class_by_name('MULTIPATH')
+    cls = geom_snapshot.get(fresh=True).class_by_name('MULTIPATH')
     if cls:
         for i in cls.geoms:
             logger.info('Destroying multipath device %s', i.name)
@@ -1154,8 +1263,7 @@ def clean_multipaths(dispatcher):
 
 
 def clean_mirrors(dispatcher):
-    dispatcher.threaded(geom.scan)
-    cls = geom.class_by_name('MIRROR')
+    cls = geom_snapshot.get(fresh=True).class_by_name('MIRROR')
     if cls:
         for i in cls.geoms:
             if i.name.endswith('.sync'):
@@ -1252,8 +1360,7 @@ def attach_to_multipath(dispatcher, disk, ds_disk, path):
     with open(os.path.join('/dev/multipath', nodename), 'rb+') as f:
         pass
 
-    dispatcher.threaded(geom.scan)
-    gmultipath = geom.geom_by_name('MULTIPATH', nodename)
+    gmultipath = geom_snapshot.get(fresh=True).geom_by_name('MULTIPATH', nodename)
     ret['multipath'] = generate_multipath_info(gmultipath)
     return ret
 
@@ -1262,7 +1369,7 @@ def disk_by_id(dispatcher, id):
     return dispatcher.call_sync('disk.query', [('id', '=', id)], {'single': True})
 
 
-def generate_partitions_list(gpart):
+def generate_partitions_list(gpart, topology):
     if not gpart:
         return
 
@@ -1273,7 +1380,7 @@ def generate_partitions_list(gpart):
 
         label = p.config.get('label')
         uuid = p.config.get('rawuuid')
-        eli = geom.geom_by_name('ELI', 'gptid/{0}.eli'.format(uuid))
+        eli = topology.geom_by_name('ELI', 'gptid/{0}.eli'.format(uuid))
 
         if label:
             paths.append(os.path.join("/dev/gpt", label))
@@ -1308,21 +1415,21 @@ def generate_multipath_info(gmultipath):
 
 
 def update_disk_cache(dispatcher, path):
-    dispatcher.threaded(geom.scan)
+    topology = geom_snapshot.get(fresh=True)
     name = re.match('/dev/(.*)', path).group(1)
-    gdisk = geom.geom_by_name('DISK', name)
-    gpart = geom.geom_by_name('PART', name)
+    gdisk = topology.geom_by_name('DISK', name)
+    gpart = topology.geom_by_name('PART', name)
     gmultipath = None
 
     # Handle diskid labels
     if gpart is None:
-        glabel = geom.geom_by_name('LABEL', name)
+        glabel = topology.geom_by_name('LABEL', name)
         if glabel and glabel.provider and glabel.provider.name.startswith('diskid/'):
-            gpart = geom.geom_by_name('PART', glabel.provider.name)
+            gpart = topology.geom_by_name('PART', glabel.provider.name)
 
     if name.startswith('multipath/'):
         multipath_name = re.match('multipath/(.*)', name).group(1)
-        gmultipath = geom.geom_by_name('MULTIPATH', multipath_name)
+        gmultipath = topology.geom_by_name('MULTIPATH', multipath_name)
 
     disk = get_disk_by_path(path)
     if not disk:
@@ -1345,8 +1452,8 @@ def update_disk_cache(dispatcher, path):
         camdev = None
 
     provider = gdisk.provider
-    partitions = list(generate_partitions_list(gpart))
-    identifier = device_to_identifier(gdisk.name, camdev.serial if camdev else provider.config.get('ident'))
+    partitions = list(generate_partitions_list(gpart, topology))
+    identifier = device_to_identifier(gdisk.name, camdev.serial if camdev else provider.config.get('ident'), topology)
     data_part = first_or_default(lambda x: x['rawtype'] in ZFS_TYPE_IDS, partitions)
     data_uuid = data_part["uuid"] if data_part else None
     data_path = data_uuid
@@ -1404,6 +1511,9 @@ def update_disk_cache(dispatcher, path):
                 'operation': 'update',
                 'ids': disk['enclosure']
             })
+    else:
+        # Entry was updated in place, put it back so that it gets re-indexed
+        diskinfo_cache.put(identifier, disk)
 
     persist_disk(dispatcher, disk)
     # post this persist disk check to see if the 'smart' value in the databse
@@ -1424,9 +1534,9 @@ def update_disk_cache(dispatcher, path):
 
 
 def generate_disk_cache(dispatcher, path):
-    dispatcher.threaded(geom.scan)
     name = os.path.basename(path)
-    gdisk = geom.geom_by_name('DISK', name)
+    topology = geom_snapshot.get(fresh=True)
+    gdisk = topology.geom_by_name('DISK', name)
     multipath_info = None
     max_rotation = None
 
@@ -1437,7 +1547,7 @@ def generate_disk_cache(dispatcher, path):
 
     provider = gdisk.provider
     serial = camdev.serial if camdev else provider.config.get('ident')
-    identifier = device_to_identifier(name, serial)
+    identifier = device_to_identifier(name, serial, topology)
     ds_disk = dispatcher.datastore.get_by_id('disks', identifier)
 
     try:
@@ -1484,7 +1594,6 @@ def generate_disk_cache(dispatcher, path):
 
 
 def purge_disk_cache(dispatcher, path):
-    dispatcher.threaded(geom.scan)
     delete = False
     disk = get_disk_by_path(path)
 
@@ -1595,63 +1704,173 @@ def configure_disk(datastore, id):
         gevent.spawn_later(60, configure_standby, standby_mode)
 
 
-def update_smart_info(dispatcher, disk):
-    updated = False
+def probe_smart_info(disk):
     # setting all_info to False below makes pySMART skip over fields we already
     # have in the disk dict (like name, path, serial number, is_ssd, max_roation and so on)
-    smart_info = Device(disk['gdisk_name']).__getstate__(all_info=False)
-    disk_name = disk['gdisk_name']
-    smart_status = smart_info['smart_status']
+    return Device(disk['gdisk_name']).__getstate__(all_info=False)
 
+
+def store_smart_info(disk, smart_info):
     if disk.get('smart_info') != smart_info:
         disk['smart_info'] = smart_info
         diskinfo_cache.update_one(disk['id'], smart_info=smart_info)
-        updated = True
+        return True
+
+    return False
+
 
-    existing_smart_alerts = dispatcher.call_sync(
+def reconcile_smart_alerts(dispatcher, statuses):
+    existing_smart_alerts = {}
+    for smart_alert in dispatcher.call_sync(
         'alert.query',
         [
             ('active', '=', True),
             ('dismissed', '=', False),
             ('clazz', 'in', ('SmartFail', 'SmartWarn')),
-            ('target', '=', disk_name)
+            ('target', 'in', list(statuses))
         ]
-    )
+    ):
+        existing_smart_alerts.setdefault(smart_alert['target'], []).append(smart_alert)
+
+    for disk_name, smart_status in statuses.items():
+        alerts = existing_smart_alerts.get(disk_name, [])
+        if smart_status in ('FAIL', 'WARN'):
+            # We need to issue a S.M.A.R.T alert for this disk
+            alert_class, title = SMART_ALERT_MAP[smart_status]
+            alert_exists = False
+
+            for smart_alert in alerts:
+                if smart_alert['clazz'] == alert_class:
+                    alert_exists = True
+                    continue
+                dispatcher.call_sync('alert.cancel', smart_alert['id'])
+
+            if not alert_exists:
+                dispatcher.call_sync('alert.emit', {
+                    'clazz': alert_class,
+                    'title': title,
+                    'target': disk_name,
+                    'description': 'Disk {0} S.M.A.R.T status: {1}.\
+                    See disk info in GUI/CLI for details'.format(disk_name, smart_status)
+                })
+        elif smart_status == 'PASS':
+            # for various reasons the SMART status of this disk (or a disk with this name)
+            # may have a previous 'FAIL' | 'WARN' smart status in which case clear those alerts
+            for smart_alert in alerts:
+                dispatcher.call_sync('alert.cancel', smart_alert['id'])
+
+
+def update_smart_info(dispatcher, disk):
+    smart_info = dispatcher.threaded(probe_smart_info, disk)
+    updated = store_smart_info(disk, smart_info)
+    reconcile_smart_alerts(dispatcher, {disk['gdisk_name']: smart_info['smart_status']})
+    return updated
+
 
-    if smart_status in ('FAIL', 'WARN'):
-        # We need to issue a S.M.A.R.T alert for this disk
-        alert_class, title = SMART_ALERT_MAP[smart_status]
-        alert_payload = {
-            'clazz': alert_class,
-            'title': title,
-            'target': disk_name,
-            'description': 'Disk {0} S.M.A.R.T status: {1}.\
-            See disk info in GUI/CLI for details'.format(disk_name, smart_status)
+class SmartPoller(object):
+    """
+    Periodically probes S.M.A.R.T status of all disks. Probes run in a
+    dedicated thread pool, at most SMART_POLL_THREADS at a time, and alerts
+    are reconciled once per pass. A probe which doesn't finish within
+    SMART_PROBE_TIMEOUT is skipped for the pass; the next pass picks up its
+    result instead of starting another probe of the same disk.
+    """
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.threads = ThreadPool(SMART_POLL_THREADS)
+        self.pending = {}
+        self.timings = {}
+        self.last_pass = None
+
+    def probe(self, disk):
+        started_at = time.time()
+        result = self.pending.pop(disk['id'], None) or self.threads.spawn(probe_smart_info, disk)
+        smart_info = None
+        error = None
+
+        try:
+            smart_info = result.get(timeout=SMART_PROBE_TIMEOUT)
+        except gevent.Timeout:
+            self.pending[disk['id']] = result
+            error = 'Timed out after {0} seconds'.format(SMART_PROBE_TIMEOUT)
+            logger.warning('S.M.A.R.T probe of disk %s timed out', disk['gdisk_name'])
+        except Exception as err:
+            error = str(err)
+            logger.warning('Cannot read S.M.A.R.T status of disk %s: %s', disk['gdisk_name'], err)
+
+        self.timings[disk['id']] = {
+            'id': disk['id'],
+            'name': disk['gdisk_name'],
+            'duration': time.time() - started_at,
+            'error': error
         }
 
-        alert_exists = False
+        return disk, smart_info
 
-        for smart_alert in existing_smart_alerts:
-            if smart_alert['clazz'] == alert_class and smart_alert['target'] == disk_name:
-                alert_exists = True
+    def poll(self):
+        started_at = datetime.utcnow()
+        start = time.time()
+        disks = [d for d in diskinfo_cache.validvalues() if d.get('gdisk_name')]
+        workers = gevent.pool.Pool(SMART_POLL_THREADS)
+        updated_disks = []
+        statuses = {}
+
+        for disk, smart_info in workers.imap_unordered(self.probe, disks):
+            if smart_info is None:
                 continue
-            dispatcher.call_sync('alert.cancel', smart_alert['id'])
 
-        if not alert_exists:
-            dispatcher.call_sync('alert.emit', alert_payload)
-    elif smart_status == 'PASS':
-        # for various reasons the SMART status of this disk (or a disk with this name)
-        # may have a previous 'FAIL' | 'WARN' smart status in which case clear those alerts
-        for smart_alert in existing_smart_alerts:
-            dispatcher.call_sync('alert.cancel', smart_alert['id'])
+            if store_smart_info(disk, smart_info):
+                updated_disks.append(disk['id'])
 
-    return updated
+            statuses[disk['gdisk_name']] = smart_info['smart_status']
+
+        if statuses:
+            reconcile_smart_alerts(self.dispatcher, statuses)
+
+        if updated_disks:
+            self.dispatcher.dispatch_event('disk.changed', {
+                'operation': 'update',
+                'ids': updated_disks
+            })
+
+        # Forget disks which are gone
+        ids = {d['id'] for d in disks}
+        for i in list(self.timings):
+            if i not in ids:
+                del self.timings[i]
+
+        self.last_pass = {
+            'started_at': started_at,
+            'duration': time.time() - start,
+            'disks': len(disks),
+            'failed': len(disks) - len(statuses)
+        }
+
+        logger.debug('S.M.A.R.T pass over {0} disks took {1:.0f} ms'.format(
+            len(disks), self.last_pass['duration'] * 1000
+        ))
+
+    def status(self):
+        return {
+            'last_pass': self.last_pass,
+            'pending': len(self.pending),
+            'disks': list(self.timings.values())
+        }
+
+    def run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as err:
+                logger.warning('S.M.A.R.T pass failed: {0}'.format(str(err)))
+
+            gevent.sleep(SMART_CHECK_INTERVAL)
 
 
 def collect_debug(dispatcher):
     yield AttachCommandOutput('gpart', ['/sbin/gpart', 'show'])
     yield AttachData('disk-cache-state', json.dumps(diskinfo_cache.query(), indent=4))
-    yield AttachData('confxml', ElementTree.tostring(confxml(), encoding='utf8', method='xml'))
+    yield AttachData('confxml', geom_snapshot.get().xml)
 
 
 def _depends():
@@ -1659,6 +1878,9 @@ def _depends():
 
 
 def _init(dispatcher, plugin):
+    global smart_poller
+    smart_poller = SmartPoller(dispatcher)
+
     def on_device_attached(args):
         path = args['path']
         if re.match(r'^/dev/(da|ada|vtbd|mfid|nvd)[0-9]+$', path):
@@ -1694,21 +1916,6 @@ def _init(dispatcher, plugin):
                 logger.info('Updating disk cache for device %s', args['path'])
                 update_disk_cache(dispatcher, args['path'])
 
-    def smart_updater():
-        while True:
-            updated_disks = [
-                disk['id'] for disk in diskinfo_cache.validvalues() if update_smart_info(dispatcher, disk)
-            ]
-            if updated_disks:
-                dispatcher.dispatch_event(
-                    'disk.changed',
-                    {
-                        'operation': 'update',
-                        'ids': updated_disks
-                    }
-                )
-            gevent.sleep(SMART_CHECK_INTERVAL)
-
     plugin.register_schema_definition('Disk', {
         'type': 'object',
         'properties': {
@@ -1893,6 +2100,38 @@ def _init(dispatcher, plugin):
         }
     })
 
+    plugin.register_schema_definition('DiskSmartPollStatus', {
+        'type': 'object',
+        'additionalProperties': False,
+        'readOnly': True,
+        'properties': {
+            'last_pass': {
+                'type': ['object', 'null'],
+                'additionalProperties': False,
+                'properties': {
+                    'started_at': {'type': 'datetime'},
+                    'duration': {'type': 'number'},
+                    'disks': {'type': 'integer'},
+                    'failed': {'type': 'integer'}
+                }
+            },
+            'pending': {'type': 'integer'},
+            'disks': {
+                'type': 'array',
+                'items': {
+                    'type': 'object',
+                    'additionalProperties': False,
+                    'properties': {
+                        'id': {'type': 'string'},
+                        'name': {'type': 'string'},
+                        'duration': {'type': 'number'},
+                        'error': {'type': ['string', 'null']}
+                    }
+                }
+            }
+        }
+    })
+
     plugin.register_schema_definition('SmartTestResult', {
         'type': 'object',
         'additonalProperties': False,
@@ -1996,7 +2235,7 @@ def _init(dispatcher, plugin):
     gevent.wait(greenlets)
     logger.info("Syncing disk cache took {0:.0f} ms".format((time.time() - disk_cache_start) * 1000))
 
-    gevent.spawn(smart_updater)
+    gevent.spawn(smart_poller.run)
     dispatcher.track_resources(
         'disk.query',
         'entity-subscriber.disk.changed',
@@ -31,6 +31,12 @@ import stat
 import pwd
 import grp
 import bsd
+import json
+import base64
+import binascii
+import fnmatch
+import heapq
+import itertools
 from datetime import datetime
 from bsd import acl
 from freenas.dispatcher.rpc import RpcException, description, accepts, returns, pass_sender, private, generator
@@ -40,32 +46,55 @@ from auth import FileToken
 from freenas.utils.permissions import modes_to_oct, get_type
 
 
+STREAM_CHUNK_SIZE = 256
+
+
 @description("Provides informations filesystem structure")
 class FilesystemProvider(Provider):
     @description("Lists contents of given directory")
-    @accepts(str)
-    @returns(h.array(h.ref('Directory')))
-    def list_dir(self, path):
-        result = []
-        if not os.path.isdir(path):
+    @accepts(str, h.ref('DirectoryListParams'))
+    @returns(h.array(h.ref('DirectoryEntry')))
+    def list_dir(self, path, params=None):
+        entries, _ = self.dispatcher.threaded(list_entries, path, params or {})
+        return entries
+
+    @description("Lists contents of given directory in a streaming fashion")
+    @accepts(str, h.ref('DirectoryListParams'))
+    @returns(h.array(h.ref('DirectoryEntry')))
+    @generator
+    def list_dir_stream(self, path, params=None):
+        params = params or {}
+        if params.get('sort') or params.get('cursor'):
+            # Sorting needs the whole directory anyway, so it is scanned and sorted once
+            entries, _ = self.dispatcher.threaded(list_entries, path, params)
+            yield from entries
+            return
+
+        if not self.dispatcher.threaded(os.path.isdir, path):
             raise RpcException(errno.ENOENT, 'Path {0} is not a directory'.format(path))
 
-        for i in os.listdir(path):
-            try:
-                st = os.stat(os.path.join(path, i))
-            except OSError:
-                continue
-
-            item = {
-                'name': i,
-                'type': get_type(st),
-                'size': st.st_size,
-                'modified': st.st_mtime
-            }
-
-            result.append(item)
-
-        return result
+        offset = params.get('offset', 0)
+        limit = params.get('limit')
+        entries = iter_dir(path, params.get('name'))
+        window = itertools.islice(entries, offset, offset + limit if limit else None)
+        try:
+            while True:
+                chunk = self.dispatcher.threaded(read_chunk, window, STREAM_CHUNK_SIZE)
+                yield from chunk
+                if len(chunk) < STREAM_CHUNK_SIZE:
+                    return
+        finally:
+            entries.close()
+
+    @description("Returns a single page of directory contents along with cursor pointing to the next page")
+    @accepts(str, h.ref('DirectoryListParams'))
+    @returns(h.ref('DirectoryPage'))
+    def list_dir_page(self, path, params=None):
+        entries, cursor = self.dispatcher.threaded(list_entries, path, params or {})
+        return {
+            'entries': entries,
+            'cursor': cursor
+        }
 
     @accepts(str)
     @returns(h.ref('Stat'))
@@ -335,7 +364,138 @@ class SetPermissionsTask(Task):
         })
 
 
+def iter_dir(path, pattern=None):
+    with os.scandir(path) as it:
+        for entry in it:
+            if pattern and not fnmatch.fnmatchcase(entry.name, pattern):
+                continue
+
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+
+            yield {
+                'name': entry.name,
+                'type': get_type(st),
+                'size': st.st_size,
+                'modified': st.st_mtime
+            }
+
+
+def read_chunk(it, size):
+    try:
+        return list(itertools.islice(it, size))
+    except OSError as err:
+        raise RpcException(err.errno, str(err))
+
+
+def encode_cursor(sort, entry):
+    key = sort.lstrip('-')
+    return base64.urlsafe_b64encode(json.dumps([sort, entry[key], entry['name']]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        sort, value, name = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, binascii.Error):
+        raise RpcException(errno.EINVAL, 'Invalid cursor')
+
+    return sort, value, name
+
+
+def list_entries(path, params):
+    """
+    Lists directory entries according to params. Returns a tuple of the entries
+    and a cursor pointing after the last returned entry, if there are possibly more.
+    """
+    sort = params.get('sort')
+    cursor = params.get('cursor')
+    offset = params.get('offset', 0)
+    limit = params.get('limit')
+
+    if not os.path.isdir(path):
+        raise RpcException(errno.ENOENT, 'Path {0} is not a directory'.format(path))
+
+    if cursor:
+        cursor_sort, value, name = decode_cursor(cursor)
+        if sort and sort != cursor_sort:
+            raise RpcException(errno.EINVAL, 'Cursor was created with different sort order')
+
+        sort = cursor_sort
+
+    if sort and sort.lstrip('-') not in ('name', 'type', 'size', 'modified'):
+        raise RpcException(errno.EINVAL, 'Cannot sort by {0}'.format(sort))
+
+    entries = iter_dir(path, params.get('name'))
+    try:
+        if sort:
+            key = sort.lstrip('-')
+            reverse = sort.startswith('-')
+            sort_key = lambda e: (e[key], e['name'])
+
+            if cursor:
+                if reverse:
+                    entries = (e for e in entries if sort_key(e) < (value, name))
+                else:
+                    entries = (e for e in entries if sort_key(e) > (value, name))
+
+            # With a limit only the requested window needs to be kept in memory
+            if limit:
+                select = heapq.nlargest if reverse else heapq.nsmallest
+                entries = select(offset + limit, entries, key=sort_key)
+            else:
+                entries = sorted(entries, key=sort_key, reverse=reverse)
+
+        # Without sorting there is no need to read past the requested window
+        entries = list(itertools.islice(entries, offset, offset + limit if limit else None))
+    except OSError as err:
+        raise RpcException(err.errno, str(err))
+
+    next_cursor = None
+    if sort and limit and len(entries) == limit:
+        next_cursor = encode_cursor(sort, entries[-1])
+
+    return entries, next_cursor
+
+
 def _init(dispatcher, plugin):
+    plugin.register_schema_definition('DirectoryEntry', {
+        'type': 'object',
+        'properties': {
+            'name': {'type': 'string'},
+            'type': {'type': 'string'},
+            'size': {'type': 'integer'},
+            'modified': {'type': 'number'}
+        }
+    })
+
+    plugin.register_schema_definition('DirectoryListParams', {
+        'type': ['object', 'null'],
+        'properties': {
+            'name': {'type': 'string'},
+            'sort': {
+                'type': 'string',
+                'enum': ['name', '-name', 'type', '-type', 'size', '-size', 'modified', '-modified']
+            },
+            'offset': {'type': 'integer', 'minimum': 0},
+            'limit': {'type': 'integer', 'minimum': 1},
+            'cursor': {'type': ['string', 'null']}
+        },
+        'additionalProperties': False
+    })
+
+    plugin.register_schema_definition('DirectoryPage', {
+        'type': 'object',
+        'properties': {
+            'entries': {
+                'type': 'array',
+                'items': {'$ref': 'DirectoryEntry'}
+            },
+            'cursor': {'type': ['string', 'null']}
+        }
+    })
+
     plugin.register_schema_definition('Stat', {
         'type': 'object',
         'properties': {
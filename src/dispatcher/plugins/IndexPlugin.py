@@ -26,21 +26,35 @@
 #####################################################################
 
 import os
+import stat
 import errno
+import queue
 import libzfs
 import bsd
+import logging
+import threading
 from datetime import datetime
+from datastore import DatastoreException
 from task import Provider, TaskDescription, TaskException, ProgressTask, query
 from freenas.dispatcher.rpc import generator, description, accepts, private
 from freenas.utils.permissions import get_type, get_unix_permissions
 
 
+logger = logging.getLogger('IndexPlugin')
+WALKER_THREADS = 4
+BATCH_SIZE = 1000
+PROGRESS_INTERVAL = 5
+
+
 @description("Provides access to the filesystem index")
 class IndexProvider(Provider):
     @generator
     @query('FileIndex')
     def query(self, filter=None, params=None):
-        return self.datastore.query_stream('fileindex', *(filter or []), **(params or {}))
+        params = dict(params or {})
+        exclude = params.get('exclude') or []
+        params['exclude'] = ['trigrams'] + ([exclude] if isinstance(exclude, str) else list(exclude))
+        return self.datastore.query_stream('fileindex', *narrow_filter(filter or []), **params)
 
 
 @description("Generates index of a specified volume")
@@ -119,8 +133,9 @@ class IndexDatasetIncrementalTask(ProgressTask):
         if not ds:
             raise TaskException(errno.ENOENT, 'Dataset {0} not found'.format(dataset))
 
-        for rec in ds.diff('{0}@org.freenas.indexer:ref'.format(dataset), '{0}@org.freenas.indexer:now'.format(dataset)):
-            collect(self.datastore, rec.path)
+        with IndexWriter(self.datastore) as writer:
+            for rec in ds.diff('{0}@org.freenas.indexer:ref'.format(dataset), '{0}@org.freenas.indexer:now'.format(dataset)):
+                collect(writer, rec.path)
 
         self.run_subtask_sync('volume.snapshot.delete', '{0}@org.freenas.indexer:ref'.format(dataset))
         self.run_subtask_sync('volume.snapshot.update', '{0}@org.freenas.indexer:now'.format(dataset), {
@@ -146,22 +161,17 @@ class IndexDatasetFullTask(ProgressTask):
 
         # Estimate number of files
         statfs = bsd.statfs(mountpoint)
-        total_files = statfs.files - statfs.free_files
-        done_files = 0
-
-        for root, dirs, files in os.walk(mountpoint, topdown=True):
-            dirs[:] = [dir for dir in dirs if not os.path.ismount(os.path.join(root, dir))]
+        total_files = (statfs.files - statfs.free_files) or 1
 
-            for d in dirs:
-                path = os.path.join(root, d)
-                collect(self.datastore, path)
-                done_files += 1
-                self.set_progress(done_files / total_files * 100, 'Processing directory {0}'.format(path))
+        with IndexWriter(self.datastore) as writer:
+            def report_progress():
+                self.set_progress(
+                    min(writer.written / total_files * 100, 100),
+                    'Indexed {0} files'.format(writer.written)
+                )
 
-            for f in files:
-                path = os.path.join(root, f)
-                collect(self.datastore, path)
-                done_files += 1
+            with ProgressTimer(PROGRESS_INTERVAL, report_progress):
+                walk(mountpoint, WALKER_THREADS, writer.put)
 
         self.run_subtask_sync('volume.snapshot.create', {
             'dataset': dataset,
@@ -170,18 +180,269 @@ class IndexDatasetFullTask(ProgressTask):
         })
 
 
-def collect(datastore, path):
-    try:
-        st = os.stat(path, follow_symlinks=False)
-    except OSError as err:
-        # Can't access the file - delete index entry
-        datastore.delete('fileindex', path)
-        return
+class IndexWriter(object):
+    """
+    Accumulates index records and writes them to the datastore in batches
+    """
+    def __init__(self, datastore, batch_size=BATCH_SIZE):
+        self.datastore = datastore
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.upserts = []
+        self.deletes = []
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def put(self, record):
+        with self.lock:
+            self.upserts.append(record)
+            if len(self.upserts) < self.batch_size:
+                return
+
+            batch, self.upserts = self.upserts, []
+
+        self.datastore.upsert_many('fileindex', batch)
+        with self.lock:
+            self.written += len(batch)
+
+    def delete(self, path):
+        with self.lock:
+            self.deletes.append(path)
+            if len(self.deletes) < self.batch_size:
+                return
+
+            batch, self.deletes = self.deletes, []
+
+        self.datastore.delete_many('fileindex', batch)
+
+    def flush(self):
+        with self.lock:
+            upserts, self.upserts = self.upserts, []
+            deletes, self.deletes = self.deletes, []
+
+        self.datastore.upsert_many('fileindex', upserts)
+        self.datastore.delete_many('fileindex', deletes)
+        with self.lock:
+            self.written += len(upserts)
+
+
+class ProgressTimer(object):
+    def __init__(self, interval, callback):
+        self.interval = interval
+        self.callback = callback
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            self.callback()
+
+
+def walk(root, workers, callback):
+    """
+    Walks the directory tree starting at root using a bounded pool of threads, calling
+    callback with an index record for every entry found. Does not cross mountpoints.
+    """
+    root_dev = os.lstat(root).st_dev
+    dirs = queue.Queue()
+    pending = 1
+    lock = threading.Lock()
+    errors = []
+
+    def scan(path):
+        # Only unreadable directories and entries are skipped; callback failures
+        # propagate to the worker and end up in errors
+        try:
+            it = os.scandir(path)
+        except OSError:
+            return
+
+        with it:
+            while True:
+                try:
+                    entry = next(it)
+                except (StopIteration, OSError):
+                    return
+
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+
+                if stat.S_ISDIR(st.st_mode):
+                    if st.st_dev != root_dev:
+                        # Mountpoint of another filesystem
+                        continue
+
+                    yield entry.path
+
+                callback(make_record(entry.path, st))
+
+    def worker():
+        nonlocal pending
+        while True:
+            path = dirs.get()
+            if path is None:
+                return
+
+            try:
+                if not errors:
+                    for subdir in scan(path):
+                        with lock:
+                            pending += 1
+
+                        dirs.put(subdir)
+            except BaseException as err:
+                errors.append(err)
+            finally:
+                with lock:
+                    pending -= 1
+                    if pending == 0:
+                        for _ in range(workers):
+                            dirs.put(None)
+
+    dirs.put(root)
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for t in threads:
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+
+
+def trigrams(s):
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+def class_end(pattern, start):
+    """
+    Returns index of the ] closing the character class opened at start, or length
+    of the pattern if the class is unterminated. A ] right after [ or [^ is literal.
+    """
+    i = start + 1
+    if i < len(pattern) and pattern[i] == '^':
+        i += 1
+
+    if i < len(pattern) and pattern[i] == ']':
+        i += 1
+
+    while i < len(pattern):
+        if pattern[i] == '\\':
+            i += 2
+            continue
+
+        if pattern[i] == ']':
+            return i
+
+        i += 1
+
+    return len(pattern)
+
+
+def pattern_trigrams(pattern):
+    """
+    Returns trigrams every string matched by the regex pattern has to contain.
+    Patterns with alternations, groups or inline flags yield no trigrams.
+    """
+    if '|' in pattern or '(' in pattern:
+        return set()
+
+    runs = []
+    current = ''
+    i = 0
+
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == '\\' and i + 1 < len(pattern):
+            nxt = pattern[i + 1]
+            i += 2
+            if nxt.isalnum():
+                # Character class escape (\d, \w, ...)
+                runs.append(current)
+                current = ''
+            else:
+                current += nxt
+
+            continue
+
+        if ch in '*?{':
+            # Previous character is optional
+            current = current[:-1]
+            runs.append(current)
+            current = ''
+            if ch == '{':
+                end = pattern.find('}', i + 1)
+                i = len(pattern) if end == -1 else end
+        elif ch == '[':
+            runs.append(current)
+            current = ''
+            i = class_end(pattern, i)
+        elif ch in '.^$+]':
+            runs.append(current)
+            current = ''
+        else:
+            current += ch
+
+        i += 1
+
+    runs.append(current)
+    result = set()
+    for run in runs:
+        result |= trigrams(run)
+
+    return result
+
+
+def narrow_filter(filter):
+    """
+    Rewrites regex predicates on file path so that candidates are first selected
+    through the trigram index. Entries indexed before trigrams were introduced
+    have no trigrams field and are always considered candidates.
+    """
+    result = []
+    for i in filter:
+        if len(i) == 2 and i[0] in ('and', 'or', 'nor'):
+            result.append((i[0], narrow_filter(i[1])))
+            continue
+
+        if len(i) == 3 and i[0] == 'id' and i[1] == '~':
+            tg = pattern_trigrams(i[2])
+            if tg:
+                result.append(('and', [
+                    ('or', [
+                        ('and', [('trigrams', '=', t) for t in sorted(tg)]),
+                        ('trigrams', '=', None)
+                    ]),
+                    tuple(i)
+                ]))
+                continue
+
+        result.append(i)
+
+    return result
+
 
-    volume = path.split('/')[2]
-    datastore.upsert('fileindex', path, {
+def make_record(path, st):
+    return {
         'id': path,
-        'volume': volume,
+        'trigrams': sorted(trigrams(path)),
+        'volume': path.split('/')[2],
         'type': get_type(st),
         'atime': datetime.utcfromtimestamp(st.st_atime),
         'mtime': datetime.utcfromtimestamp(st.st_mtime),
@@ -189,7 +450,18 @@ def collect(datastore, path):
         'uid': st.st_uid,
         'gid': st.st_gid,
         'permissions': get_unix_permissions(st.st_mode)
-    })
+    }
+
+
+def collect(writer, path):
+    try:
+        st = os.stat(path, follow_symlinks=False)
+    except OSError as err:
+        # Can't access the file - delete index entry
+        writer.delete(path)
+        return
+
+    writer.put(make_record(path, st))
 
 
 def _init(dispatcher, plugin):
@@ -210,6 +482,11 @@ def _init(dispatcher, plugin):
         }
     })
 
+    try:
+        dispatcher.datastore.collection_ensure_index('fileindex', 'trigrams')
+    except DatastoreException as err:
+        logger.warning('Cannot create trigram index on file index: {0}'.format(str(err)))
+
     plugin.register_provider('index', IndexProvider)
     plugin.register_task_handler('index.generate', IndexVolumeTask)
     plugin.register_task_handler('index.generate.dataset.full', IndexDatasetFullTask)
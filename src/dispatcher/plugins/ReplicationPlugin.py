@@ -33,7 +33,9 @@ import time
 import copy
 import gevent
 import socket
+import queue
 import logging
+import threading
 from cache import CacheStore
 from resources import Resource
 from datetime import datetime, timedelta
@@ -42,6 +44,7 @@ from task import Provider, Task, ProgressTask, VerifyException, TaskException, T
 from freenas.dispatcher.rpc import RpcException, SchemaHelper as h, description, accepts, returns, private, generator
 from freenas.dispatcher.fd import FileDescriptor
 from utils import get_freenas_peer_client, call_task_and_check_state
+from lib.replication import group_remote_snapshots, group_local_snapshots, find_common_snapshot, find_deleted_snapshots
 from freenas.utils import first_or_default, query as q, normalize, human_readable_bytes
 from freenas.utils.decorators import throttle
 
@@ -414,6 +417,7 @@ class ReplicationCreateTask(ReplicationBaseTask):
                 'transport_options': [],
                 'snapshot_lifetime': 365 * 24 * 60 * 60,
                 'followdelete': False,
+                'concurrency': 1,
                 'status': []
             }
         )
@@ -944,7 +948,8 @@ class ReplicationSyncTask(ReplicationBaseTask):
                                 'recursive': link['recursive'],
                                 'nomount': True,
                                 'lifetime': link['snapshot_lifetime'],
-                                'followdelete': link['followdelete']
+                                'followdelete': link['followdelete'],
+                                'concurrency': link.get('concurrency', 1)
                             },
                             link['transport_options'],
                             progress_callback=lambda p, m, e=None: report_progress(p, m, e)
@@ -1150,18 +1155,8 @@ class CalculateReplicationDeltaTask(Task):
 
     def run(self, localds, remoteds, snapshots_list, recursive=False, followdelete=False):
         datasets = [localds]
-        remote_datasets = list(filter(lambda s: '@' not in s['name'], snapshots_list))
         actions = []
 
-        def matches(src, tgt):
-            return src['snapshot_name'] == tgt['snapshot_name'] and src['created_at'] == tgt['created_at']
-
-        def match_snapshots(local, remote):
-            for i in local:
-                match = first_or_default(lambda s: matches(i, s), remote)
-                if match:
-                    yield i, match
-
         def convert_snapshot(snap):
             return {
                 'name': snap['name'],
@@ -1177,6 +1172,8 @@ class CalculateReplicationDeltaTask(Task):
         for i in snapshots_list:
             extend_with_snapshot_name(i)
 
+        remote_datasets, remote_snapshots_by_ds = group_remote_snapshots(snapshots_list)
+
         if recursive:
             datasets = list(self.dispatcher.call_sync(
                 'zfs.dataset.query',
@@ -1184,24 +1181,19 @@ class CalculateReplicationDeltaTask(Task):
                 {'select': 'name'}
             ))
 
+            local_snapshots_list = self.dispatcher.call_sync('zfs.dataset.get_snapshots_recursive', localds)
+        else:
+            local_snapshots_list = self.dispatcher.call_sync('zfs.dataset.get_snapshots', localds)
+
+        local_snapshots_by_ds = group_local_snapshots(map(convert_snapshot, local_snapshots_list))
+
         for ds in datasets:
             localfs = ds
             remotefs = localfs.replace(localds, remoteds, 1)
 
-            local_snapshots = sorted(
-                list(map(
-                    convert_snapshot,
-                    self.dispatcher.call_sync('zfs.dataset.get_snapshots', localfs)
-                )),
-                key=lambda x: x['txg']
-            )
-
-            remote_snapshots = q.query(
-                snapshots_list,
-                ('name', '~', '^{0}@'.format(remotefs))
-            )
-
-            remote_ds = first_or_default(lambda s: s['name'] == remotefs, snapshots_list)
+            local_snapshots = sorted(local_snapshots_by_ds.get(localfs, []), key=lambda x: x['txg'])
+            remote_snapshots = remote_snapshots_by_ds.get(remotefs, [])
+            remote_ds = remote_datasets.get(remotefs)
             snapshots = local_snapshots[:]
             found = None
 
@@ -1223,24 +1215,19 @@ class CalculateReplicationDeltaTask(Task):
                     snapshot=token_info['toname'].split('@')[-1]
                 ))
 
-                found = first_or_default(lambda s: s['name'] == token_info['toname'], local_snapshots)
+                found = next(
+                    (idx for idx, s in enumerate(local_snapshots) if s['name'] == token_info['toname']),
+                    None
+                )
 
-            if remote_snapshots or found:
+            if remote_snapshots or found is not None:
                 # Find out the last common snapshot.
-                if not found:
-                    pairs = list(match_snapshots(local_snapshots, remote_snapshots))
-                    if pairs:
-                        pairs.sort(key=lambda p: p[0]['created_at'], reverse=True)
-                        found, _ = first_or_default(None, pairs)
+                if found is None:
+                    found = find_common_snapshot(local_snapshots, remote_snapshots)
 
-                if found:
+                if found is not None:
                     if followdelete:
-                        delete = []
-                        for snap in remote_snapshots:
-                            rsnap = snap['snapshot_name']
-                            if not first_or_default(lambda s: s['snapshot_name'] == rsnap, local_snapshots):
-                                delete.append(rsnap)
-
+                        delete = find_deleted_snapshots(local_snapshots, remote_snapshots)
                         if delete:
                             actions.append(ReplicationAction(
                                 ReplicationActionType.DELETE_SNAPSHOTS,
@@ -1249,9 +1236,7 @@ class CalculateReplicationDeltaTask(Task):
                                 snapshots=delete
                             ))
 
-                    index = local_snapshots.index(found)
-
-                    for idx in range(index + 1, len(local_snapshots)):
+                    for idx in range(found + 1, len(local_snapshots)):
                         actions.append(ReplicationAction(
                             ReplicationActionType.SEND_STREAM,
                             localfs,
@@ -1289,11 +1274,11 @@ class CalculateReplicationDeltaTask(Task):
                         snapshot=snapshots[idx]['snapshot_name']
                     ))
 
-        for rds in remote_datasets:
-            remotefs = rds['name']
+        local_datasets = set(datasets)
+        for remotefs in remote_datasets:
             localfs = remotefs.replace(remoteds, localds, 1)
 
-            if localfs not in datasets:
+            if localfs not in local_datasets:
                 actions.append(ReplicationAction(
                     ReplicationActionType.DELETE_DATASET,
                     localfs,
@@ -1325,8 +1310,7 @@ class CalculateReplicationDeltaTask(Task):
 class ReplicateDatasetTask(ProgressTask):
     def __init__(self, dispatcher):
         super(ReplicateDatasetTask, self).__init__(dispatcher)
-        self.rd_fd = None
-        self.wr_fd = None
+        self.fds = set()
         self.aborted = False
 
     @classmethod
@@ -1348,6 +1332,7 @@ class ReplicateDatasetTask(ProgressTask):
         force = options.get('force', True)
         peer = options.get('peer')
         nomount = options.get('nomount', False)
+        concurrency = options.get('concurrency', 1)
 
         self.run_subtask_sync(
             'volume.snapshot_dataset',
@@ -1431,29 +1416,34 @@ class ReplicateDatasetTask(ProgressTask):
             followdelete
         )
 
+        schedule = plan_replication_schedule(actions)
+
         if dry_run:
-            return actions, send_size
+            return actions, send_size, schedule
 
         # 2nd pass - actual send
-        progress = 0
+        lock = threading.Lock()
         done = 0
+        finished = 0
         actions_len = len(actions)
 
-        for idx, action in enumerate(actions):
-            def get_progress(delta=None):
-                nonlocal progress, done, idx
+        def get_progress(delta=None, completed=False):
+            nonlocal done, finished
+            with lock:
                 if delta:
                     done += delta
 
-                progress = ((idx / actions_len) * 100) + ((1 / actions_len) * 100 * (done / (send_size or 1)))
-                if progress > 100:
-                    progress = 100
+                if completed:
+                    finished += 1
 
-                return progress
+                if send_size:
+                    progress = (done / send_size) * 100
+                else:
+                    progress = (finished / (actions_len or 1)) * 100
 
-            if self.aborted:
-                break
+                return min(progress, 100)
 
+        def run_action(action):
             if action['type'] in (ReplicationActionType.DELETE_SNAPSHOTS.name, ReplicationActionType.CLEAR_SNAPSHOTS.name):
                 self.set_progress(get_progress(), 'Removing snapshots on remote dataset {0}'.format(action['remotefs']))
                 # Remove snapshots on remote side
@@ -1469,53 +1459,60 @@ class ReplicateDatasetTask(ProgressTask):
                     ))
 
             if action['type'] == ReplicationActionType.SEND_STREAM.name:
-                self.rd_fd, self.wr_fd = os.pipe()
+                rd_fd, wr_fd = os.pipe()
                 fromsnap = action['anchor'] if 'anchor' in action else None
 
-                if action.get('resume'):
-                    send_task = self.run_subtask(
-                        'zfs.send_resume',
-                        action['token'],
-                        FileDescriptor(self.wr_fd)
-                    )
-                else:
-                    send_task = self.run_subtask(
-                        'zfs.send',
-                        action['localfs'],
-                        fromsnap,
-                        action['snapshot'],
-                        FileDescriptor(self.wr_fd)
-                    )
+                with lock:
+                    self.fds.update((rd_fd, wr_fd))
+
+                try:
+                    if action.get('resume'):
+                        send_task = self.run_subtask(
+                            'zfs.send_resume',
+                            action['token'],
+                            FileDescriptor(wr_fd)
+                        )
+                    else:
+                        send_task = self.run_subtask(
+                            'zfs.send',
+                            action['localfs'],
+                            fromsnap,
+                            action['snapshot'],
+                            FileDescriptor(wr_fd)
+                        )
 
-                self.join_subtasks(
-                    send_task,
-                    self.run_subtask(
-                        'replication.transport.send',
-                        FileDescriptor(self.rd_fd),
-                        {
-                            'client_address': remote,
-                            'transport_plugins': transport_plugins,
-                            'receive_properties': {
-                                'name': action['remotefs'],
-                                'force': force,
-                                'nomount': nomount,
-                                'props': {'mountpoint': None}
+                    self.join_subtasks(
+                        send_task,
+                        self.run_subtask(
+                            'replication.transport.send',
+                            FileDescriptor(rd_fd),
+                            {
+                                'client_address': remote,
+                                'transport_plugins': transport_plugins,
+                                'receive_properties': {
+                                    'name': action['remotefs'],
+                                    'force': force,
+                                    'nomount': nomount,
+                                    'props': {'mountpoint': None}
+                                },
+                                'estimated_size': send_size or 1
                             },
-                            'estimated_size': send_size or 1
-                        },
-                        progress_callback=lambda p, m, e=None: self.set_progress(
-                            get_progress(e),
-                            'Sending {0} stream of snapshot {1}@{2} - {3}% - speed {4}'.format(
-                                'incremental' if action['incremental'] else 'full',
-                                action['localfs'],
-                                action['snapshot'],
-                                int(p),
-                                human_readable_bytes(e, '/s')
-                            ),
-                            extra=e
+                            progress_callback=lambda p, m, e=None: self.set_progress(
+                                get_progress(e),
+                                'Sending {0} stream of snapshot {1}@{2} - {3}% - speed {4}'.format(
+                                    'incremental' if action['incremental'] else 'full',
+                                    action['localfs'],
+                                    action['snapshot'],
+                                    int(p),
+                                    human_readable_bytes(e, '/s')
+                                ),
+                                extra=e
+                            )
                         )
                     )
-                )
+                finally:
+                    with lock:
+                        self.fds.difference_update((rd_fd, wr_fd))
 
             if action['type'] == ReplicationActionType.DELETE_DATASET.name:
                 self.set_progress(get_progress(), 'Removing remote dataset {0}'.format(action['remotefs']))
@@ -1530,6 +1527,25 @@ class ReplicateDatasetTask(ProgressTask):
                         result['error']['message']
                     ))
 
+            get_progress(completed=True)
+
+        def run_chain(chain):
+            for action in chain['actions']:
+                if self.aborted:
+                    break
+
+                run_action(action)
+
+        self.execute_schedule(schedule, concurrency, run_chain)
+
+        # Remote datasets removal goes last, after every stream has been received
+        for action in actions:
+            if self.aborted:
+                break
+
+            if action['type'] == ReplicationActionType.DELETE_DATASET.name:
+                run_action(action)
+
         remote_client.disconnect()
 
         subtasks = []
@@ -1539,12 +1555,69 @@ class ReplicateDatasetTask(ProgressTask):
                 'org.freenas:last_replicated_at': {'value': int(time.time())}
             }))
 
-        return actions, send_size
+        return actions, send_size, schedule
+
+    def execute_schedule(self, schedule, concurrency, worker_fn):
+        # Runs dataset chains on a bounded pool of worker threads. A chain is queued only
+        # once its parent chain is done, so parent datasets always exist on the remote side
+        # before their children are received.
+        ready = queue.Queue()
+        lock = threading.Lock()
+        children = {}
+        errors = []
+        remaining = len(schedule)
+        workers = max(1, min(concurrency, remaining))
+
+        for chain in schedule:
+            if chain['parent']:
+                children.setdefault(chain['parent'], []).append(chain)
+            else:
+                ready.put(chain)
+
+        def worker():
+            nonlocal remaining
+            while True:
+                chain = ready.get()
+                if chain is None:
+                    return
+
+                try:
+                    # Chains of failed parents are still dequeued, just not executed
+                    if not errors and not self.aborted:
+                        worker_fn(chain)
+                except BaseException as err:
+                    with lock:
+                        errors.append(err)
+                finally:
+                    with lock:
+                        for c in children.pop(chain['localfs'], []):
+                            ready.put(c)
+
+                        remaining -= 1
+                        if remaining == 0:
+                            for _ in range(workers):
+                                ready.put(None)
+
+        if not schedule:
+            return
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise errors[0]
 
     def abort(self):
         self.aborted = True
-        self.rd_fd.close()
-        self.wr_fd.close()
+        for fd in list(self.fds):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
 
 
 @private
@@ -1770,6 +1843,48 @@ class ReplicationCleanHistoryTask(ReplicationBaseTask):
             remote_client.disconnect()
 
 
+def plan_replication_schedule(actions):
+    """
+    Groups replication actions into per-dataset chains. Actions within a chain have
+    to be executed in order, while chains only depend on the chain of their closest
+    parent dataset. DELETE_DATASET actions are not part of any chain.
+    """
+    chains = {}
+    for action in actions:
+        if action['type'] == ReplicationActionType.DELETE_DATASET.name:
+            continue
+
+        chain = chains.get(action['localfs'])
+        if not chain:
+            chain = chains[action['localfs']] = {
+                'localfs': action['localfs'],
+                'remotefs': action['remotefs'],
+                'parent': None,
+                'depth': 0,
+                'send_size': 0,
+                'actions': []
+            }
+
+        chain['actions'].append(action)
+        chain['send_size'] += action.get('send_size') or 0
+
+    for name, chain in chains.items():
+        parts = name.split('/')
+        for i in range(len(parts) - 1, 0, -1):
+            parent = '/'.join(parts[:i])
+            if parent in chains:
+                chain['parent'] = parent
+                break
+
+    for chain in chains.values():
+        parent = chain['parent']
+        while parent:
+            chain['depth'] += 1
+            parent = chains[parent]['parent']
+
+    return list(chains.values())
+
+
 def get_services(dispatcher, service, relation, link_name):
     services = []
     link = dispatcher.call_task_sync('replication.get_latest_link', link_name)
@@ -1819,7 +1934,8 @@ def _init(dispatcher, plugin):
             'lifetime': {'type': ['number', 'null']},
             'recursive': {'type': 'boolean'},
             'force': {'type': 'boolean'},
-            'nomount': {'type': 'boolean'}
+            'nomount': {'type': 'boolean'},
+            'concurrency': {'type': 'integer', 'minimum': 1}
         },
         'additionalProperties': False,
     })
@@ -1852,7 +1968,8 @@ def _init(dispatcher, plugin):
                 'items': {'$ref': 'ReplicationTransportOption'}
             },
             'snapshot_lifetime': {'type': 'number'},
-            'followdelete': {'type': 'boolean'}
+            'followdelete': {'type': 'boolean'},
+            'concurrency': {'type': 'integer', 'minimum': 1}
         },
         'additionalProperties': False,
     })
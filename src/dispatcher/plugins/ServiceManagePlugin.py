@@ -26,9 +26,11 @@
 #####################################################################
 
 import os
+import copy
 import errno
 import logging
 import signal
+from gevent.lock import RLock
 from task import Task, ProgressTask, Provider, TaskException, TaskDescription, ValidationException, query
 from debug import AttachFile, AttachData, AttachCommandOutput
 from resources import Resource
@@ -41,6 +43,89 @@ from freenas.utils.lazy import lazy
 
 
 logger = logging.getLogger('ServiceManagePlugin')
+status_cache = None
+
+
+class ServiceStatusCache(object):
+    """
+    Keeps serviced job states and service configs, so that service.query
+    doesn't need to ask serviced and configstore about every service.
+    Jobs are bulk-loaded on first use and then updated from
+    serviced.job.state_changed, which serviced emits on every transition;
+    configs are dropped on service.changed and service.*.changed.
+
+    Cached job states are for reporting only. Anything starting, stopping
+    or signalling a service has to use get_status(..., fresh=True).
+    """
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.lock = RLock()
+        self.jobs = None
+        self.configs = {}
+        self.generation = 0
+
+    def get_job(self, label):
+        with self.lock:
+            if self.jobs is None:
+                # serviced filters Job objects, not their serialized form, so
+                # child jobs are weeded out here
+                self.jobs = {
+                    j['Label']: j for j in
+                    self.dispatcher.call_sync('serviced.job.query')
+                    if j['ParentID'] is None
+                }
+
+            return self.jobs.get(label)
+
+    def refresh_job(self, label):
+        with self.lock:
+            if self.jobs is None:
+                return
+
+            try:
+                self.jobs[label] = self.dispatcher.call_sync('serviced.job.get', label)
+            except RpcException:
+                self.jobs.pop(label, None)
+
+    def update_job(self, label, **kwargs):
+        with self.lock:
+            if self.jobs is None:
+                return
+
+            job = self.jobs.get(label)
+            if not job:
+                self.refresh_job(label)
+                return
+
+            job.update(kwargs)
+
+    def remove_job(self, label):
+        with self.lock:
+            if self.jobs is not None:
+                self.jobs.pop(label, None)
+
+    def invalidate_jobs(self):
+        with self.lock:
+            self.jobs = None
+
+    def get_config(self, id, fetch):
+        if id not in self.configs:
+            generation = self.generation
+            config = fetch()
+            # Don't store a config which got invalidated while it was being fetched
+            if generation == self.generation:
+                self.configs[id] = config
+
+            return copy.deepcopy(config)
+
+        return copy.deepcopy(self.configs[id])
+
+    def invalidate_config(self, id=None):
+        self.generation += 1
+        if id is None:
+            self.configs.clear()
+        else:
+            self.configs.pop(id, None)
 
 
 @description("Provides info about available services and their state")
@@ -49,8 +134,10 @@ class ServiceInfoProvider(Provider):
     @query("service")
     @generator
     def query(self, filter=None, params=None):
+        services = {s['id']: s for s in self.datastore.query('service_definitions')}
+
         def extend(i):
-            lazy_status = lazy(get_status, self.dispatcher, self.datastore, i)
+            lazy_status = lazy(get_status, self.dispatcher, self.datastore, i, services)
             entry = {
                 'id': i['id'],
                 'name': i['name'],
@@ -64,13 +151,13 @@ class ServiceInfoProvider(Provider):
                 jobs = [launchd] if isinstance(launchd, dict) else launchd
                 entry['labels'] = [j['Label'] for j in jobs]
 
-            entry['pid'] = lazy(lambda: lazy_status()[2]),
+            entry['pid'] = lazy(lambda: lazy_status()[2])
             entry['builtin'] = i['builtin']
             entry['config'] = lazy(self.get_service_config, i['id'])
             return entry
 
         return q.query(
-            self.datastore.query_stream('service_definitions', callback=extend),
+            (extend(i) for i in services.values()),
             *(filter or []),
             stream=True,
             **(params or {})
@@ -79,21 +166,24 @@ class ServiceInfoProvider(Provider):
     @accepts(str)
     @returns(h.object())
     def get_service_config(self, id):
-        svc = self.datastore.get_by_id('service_definitions', id)
-        if not svc:
-            raise RpcException(errno.EINVAL, 'Invalid service name')
+        def fetch():
+            svc = self.datastore.get_by_id('service_definitions', id)
+            if not svc:
+                raise RpcException(errno.EINVAL, 'Invalid service name')
 
-        if svc.get('get_config_rpc'):
-            ret = self.dispatcher.call_sync(svc['get_config_rpc'])
-        else:
-            ret = ConfigNode('service.{0}'.format(svc['name']), self.configstore).__getstate__()
+            if svc.get('get_config_rpc'):
+                ret = self.dispatcher.call_sync(svc['get_config_rpc'])
+            else:
+                ret = ConfigNode('service.{0}'.format(svc['name']), self.configstore).__getstate__()
 
-        if not ret:
-            return
+            if not ret:
+                return
 
-        return extend_dict(ret, {
-            'type': 'service-{0}'.format(svc['name'])
-        })
+            return extend_dict(ret, {
+                'type': 'service-{0}'.format(svc['name'])
+            })
+
+        return status_cache.get_config(id, fetch)
 
     @private
     @accepts(str)
@@ -153,10 +243,11 @@ class ServiceInfoProvider(Provider):
     @accepts(str)
     def reload(self, service):
         svc = self.datastore.get_one('service_definitions', ('name', '=', service))
-        status, _, pid = get_status(self.dispatcher, self.datastore, svc)
         if not svc:
             raise RpcException(errno.ENOENT, 'Service {0} not found'.format(service))
 
+        status, _, pid = get_status(self.dispatcher, self.datastore, svc, fresh=True)
+
         if status != 'RUNNING':
             return
 
@@ -175,10 +266,11 @@ class ServiceInfoProvider(Provider):
     @accepts(str)
     def restart(self, service):
         svc = self.datastore.get_one('service_definitions', ('name', '=', service))
-        status, _, _ = get_status(self.dispatcher, self.datastore, svc)
         if not svc:
             raise RpcException(errno.ENOENT, 'Service {0} not found'.format(service))
 
+        status, _, _ = get_status(self.dispatcher, self.datastore, svc, fresh=True)
+
         if status != 'RUNNING':
             return
 
@@ -206,7 +298,7 @@ class ServiceInfoProvider(Provider):
         if not svc:
             raise RpcException(errno.ENOENT, 'Service {0} not found'.format(service))
 
-        state, _, pid = get_status(self.dispatcher, self.datastore, svc)
+        state, _, pid = get_status(self.dispatcher, self.datastore, svc, fresh=True)
         node = ConfigNode('service.{0}'.format(service), self.configstore)
 
         if node['enable'].value and state != 'RUNNING':
@@ -248,7 +340,7 @@ class ServiceManageTask(Task):
             raise TaskException(errno.ENOENT, 'Service {0} not found'.format(id))
 
         service = self.datastore.get_by_id('service_definitions', id)
-        state, _, pid = get_status(self.dispatcher, self.datastore, service)
+        state, _, pid = get_status(self.dispatcher, self.datastore, service, fresh=True)
         hook_rpc = service.get('{0}_rpc'.format(action))
         name = service['name']
 
@@ -406,6 +498,8 @@ def load_job(dispatcher, svc):
             if err.code != errno.EEXIST:
                 raise
 
+        status_cache.refresh_job(plist['Label'])
+
 
 def unload_job(dispatcher, svc):
     if isinstance(svc['launchd'], dict):
@@ -418,8 +512,23 @@ def unload_job(dispatcher, svc):
             if err.code != errno.ENOENT:
                 raise
 
+        status_cache.remove_job(plist['Label'])
+
+
+def get_job(dispatcher, label, fresh=False):
+    if not fresh:
+        return status_cache.get_job(label)
 
-def get_status(dispatcher, datastore, service):
+    try:
+        return dispatcher.call_sync('serviced.job.get', label)
+    except RpcException as err:
+        if err.code != errno.ENOENT:
+            raise
+
+        return None
+
+
+def get_status(dispatcher, datastore, service, services=None, fresh=False):
     if 'status_rpc' in service:
         state = 'RUNNING'
         error = None
@@ -442,7 +551,10 @@ def get_status(dispatcher, datastore, service):
             states = []
 
             for i in plists:
-                job = dispatcher.call_sync('serviced.job.get', i['Label'])
+                job = get_job(dispatcher, i['Label'], fresh)
+                if not job:
+                    raise RpcException(errno.ENOENT, 'Job {0} not found'.format(i['Label']))
+
                 states.append(job['State'])
                 errors.append(job.get('FailureReason'))
                 if job['PID']:
@@ -471,8 +583,12 @@ def get_status(dispatcher, datastore, service):
         state = 'RUNNING'
 
         for i in service['dependencies']:
-            d_service = datastore.get_one('service_definitions', ('id', '=', i))
-            d_state, d_error, d_pid = get_status(dispatcher, datastore, d_service)
+            if services is not None:
+                d_service = services.get(i)
+            else:
+                d_service = datastore.get_one('service_definitions', ('id', '=', i))
+
+            d_state, d_error, d_pid = get_status(dispatcher, datastore, d_service, services, fresh)
             if d_state != 'RUNNING':
                 state = d_state
                 error = d_error
@@ -492,6 +608,9 @@ def collect_debug(dispatcher):
 
 
 def _init(dispatcher, plugin):
+    global status_cache
+    status_cache = ServiceStatusCache(dispatcher)
+
     def on_ready(args):
         for svc in dispatcher.datastore.query('service_definitions'):
             logger.debug('Loading service {0}'.format(svc['name']))
@@ -515,6 +634,15 @@ def _init(dispatcher, plugin):
         dispatcher.emit_event('service.ready', {})
 
     def on_job_changed(args):
+        state = args['State']
+        if not args.get('Anonymous'):
+            status_cache.update_job(
+                args['Label'],
+                State=state,
+                PID=args.get('PID') if state in ('STARTING', 'RUNNING', 'STOPPING') else None,
+                FailureReason=args.get('Reason')
+            )
+
         svc = dispatcher.datastore.get_one('service_definitions', ('launchd.Label', '=', args['Label']))
         if svc:
             dispatcher.emit_event('service.changed', {
@@ -522,6 +650,24 @@ def _init(dispatcher, plugin):
                 'ids': [svc['id']]
             })
 
+    def on_serviced_session(args):
+        # Job states might have changed while serviced was away
+        if args['name'] == 'serviced':
+            status_cache.invalidate_jobs()
+
+    def on_service_changed(args):
+        if args.get('operation') == 'update' and args.get('ids'):
+            for i in args['ids']:
+                status_cache.invalidate_config(i)
+        else:
+            status_cache.invalidate_config()
+
+    def on_service_config_changed(svc_id):
+        def handler(args):
+            status_cache.invalidate_config(svc_id)
+
+        return handler
+
     plugin.register_schema_definition('Service', {
         'type': 'object',
         'additionalProperties': False,
@@ -556,9 +702,16 @@ def _init(dispatcher, plugin):
         ]
     })
 
-    plugin.register_event_handler("serviced.job.started", on_job_changed)
-    plugin.register_event_handler("serviced.job.stopped", on_job_changed)
-    plugin.register_event_handler("serviced.job.error", on_job_changed)
+    plugin.register_event_handler("serviced.job.state_changed", on_job_changed)
+    plugin.register_event_handler("server.service_login", on_serviced_session)
+    plugin.register_event_handler("server.service_logout", on_serviced_session)
+    plugin.register_event_handler("service.changed", on_service_changed)
+    for svc in dispatcher.datastore.query('service_definitions'):
+        plugin.register_event_handler(
+            "service.{0}.changed".format(svc['name']),
+            on_service_config_changed(svc['id'])
+        )
+
     plugin.register_event_handler("server.ready", on_ready)
     plugin.register_task_handler("service.manage", ServiceManageTask)
     plugin.register_task_handler("service.update", UpdateServiceConfigTask)
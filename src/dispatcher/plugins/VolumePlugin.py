@@ -29,6 +29,8 @@ import errno
 import os
 import re
 import gevent
+import gevent.event
+import heapq
 import logging
 import tempfile
 import shutil
@@ -42,9 +44,9 @@ import uuid
 import itertools
 from datetime import datetime
 from event import sync
-from cache import EventCacheStore
+from cache import DerivedCacheView, get_store
 from lib.system import SubprocessException
-from lib.freebsd import fstyp
+from lib.freebsd import fstyp, mount_table
 from lib.zfs import compare_vdevs, iterate_vdevs, vdev_by_guid, split_snapshot_name, get_disks, get_disk_ids
 from lib.zfs import get_resources
 from task import (
@@ -98,6 +100,9 @@ DEFAULT_ACLS = [
 logger = logging.getLogger('VolumePlugin')
 snapshots = None
 datasets = None
+retention = None
+SNAPSHOT_DELETE_BATCH = 1000
+SNAPSHOT_RETRY_MAX_DELAY = 24 * 60 * 60
 
 
 @description("Provides access to volumes information")
@@ -115,8 +120,15 @@ class VolumeProvider(Provider):
 
             return True
 
+        pools = None
+
         def extend(vol):
-            config = self.dispatcher.call_sync('zfs.pool.query', [('id', '=', vol['id'])], {'single': True})
+            nonlocal pools
+            if pools is None:
+                # One zfs.pool.query for all volumes instead of one per volume
+                pools = {p['id']: p for p in self.dispatcher.call_sync('zfs.pool.query')}
+
+            config = pools.get(vol['id'])
             encrypted = vol.get('key_encrypted', False) or vol.get('password_encrypted', False)
 
             if not config:
@@ -125,18 +137,16 @@ class VolumeProvider(Provider):
                 @lazy
                 def collect_topology():
                     topology = config['groups']
-                    for vdev, _ in iterate_vdevs(topology):
-                        disk_info = self.dispatcher.call_sync(
-                            'disk.query',
-                            [('status.data_partition_path', '=', vdev['path'])],
-                            {'single': True, 'select': ('id', 'path')}
-                        )
+                    vdevs = [vdev for vdev, _ in iterate_vdevs(topology)]
+                    disks = self.dispatcher.call_sync('disk.resolve_paths', [vdev['path'] for vdev in vdevs])
+                    for vdev in vdevs:
+                        disk_info = disks.get(vdev['path'])
                         if not disk_info:
                             if encrypted:
                                 topology = vol['topology']
                                 break
                         else:
-                            vdev['disk_id'], vdev['path'] = disk_info
+                            vdev['disk_id'], vdev['path'] = disk_info['id'], disk_info['path']
 
                     return topology
 
@@ -489,7 +499,12 @@ class SnapshotProvider(Provider):
     @query('VolumeSnapshot')
     @generator
     def query(self, filter=None, params=None):
-        return snapshots.query(*(filter or []), stream=True, **(params or {}))
+        return snapshots.query(*(filter or []), stream=True, frozen=True, **(params or {}))
+
+    @accepts()
+    @returns(h.ref('VolumeSnapshotRetentionStatus'))
+    def get_retention_status(self):
+        return retention.status()
 
 
 @description("Creating a volume")
@@ -2640,6 +2655,36 @@ class SnapshotDeleteTask(Task):
         )
 
 
+@description("Deletes multiple snapshots")
+@accepts(h.array(str))
+class SnapshotDeleteMultipleTask(Task):
+    @classmethod
+    def early_describe(cls):
+        return "Deleting snapshots"
+
+    def describe(self, ids):
+        return TaskDescription("Deleting {count} snapshots", count=len(ids))
+
+    def verify(self, ids):
+        return list({f'zfs:{split_snapshot_name(i)[1]}' for i in ids})
+
+    def run(self, ids):
+        by_dataset = {}
+        for i in ids:
+            pool, ds, snap = split_snapshot_name(i)
+            by_dataset.setdefault(ds, []).append(snap)
+
+        failed = []
+        for ds, names in by_dataset.items():
+            try:
+                self.run_subtask_sync('zfs.delete_multiple_snapshots', ds, names, False)
+            except RpcException as err:
+                failed.append(err)
+
+        if failed:
+            raise TaskException(failed[0].code, '; '.join(err.message for err in failed))
+
+
 @description("Updates configuration of specified snapshot")
 @accepts(str, h.all_of(
     h.ref('VolumeSnapshot')
@@ -3043,6 +3088,145 @@ def register_property_schemas(plugin):
         })
 
 
+def snapshot_expiry(snapshot):
+    if snapshot.get('lifetime') is None:
+        return None
+
+    try:
+        return int(q.get(snapshot, 'properties.creation.rawvalue')) + snapshot['lifetime']
+    except (ValueError, TypeError):
+        return None
+
+
+class SnapshotRetention(object):
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.heap = []
+        self.expiry = {}
+        self.failures = {}
+        self.deleting = 0
+        self.wakeup = gevent.event.Event()
+
+    def add(self, snapshot):
+        expires_at = snapshot_expiry(snapshot)
+        if expires_at is None:
+            self.expiry.pop(snapshot['id'], None)
+            return
+
+        if self.expiry.get(snapshot['id']) == expires_at:
+            return
+
+        # Previous heap entries of the snapshot become stale and are skipped when popped
+        self.expiry[snapshot['id']] = expires_at
+        heapq.heappush(self.heap, (expires_at, snapshot['id']))
+        if self.heap[0][1] == snapshot['id']:
+            self.wakeup.set()
+
+    def remove(self, id):
+        self.expiry.pop(id, None)
+        self.failures.pop(id, None)
+
+    def retry(self, id, now, interval):
+        # Back off exponentially on snapshots which keep failing to delete
+        attempts = self.failures.get(id, 0) + 1
+        self.failures[id] = attempts
+        retry_at = now + min(interval * 2 ** (attempts - 1), SNAPSHOT_RETRY_MAX_DELAY)
+        self.expiry[id] = retry_at
+        heapq.heappush(self.heap, (retry_at, id))
+
+    def propagate(self, event):
+        if event['operation'] == 'delete':
+            for i in event['ids']:
+                self.remove(i)
+
+            return
+
+        if event['operation'] == 'rename':
+            for o, i in event['ids']:
+                self.remove(o)
+                snap = snapshots.get(i)
+                if snap:
+                    self.add(snap)
+
+            return
+
+        if event['operation'] in ('create', 'update'):
+            for i in event['entities']:
+                snap = snapshots.get(i['name'])
+                if snap:
+                    self.add(snap)
+
+    def next_expiry(self):
+        while self.heap and self.expiry.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+        return self.heap[0][0] if self.heap else None
+
+    def pop_expired(self, now):
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            expires_at, id = heapq.heappop(self.heap)
+            if self.expiry.get(id) != expires_at:
+                continue
+
+            del self.expiry[id]
+            expired.append(id)
+
+        return expired
+
+    def status(self):
+        now = int(time.time())
+        next_expiry = self.next_expiry()
+        return {
+            'next_expiry': datetime.utcfromtimestamp(next_expiry) if next_expiry is not None else None,
+            'backlog': self.deleting + sum(1 for i in self.expiry.values() if i <= now),
+            'tracked': len(self.expiry)
+        }
+
+    def delete(self, ids, now, interval):
+        by_dataset = {}
+        for i in ids:
+            by_dataset.setdefault(split_snapshot_name(i)[1], []).append(i)
+
+        for ds, ds_ids in by_dataset.items():
+            for batch in chunks(ds_ids, SNAPSHOT_DELETE_BATCH):
+                batch = list(batch)
+                self.deleting += len(batch)
+                try:
+                    self.dispatcher.call_task_sync('volume.snapshot.delete_multiple', batch)
+                except RpcException as err:
+                    logger.warning('Cannot delete expired snapshots of {0}: {1}'.format(ds, str(err)))
+                finally:
+                    self.deleting -= len(batch)
+
+                # Whatever is still there failed to delete, only those get retried
+                for i in batch:
+                    if snapshots.exists(i):
+                        logger.warning('Cannot delete expired snapshot {0}, will retry later'.format(i))
+                        self.retry(i, now, interval)
+                    else:
+                        self.failures.pop(i, None)
+
+    def run(self):
+        while True:
+            interval = self.dispatcher.configstore.get('middleware.snapshot_scrub_interval')
+            next_expiry = self.next_expiry()
+            timeout = interval
+            if next_expiry is not None:
+                timeout = min(interval, max(0, next_expiry - time.time()))
+
+            self.wakeup.clear()
+            self.wakeup.wait(timeout)
+
+            now = int(time.time())
+            expired = self.pop_expired(now)
+            if expired:
+                try:
+                    self.delete(expired, now, interval)
+                except BaseException as err:
+                    logger.warning('Cannot delete expired snapshots: {0}'.format(str(err)))
+
+
 def collect_debug(dispatcher):
     yield AttachData('volume-query', dumps(list(dispatcher.call_sync('volume.query')), indent=4))
     yield AttachData('volumes', dumps(list(dispatcher.datastore.query('volumes')), indent=4))
@@ -3084,11 +3268,26 @@ def _init(dispatcher, plugin):
             'metadata': convert_properties(snapshot['properties'])
         }
 
+    def fix_mountpoint(ds):
+        local_mountpoint = q.get(ds, 'properties.mountpoint.source') != 'INHERITED'
+
+        if ds['pool'] == boot_pool['id']:
+            return
+
+        if ds['mountpoint'] and '.system' not in ds['name'] and ds['name'] != ds['pool'] and local_mountpoint:
+            # Correct mountpoint of a non-root dataset
+            dispatcher.call_task_sync('zfs.update', ds['name'], {'mountpoint': {'source': 'INHERITED'}})
+
+        if ds['name'] == ds['pool']:
+            # Correct mountpoint of a root dataset
+            desired_mountpoint = os.path.join(VOLUMES_ROOT, ds['pool'])
+            if q.get(ds, 'properties.mountpoint.parsed') != desired_mountpoint:
+                dispatcher.call_task_sync('zfs.update', ds['name'], {'mountpoint': {'value': desired_mountpoint}})
+
     def convert_dataset(ds):
         perms = None
         last_replicated_at = None
         last_replicated_by = None
-        local_mountpoint = q.get(ds, 'properties.mountpoint.source') != 'INHERITED'
 
         if ds['pool'] == boot_pool['id']:
             return None
@@ -3101,21 +3300,11 @@ def _init(dispatcher, plugin):
 
         temp_mountpoint = None
         if q.get(ds, 'properties.readonly.parsed') and q.get(ds, 'properties.mounted.parsed'):
-            for mnt in bsd.getmntinfo():
-                if mnt.source == ds['name'] and mnt.dest != q.get(ds, 'properties.mountpoint.parsed'):
+            for mnt in mount_table.by_source(ds['name']):
+                if mnt.dest != q.get(ds, 'properties.mountpoint.parsed'):
                     temp_mountpoint = mnt.dest
                     break
 
-        if ds['mountpoint'] and '.system' not in ds['name'] and ds['name'] != ds['pool'] and local_mountpoint:
-            # Correct mountpoint of a non-root dataset
-            dispatcher.call_task_sync('zfs.update', ds['name'], {'mountpoint': {'source': 'INHERITED'}})
-
-        if ds['name'] == ds['pool']:
-            # Correct mountpoint of a root dataset
-            desired_mountpoint = os.path.join(VOLUMES_ROOT, ds['pool'])
-            if q.get(ds, 'properties.mountpoint.parsed') != desired_mountpoint:
-                dispatcher.call_task_sync('zfs.update', ds['name'], {'mountpoint': {'value': desired_mountpoint}})
-
         prop = q.get(ds, 'properties.org\\.freenas:last_replicated_at')
         if prop and prop['source'] == 'LOCAL':
             try:
@@ -3228,11 +3417,16 @@ def _init(dispatcher, plugin):
 
     @sync
     def on_snapshot_change(args):
-        snapshots.propagate(args, callback=convert_snapshot)
+        snapshots.propagate(args)
+        retention.propagate(args)
 
     @sync
     def on_dataset_change(args):
-        datasets.propagate(args, callback=convert_dataset)
+        if args['operation'] in ('create', 'update'):
+            for i in args['entities']:
+                fix_mountpoint(i)
+
+        datasets.propagate(args)
 
     @sync
     def on_vdev_state_change(args):
@@ -3281,21 +3475,6 @@ def _init(dispatcher, plugin):
                 if vol.get('auto_unlock') and vol.get('key_encrypted') and not vol.get('password_encrypted'):
                     dispatcher.call_task_sync('volume.unlock', vol['id'])
 
-    def scrub_snapshots():
-        interval = dispatcher.configstore.get('middleware.snapshot_scrub_interval')
-        while True:
-            gevent.sleep(interval)
-            ts = int(time.time())
-            for snap in dispatcher.call_sync('volume.snapshot.query'):
-                creation = int(q.get(snap, 'properties.creation.rawvalue'))
-                lifetime = snap['lifetime']
-
-                if lifetime is None:
-                    continue
-
-                if creation + lifetime <= ts:
-                    dispatcher.call_task_sync('volume.snapshot.delete', snap['id'])
-
     plugin.register_schema_definition('Volume', {
         'type': 'object',
         'title': 'volume',
@@ -3451,6 +3630,17 @@ def _init(dispatcher, plugin):
         }
     })
 
+    plugin.register_schema_definition('VolumeSnapshotRetentionStatus', {
+        'type': 'object',
+        'additionalProperties': False,
+        'readOnly': True,
+        'properties': {
+            'next_expiry': {'type': ['datetime', 'null']},
+            'backlog': {'type': 'integer'},
+            'tracked': {'type': 'integer'}
+        }
+    })
+
     plugin.register_schema_definition('VolumeDiskLabel', {
         'type': 'object',
         'additionalProperties': False,
@@ -3579,6 +3769,7 @@ def _init(dispatcher, plugin):
     plugin.register_task_handler('volume.dataset.temporary.umount', DatasetTemporaryUmountTask)
     plugin.register_task_handler('volume.snapshot.create', SnapshotCreateTask)
     plugin.register_task_handler('volume.snapshot.delete', SnapshotDeleteTask)
+    plugin.register_task_handler('volume.snapshot.delete_multiple', SnapshotDeleteMultipleTask)
     plugin.register_task_handler('volume.snapshot.update', SnapshotConfigureTask)
     plugin.register_task_handler('volume.snapshot.clone', SnapshotCloneTask)
     plugin.register_task_handler('volume.snapshot.rollback', SnapshotRollbackTask)
@@ -3626,25 +3817,37 @@ def _init(dispatcher, plugin):
             'attributes': {}
         })
 
+    # Both views are computed on demand from ZfsPlugin caches instead of keeping converted copies
     global snapshots
-    snapshots = EventCacheStore(dispatcher, 'volume.snapshot')
-    snapshots.populate(dispatcher.call_sync('zfs.snapshot.query'), callback=convert_snapshot)
+    snapshots = DerivedCacheView(dispatcher, 'volume.snapshot', get_store('zfs.snapshot'), convert_snapshot)
     snapshots.ready = True
+
+    global retention
+    retention = SnapshotRetention(dispatcher)
+    for snap in snapshots.validvalues():
+        retention.add(snap)
+
     plugin.register_event_handler(
         'entity-subscriber.zfs.snapshot.changed',
         on_snapshot_change
     )
 
+    # Converted datasets depend on what is mounted from them and at their mountpoints
     global datasets
-    datasets = EventCacheStore(dispatcher, 'volume.dataset')
-    datasets.populate(dispatcher.call_sync('zfs.dataset.query'), callback=convert_dataset)
+    datasets = DerivedCacheView(
+        dispatcher, 'volume.dataset', get_store('zfs.dataset'), convert_dataset,
+        generation=lambda ds: mount_table.key(ds['name'], ds['mountpoint'])
+    )
     datasets.ready = True
+    for ds in dispatcher.call_sync('zfs.dataset.query'):
+        fix_mountpoint(ds)
+
     plugin.register_event_handler(
         'entity-subscriber.zfs.dataset.changed',
         on_dataset_change
     )
 
-    gevent.spawn(scrub_snapshots)
+    gevent.spawn(retention.run)
     dispatcher.track_resources(
         'volume.query',
         'entity-subscriber.volume.changed',
@@ -26,7 +26,6 @@
 #####################################################################
 
 import os
-import bsd
 import errno
 import logging
 import time
@@ -43,6 +42,7 @@ from freenas.dispatcher.rpc import RpcException, accepts, returns, description,
 from freenas.dispatcher.rpc import SchemaHelper as h
 from freenas.dispatcher.jsonenc import dumps
 from debug import AttachData, AttachCommandOutput
+from lib.freebsd import mount_table
 from lib.zfs import iterate_vdevs, vdev_by_guid, vdev_by_path, get_disks
 from freenas.utils.trace_logger import TRACE
 from freenas.utils import first_or_default, query as q
@@ -227,6 +227,21 @@ class ZfsDatasetProvider(Provider):
 
             raise RpcException(zfs_error_to_errno(err.code), str(err))
 
+    @accepts(str)
+    @returns(h.array(h.ref('ZfsSnapshot')))
+    def get_snapshots_recursive(self, dataset_name):
+        try:
+            zfs = get_zfs()
+            ds = zfs.get_dataset(dataset_name)
+            snaps = self.dispatcher.threaded(lambda: [d.__getstate__() for d in ds.snapshots_recursive])
+            snaps.sort(key=lambda s: int(q.get(s, 'properties.creation.rawvalue')))
+            return snaps
+        except libzfs.ZFSException as err:
+            if err.code == libzfs.Error.NOENT:
+                raise RpcException(errno.ENOENT, str(err))
+
+            raise RpcException(zfs_error_to_errno(err.code), str(err))
+
     @returns(int)
     def estimate_send_size(self, dataset_name, snapshot_name, anchor_name=None):
         try:
@@ -274,7 +289,7 @@ class ZfsSnapshotProvider(Provider):
     @query('ZfsSnapshot')
     @generator
     def query(self, filter=None, params=None):
-        return snapshots.query(*(filter or []), stream=True, **(params or {}))
+        return snapshots.query(*(filter or []), stream=True, frozen=True, **(params or {}))
 
 
 class ScanStatusTaskMixin(object):
@@ -1036,8 +1051,13 @@ class ZfsSnapshotDeleteMultipleTask(ZfsBaseTask):
             if snapshot_names is None:
                 ds = zfs.get_dataset(path)
                 snapshot_names = (i.snapshot_name for i in list(ds.snapshots))
+        except libzfs.ZFSException as err:
+            raise TaskException(zfs_error_to_errno(err.code), str(err))
 
-            for i in snapshot_names:
+        # One snapshot which cannot be deleted (held, cloned) must not keep the rest around
+        failed = []
+        for i in snapshot_names:
+            try:
                 snap = zfs.get_snapshot('{0}@{1}'.format(path, i))
                 self.dispatcher.exec_and_wait_for_event(
                     'fs.zfs.dataset.deleted',
@@ -1045,8 +1065,17 @@ class ZfsSnapshotDeleteMultipleTask(ZfsBaseTask):
                     lambda: snap.delete(recursive),
                     600
                 )
-        except libzfs.ZFSException as err:
-            raise TaskException(zfs_error_to_errno(err.code), str(err))
+            except libzfs.ZFSException as err:
+                failed.append((i, err))
+
+        if failed:
+            raise TaskException(
+                zfs_error_to_errno(failed[0][1].code),
+                'Cannot delete snapshots of {0}: {1}'.format(
+                    path,
+                    ', '.join('{0} ({1})'.format(i, str(err)) for i, err in failed)
+                )
+            )
 
 
 @private
@@ -1553,6 +1582,7 @@ def _init(dispatcher, plugin):
 
     @sync
     def on_vfs_mount_or_unmount(type, args):
+        mount_table.invalidate()
         if args['fstype'] == 'zfs':
             with dispatcher.get_lock('zfs-cache'):
                 if 'source' in args:
@@ -1561,7 +1591,7 @@ def _init(dispatcher, plugin):
                     ds = datasets.query(('properties.mountpoint.value', '=', args['path']), single=True)
 
                 if not ds:
-                    for mnt in dispatcher.threaded(lambda: list(bsd.getmntinfo())):
+                    for mnt in dispatcher.threaded(mount_table.by_dest, args['path']):
                         if mnt.dest == args['path']:
                             ds = datasets.query(('id', '=', mnt.source), single=True)
                             if ds:
@@ -48,6 +48,7 @@ files = [
     "src/utils.py",
     "src/lib/freebsd.py",
     "src/lib/geom.py",
+    "src/lib/replication.py",
     "src/lib/system.py",
     "src/lib/zfs.py",
 ]
@@ -25,23 +25,151 @@
 #
 #####################################################################
 
+import copy
 from gevent.event import Event
 from gevent.lock import RLock
 from freenas.utils.query import query, set
 from sortedcontainers import SortedDict
 
 
+stores = {}
+
+
+def immutable(self, *args, **kwargs):
+    raise TypeError('{0} is immutable, use copy.deepcopy() to get a mutable copy'.format(type(self).__name__))
+
+
+class FrozenDict(dict):
+    """
+    Read-only view of a dict. Nested containers are wrapped on access, so creating
+    the view costs only a shallow copy of the top level. Copies are deep and
+    mutable, as nested containers are shared with the cache.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return freeze(dict.__getitem__(self, key))
+
+    def __iter__(self):
+        # Overriding __iter__ makes dict(view) and {**view} go through
+        # keys() and __getitem__, so nested containers come out frozen
+        return dict.__iter__(self)
+
+    def keys(self):
+        return dict.keys(self)
+
+    def get(self, key, default=None):
+        return freeze(dict.get(self, key, default))
+
+    def values(self):
+        return [freeze(v) for v in dict.values(self)]
+
+    def items(self):
+        return [(k, freeze(v)) for k, v in dict.items(self)]
+
+    def copy(self):
+        return self.__deepcopy__({})
+
+    def __copy__(self):
+        return self.__deepcopy__({})
+
+    def __deepcopy__(self, memo):
+        return {k: copy.deepcopy(v, memo) for k, v in dict.items(self)}
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = immutable
+    __ior__ = immutable
+
+
+class FrozenList(list):
+    """
+    Read-only view of a list, see FrozenDict
+    """
+    __slots__ = ()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return FrozenList(list.__getitem__(self, index))
+
+        return freeze(list.__getitem__(self, index))
+
+    def __iter__(self):
+        for i in list.__iter__(self):
+            yield freeze(i)
+
+    def copy(self):
+        return self.__deepcopy__({})
+
+    def __copy__(self):
+        return self.__deepcopy__({})
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(i, memo) for i in list.__iter__(self)]
+
+    def __reduce__(self):
+        return list, (list(list.__iter__(self)),)
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = immutable
+    append = extend = insert = pop = remove = reverse = sort = clear = immutable
+
+
+FROZEN_TYPES = (FrozenDict, FrozenList)
+
+
+def freeze(obj):
+    if isinstance(obj, FROZEN_TYPES):
+        return obj
+
+    if isinstance(obj, dict):
+        return FrozenDict(obj)
+
+    if isinstance(obj, list):
+        return FrozenList(obj)
+
+    return obj
+
+
+def copy_result(obj):
+    """
+    Returns obj as-is if it is a frozen view, deep copy of obj otherwise
+    """
+    if isinstance(obj, FROZEN_TYPES):
+        return obj
+
+    return copy.deepcopy(obj)
+
+
+def get_store(name):
+    return stores.get(name)
+
+
 class CacheStore(object):
     class CacheItem(object):
-        __slots__ = ('valid', 'data')
+        __slots__ = ('valid', 'data', 'view', 'derived', 'generation')
 
         def __init__(self):
             self.valid = Event()
             self.data = None
+            self.view = None
+            self.derived = None
+            self.generation = 0
+
+        def frozen(self):
+            if self.view is None:
+                self.view = freeze(self.data)
+
+            return self.view
 
     def __init__(self, key=None):
         self.lock = RLock()
         self.store = SortedDict(key)
+        self.generation = 0
+
+    def next_generation(self):
+        self.generation += 1
+        return self.generation
 
     def __getitem__(self, item):
         return self.get(item)
@@ -51,11 +179,15 @@ class CacheStore(object):
             try:
                 item = self.store[key]
                 item.data = data
+                item.view = None
+                item.derived = None
+                item.generation = self.next_generation()
                 item.valid.set()
                 return False
             except KeyError:
                 item = self.CacheItem()
                 item.data = data
+                item.generation = self.next_generation()
                 item.valid.set()
                 self.store[key] = item
                 return True
@@ -68,6 +200,7 @@ class CacheStore(object):
             for k, v in kwargs.items():
                 items[k] = self.CacheItem()
                 items[k].data = v
+                items[k].generation = self.next_generation()
                 items[k].valid.set()
                 if k in self.store:
                     updated.append(k)
@@ -161,10 +294,10 @@ class CacheStore(object):
             if value.valid.is_set():
                 yield (key, value.data)
 
-    def validvalues(self):
+    def validvalues(self, frozen=False):
         for value in list(self.store.values()):
             if value.valid.is_set():
-                yield value.data
+                yield value.frozen() if frozen else value.data
 
     def remove_predicate(self, predicate):
         result = []
@@ -176,7 +309,9 @@ class CacheStore(object):
         return result
 
     def query(self, *filter, **params):
-        return query(list(self.validvalues()), *filter, **params)
+        # frozen=True returns read-only views, which in-process callers get without copying
+        frozen = params.pop('frozen', False)
+        return query(list(self.validvalues(frozen)), *filter, **params)
 
 
 class EventCacheStore(CacheStore):
@@ -185,6 +320,7 @@ class EventCacheStore(CacheStore):
         self.dispatcher = dispatcher
         self.ready = False
         self.name = name
+        stores[name] = self
 
     def put(self, key, data):
         ret = super(EventCacheStore, self).put(key, data)
@@ -302,3 +438,99 @@ class EventCacheStore(CacheStore):
                 obj = callback(i) if callback else i
                 if obj is not None:
                     self.put(obj['id'], obj)
+
+
+class DerivedCacheView(object):
+    """
+    Read-only view of another cache store, with records converted on first
+    access. Converted records are kept on the source items themselves, so they
+    go away together with them and get converted again once the source item
+    changes, or the value `generation` returns for the source record, if given.
+    """
+    def __init__(self, dispatcher, name, source, convert, generation=None):
+        self.dispatcher = dispatcher
+        self.name = name
+        self.source = source
+        self.convert = convert
+        self.generation = generation
+        self.ready = False
+
+    def __getitem__(self, item):
+        return self.get(item)
+
+    def derive(self, item):
+        # Source items drop their derived records whenever their data changes
+        token = self.generation(item.data) if self.generation else None
+        derived = item.derived
+        if derived is None:
+            derived = item.derived = {}
+        else:
+            entry = derived.get(self.name)
+            if entry is not None and entry[0] == token:
+                return entry[1]
+
+        value = self.convert(item.data)
+        derived[self.name] = (token, value)
+        return value
+
+    def get(self, key, default=None, timeout=None):
+        item = self.source.store.get(key)
+        if not item or not item.valid.wait(timeout):
+            return default
+
+        value = self.derive(item)
+        return default if value is None else value
+
+    def exists(self, key):
+        return self.get(key, timeout=0) is not None
+
+    def itervalid(self):
+        for key, item in list(self.source.store.items()):
+            if item.valid.is_set():
+                value = self.derive(item)
+                if value is not None:
+                    yield (key, value)
+
+    def validvalues(self, frozen=False):
+        for item in list(self.source.store.values()):
+            if item.valid.is_set():
+                value = self.derive(item)
+                if value is not None:
+                    yield freeze(value) if frozen else value
+
+    def query(self, *filter, **params):
+        frozen = params.pop('frozen', False)
+        keys = self.lookup_keys(filter)
+        if keys is None:
+            values = self.validvalues(frozen)
+        else:
+            values = (freeze(v) if frozen else v for v in (self.get(k, timeout=0) for k in keys) if v is not None)
+
+        return query(list(values), *filter, **params)
+
+    def lookup_keys(self, filter):
+        # Filtering on id needs only the matching records to be converted
+        for f in filter:
+            if len(f) == 3 and f[0] == 'id':
+                if f[1] == '=':
+                    return [f[2]]
+
+                if f[1] == 'in':
+                    return list(f[2])
+
+        return None
+
+    def propagate(self, event):
+        operation = event['operation']
+        if operation in ('delete', 'rename'):
+            ids = event['ids']
+        elif operation in ('create', 'update'):
+            ids = [i['id'] for i in event['entities'] if self.exists(i['id'])]
+        else:
+            return
+
+        if self.ready and ids:
+            self.dispatcher.emit_event('{0}.changed'.format(self.name), {
+                'operation': operation,
+                'ids': ids
+            })
@@ -25,10 +25,55 @@
 #
 #####################################################################
 
-from bsd import sysctl
+from bsd import sysctl, getmntinfo
 from lib.system import system, SubprocessException
 
 
+class MountTable(object):
+    """
+    getmntinfo() snapshot shared by plugins. Re-read on first use after
+    invalidate(), which mount/unmount event handlers call.
+    """
+    def __init__(self):
+        self.generation = 0
+        self.entries = None
+        self.sources = {}
+        self.dests = {}
+
+    def invalidate(self):
+        self.entries = None
+        self.generation += 1
+
+    def get(self):
+        if self.entries is None:
+            self.entries = list(getmntinfo())
+            self.sources = {}
+            self.dests = {}
+            for i in self.entries:
+                self.sources.setdefault(i.source, []).append(i)
+                self.dests.setdefault(i.dest, []).append(i)
+
+        return self.entries
+
+    def by_source(self, source):
+        self.get()
+        return list(self.sources.get(source, []))
+
+    def by_dest(self, dest):
+        self.get()
+        return list(self.dests.get(dest, []))
+
+    def key(self, source, dest):
+        """
+        Changes only when something gets mounted from `source` or at `dest`,
+        unlike `generation` which changes with every mount.
+        """
+        return tuple((i.source, i.dest) for i in self.by_source(source) + self.by_dest(dest))
+
+
+mount_table = MountTable()
+
+
 def get_sysctl(name):
     return sysctl.sysctlbyname(name)
 
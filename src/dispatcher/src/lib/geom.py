@@ -25,9 +25,208 @@
 #
 #####################################################################
 
+import time
+from threading import RLock
+from xml.etree import ElementTree
 from .freebsd import get_sysctl
 from lxml import etree
 
 
 def confxml():
     return etree.fromstring(get_sysctl("kern.geom.confxml"))
+
+
+class GeomClass(object):
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self._geoms = []
+
+    @property
+    def geoms(self):
+        return iter(self._geoms)
+
+
+class GeomObject(object):
+    def __init__(self, id, name, rank, config):
+        self.id = id
+        self.name = name
+        self.rank = rank
+        self.config = config
+        self.clazz = None
+        self._providers = []
+        self._consumers = []
+
+    @property
+    def providers(self):
+        return iter(self._providers)
+
+    @property
+    def consumers(self):
+        return iter(self._consumers)
+
+    @property
+    def provider(self):
+        return self._providers[0] if self._providers else None
+
+
+class GeomProvider(object):
+    def __init__(self, id, name, mode, mediasize, sectorsize, stripesize, stripeoffset, config):
+        self.id = id
+        self.name = name
+        self.mode = mode
+        self.mediasize = mediasize
+        self.sectorsize = sectorsize
+        self.stripesize = stripesize
+        self.stripeoffset = stripeoffset
+        self.config = config
+        self.geom = None
+        self._consumers = []
+
+    @property
+    def consumers(self):
+        return iter(self._consumers)
+
+
+class GeomConsumer(object):
+    def __init__(self, id, mode, config):
+        self.id = id
+        self.mode = mode
+        self.config = config
+        self.geom = None
+        self.provider = None
+
+
+class GeomTopology(object):
+    """
+    Parsed kern.geom.confxml. Offers the subset of bsd.geom API the plugins
+    use, but as an immutable object which can be shared between callers.
+    """
+    def __init__(self, xml):
+        self.xml = xml
+        self.classes = {}
+        self.geoms = {}
+        self.providers = {}
+        self.parse(ElementTree.fromstring(xml))
+
+    @staticmethod
+    def config(node):
+        config = node.find('config')
+        if config is None:
+            return {}
+
+        return {i.tag: i.text for i in config}
+
+    @staticmethod
+    def number(node, tag):
+        value = node.findtext(tag)
+        return int(value) if value is not None else None
+
+    def parse(self, root):
+        provider_refs = []
+        for cnode in root.findall('class'):
+            cls = GeomClass(cnode.get('id'), cnode.findtext('name'))
+            self.classes[cls.name] = cls
+
+            for gnode in cnode.findall('geom'):
+                geom = GeomObject(
+                    gnode.get('id'),
+                    gnode.findtext('name'),
+                    self.number(gnode, 'rank'),
+                    self.config(gnode)
+                )
+
+                geom.clazz = cls
+                cls._geoms.append(geom)
+                self.geoms[(cls.name, geom.name)] = geom
+
+                for pnode in gnode.findall('provider'):
+                    provider = GeomProvider(
+                        pnode.get('id'),
+                        pnode.findtext('name'),
+                        pnode.findtext('mode'),
+                        self.number(pnode, 'mediasize'),
+                        self.number(pnode, 'sectorsize'),
+                        self.number(pnode, 'stripesize'),
+                        self.number(pnode, 'stripeoffset'),
+                        self.config(pnode)
+                    )
+
+                    provider.geom = geom
+                    geom._providers.append(provider)
+                    self.providers[provider.id] = provider
+
+                for cnnode in gnode.findall('consumer'):
+                    consumer = GeomConsumer(cnnode.get('id'), cnnode.findtext('mode'), self.config(cnnode))
+                    consumer.geom = geom
+                    geom._consumers.append(consumer)
+                    ref = cnnode.find('provider')
+                    if ref is not None:
+                        provider_refs.append((consumer, ref.get('ref')))
+
+        # Consumers may refer to providers of classes defined later in the document
+        for consumer, ref in provider_refs:
+            provider = self.providers.get(ref)
+            if provider:
+                consumer.provider = provider
+                provider._consumers.append(consumer)
+
+    def class_by_name(self, name):
+        return self.classes.get(name)
+
+    def geom_by_name(self, cls, name):
+        return self.geoms.get((cls, name))
+
+
+class GeomSnapshot(object):
+    """
+    Shared GEOM topology, rebuilt on first use after invalidate(). devd
+    GEOM/DEVFS events invalidate it; a read which follows a burst of events
+    waits until the burst settles (at most max_delay seconds after the first
+    event) so that the whole burst costs a single confxml parse.
+    """
+    def __init__(self, source=None, debounce=0.2, max_delay=2.0):
+        self.source = source or (lambda: get_sysctl('kern.geom.confxml'))
+        self.executor = lambda fn: fn()
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.lock = RLock()
+        self.topology = None
+        self.generation = 0
+        self.dirty_since = None
+        self.last_event = None
+
+    def invalidate(self):
+        now = time.monotonic()
+        self.last_event = now
+        if self.dirty_since is None:
+            self.dirty_since = now
+
+    def get(self, fresh=False):
+        with self.lock:
+            if fresh or self.topology is None:
+                self.rebuild()
+            elif self.dirty_since is not None:
+                self.settle()
+                self.rebuild()
+
+            return self.topology
+
+    def settle(self):
+        while True:
+            deadline = min(self.last_event + self.debounce, self.dirty_since + self.max_delay)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+
+            time.sleep(remaining)
+
+    def rebuild(self):
+        # Events arriving while confxml is being read mark the new topology dirty again
+        self.dirty_since = None
+        self.last_event = None
+        self.topology = self.executor(lambda: GeomTopology(self.source()))
+        self.generation += 1
+
+
+geom_snapshot = GeomSnapshot()
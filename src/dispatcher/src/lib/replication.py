@@ -0,0 +1,82 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+from collections import OrderedDict
+
+
+def snapshot_key(snap):
+    return snap['snapshot_name'], snap['created_at']
+
+
+def group_remote_snapshots(snapshots_list):
+    """
+    Splits the flat list of remote datasets and snapshots into a dataset name
+    to dataset entry map and a dataset name to ordered snapshot list map.
+    """
+    datasets = OrderedDict()
+    snapshots = {}
+
+    for i in snapshots_list:
+        ds, sep, _ = i['name'].partition('@')
+        if sep:
+            snapshots.setdefault(ds, []).append(i)
+        else:
+            datasets[ds] = i
+
+    return datasets, snapshots
+
+
+def group_local_snapshots(snapshots_list):
+    snapshots = {}
+    for i in snapshots_list:
+        snapshots.setdefault(i['name'].partition('@')[0], []).append(i)
+
+    return snapshots
+
+
+def find_common_snapshot(local_snapshots, remote_snapshots):
+    """
+    Returns the index of the newest local snapshot which has a remote counterpart
+    with the same name and creation time, or None if there is none.
+    """
+    remote_index = set(map(snapshot_key, remote_snapshots))
+    found = None
+
+    for idx, snap in enumerate(local_snapshots):
+        if snapshot_key(snap) not in remote_index:
+            continue
+
+        if found is None or snap['created_at'] > local_snapshots[found]['created_at']:
+            found = idx
+
+    return found
+
+
+def find_deleted_snapshots(local_snapshots, remote_snapshots):
+    local_names = set(s['snapshot_name'] for s in local_snapshots)
+    return [s['snapshot_name'] for s in remote_snapshots if s['snapshot_name'] not in local_names]
@@ -28,7 +28,6 @@
 import gevent.monkey
 gevent.monkey.patch_all()
 
-import copy
 import os
 import sys
 import re
@@ -75,6 +74,7 @@ from services import ManagementService, DebugService, EventService, TaskService
 from services import LockService, PluginService, ShellService
 from schemas import register_general_purpose_schemas
 from balancer import Balancer
+from cache import copy_result
 from auth import PasswordAuthenticator, TokenStore, Token, User, Service
 from freenas.utils import FaultTolerantLogHandler, load_module_from_file, serialize_exception
 from freenas.utils.trace_logger import TraceLogger, TRACE
@@ -876,13 +876,13 @@ class DispatcherRpcContext(RpcContext):
         def unpack_chunk(it):
             for chunk in it:
                 for item in chunk:
-                    yield copy.deepcopy(item)
+                    yield copy_result(item)
 
         result = self.dispatch_call(name, list(args), streaming=True, validation=False)
         if hasattr(result, '__next__'):
             return unpack_chunk(result)
 
-        return copy.deepcopy(result)
+        return copy_result(result)
 
 
 class DispatcherConnection(ServerConnection):
@@ -67,6 +67,9 @@ class ManagementService(RpcService):
     def get_event_sources(self):
         return list(self.dispatcher.event_sources.keys())
 
+    def get_event_types(self):
+        return list(self.dispatcher.event_types.keys())
+
     def get_plugin_names(self):
         return list(self.dispatcher.plugins.keys())
 
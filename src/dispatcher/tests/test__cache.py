@@ -0,0 +1,86 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+import copy
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from cache import CacheStore, FrozenDict, FrozenList
+
+
+class TestFrozenViews(unittest.TestCase):
+    def setUp(self):
+        self.store = CacheStore()
+        self.store.put('tank', {
+            'id': 'tank',
+            'properties': {'compression': {'value': 'lz4'}},
+            'children': [{'id': 'tank/a'}]
+        })
+        self.entity = self.store.query(frozen=True)[0]
+
+    def assertUnchanged(self):
+        data = self.store.get('tank')
+        self.assertEqual(data['properties'], {'compression': {'value': 'lz4'}})
+        self.assertEqual(data['children'], [{'id': 'tank/a'}])
+
+    def test_immutable(self):
+        self.assertIsInstance(self.entity, FrozenDict)
+        self.assertIsInstance(self.entity['children'], FrozenList)
+        with self.assertRaises(TypeError):
+            self.entity['properties']['compression']['value'] = 'off'
+
+        with self.assertRaises(TypeError):
+            self.entity['children'].append({'id': 'tank/b'})
+
+    def test_copy(self):
+        for i in (self.entity.copy(), copy.copy(self.entity)):
+            i['properties']['compression']['value'] = 'off'
+            i['children'].append({'id': 'tank/b'})
+            i['children'][0]['id'] = 'tank/c'
+
+        children = self.entity['children']
+        for i in (children.copy(), copy.copy(children), copy.deepcopy(children)):
+            i[0]['id'] = 'tank/d'
+
+        self.assertUnchanged()
+
+    def test_dict_constructor(self):
+        for i in (dict(self.entity), {**self.entity}):
+            with self.assertRaises(TypeError):
+                i['properties']['compression']['value'] = 'off'
+
+            i['id'] = 'other'
+
+        self.assertEqual(self.store.get('tank')['id'], 'tank')
+        self.assertUnchanged()
+
+
+if __name__ == '__main__':
+    unittest.main()
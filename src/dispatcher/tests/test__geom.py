@@ -0,0 +1,162 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+import os
+import sys
+import time
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+try:
+    import bsd
+except ImportError:
+    # py-bsd is FreeBSD only; topology is read from a recorded confxml instead
+    bsd = types.ModuleType('bsd')
+    bsd.sysctl = mock.Mock()
+    bsd.getmntinfo = mock.Mock()
+    sys.modules['bsd'] = bsd
+
+from lib.geom import GeomSnapshot, GeomTopology
+
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'confxml.xml')
+
+
+def recorded_confxml():
+    with open(FIXTURE) as f:
+        return f.read()
+
+
+class TestGeomTopology(unittest.TestCase):
+    def setUp(self):
+        self.topology = GeomTopology(recorded_confxml())
+
+    def test_disks(self):
+        disks = {g.name: g for g in self.topology.class_by_name('DISK').geoms}
+        self.assertEqual(set(disks), {'ada0', 'ada1', 'da0', 'da1'})
+        self.assertEqual(disks['ada0'].provider.mediasize, 2000398934016)
+        self.assertEqual(disks['ada0'].provider.config['descr'], 'WDC WD20EFRX-68EUZN0')
+        self.assertEqual(disks['ada0'].provider.config['lunid'], '50014ee20b6a1f01')
+        self.assertIs(self.topology.geom_by_name('DISK', 'ada1'), disks['ada1'])
+        self.assertIsNone(self.topology.geom_by_name('DISK', 'ada7'))
+        self.assertIsNone(self.topology.class_by_name('RAID'))
+
+    def test_partitions(self):
+        gpart = self.topology.geom_by_name('PART', 'ada0')
+        parts = list(gpart.providers)
+        self.assertEqual([p.name for p in parts], ['ada0p1', 'ada0p2'])
+        self.assertEqual(parts[1].config['rawuuid'], '5e2a7c10-9c3d-11e6-a4f1-000c29d2e3b1')
+        self.assertEqual(parts[1].config['label'], 'data0')
+        self.assertIs(parts[1].geom, gpart)
+        self.assertEqual(next(gpart.consumers).provider.name, 'ada0')
+
+    def test_forward_references(self):
+        # MIRROR and ELI geoms come before PART and LABEL in confxml
+        mirror = self.topology.geom_by_name('MIRROR', 'swap0')
+        members = [c.provider.geom.name for c in mirror.consumers]
+        self.assertEqual(members, ['ada0', 'ada1'])
+
+        eli = self.topology.geom_by_name('ELI', 'gptid/5e3b2c1a-9c3d-11e6-a4f1-000c29d2e3b1.eli')
+        self.assertEqual(eli.config['UsedKey'], '0')
+        label = next(eli.consumers).provider
+        self.assertEqual(next(label.geom.consumers).provider.name, 'ada1p2')
+
+    def test_multipath(self):
+        gmultipath = self.topology.geom_by_name('MULTIPATH', 'disk1')
+        self.assertEqual(gmultipath.config['Mode'], 'Active/Passive')
+        self.assertEqual(
+            {c.provider.name: c.config['State'] for c in gmultipath.consumers},
+            {'da0': 'ACTIVE', 'da1': 'PASSIVE'}
+        )
+
+        cons = next(gmultipath.consumers)
+        self.assertEqual(cons.provider.geom.name, 'da0')
+        self.assertEqual(
+            [c.geom.clazz.name for c in cons.provider.consumers],
+            ['MULTIPATH']
+        )
+
+
+class TestGeomSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.reads = 0
+        self.snapshot = GeomSnapshot(self.source, debounce=0.05, max_delay=0.5)
+
+    def source(self):
+        self.reads += 1
+        return recorded_confxml()
+
+    def test_cached(self):
+        first = self.snapshot.get()
+        self.assertIs(self.snapshot.get(), first)
+        self.assertEqual(self.reads, 1)
+        self.assertEqual(self.snapshot.generation, 1)
+
+    def test_burst(self):
+        first = self.snapshot.get()
+        for i in range(100):
+            self.snapshot.invalidate()
+
+        second = self.snapshot.get()
+        self.assertIsNot(second, first)
+        self.assertIs(self.snapshot.get(), second)
+        self.assertEqual(self.reads, 2)
+        self.assertEqual(self.snapshot.generation, 2)
+
+    def test_debounce(self):
+        self.snapshot.get()
+        self.snapshot.invalidate()
+        start = time.monotonic()
+        self.snapshot.get()
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+
+    def test_max_delay(self):
+        self.snapshot.get()
+        self.snapshot.invalidate()
+        self.snapshot.dirty_since -= 1
+        start = time.monotonic()
+        self.snapshot.get()
+        self.assertLess(time.monotonic() - start, 0.04)
+        self.assertEqual(self.reads, 2)
+
+    def test_fresh(self):
+        first = self.snapshot.get()
+        self.assertIsNot(self.snapshot.get(fresh=True), first)
+        self.assertEqual(self.reads, 2)
+
+    def test_executor(self):
+        calls = []
+        self.snapshot.executor = lambda fn: calls.append(fn) or fn()
+        self.snapshot.get()
+        self.assertEqual(len(calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
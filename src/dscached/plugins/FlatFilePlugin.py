@@ -26,6 +26,8 @@
 #####################################################################
 
 import os
+import copy
+import time
 import shutil
 import logging
 import datetime
@@ -38,96 +40,274 @@ from freenas.utils import first_or_default, crypted_password, nt_password
 from freenas.utils.query import query
 
 
+POLL_INTERVAL = 1
 logger = logging.getLogger(__name__)
 
 
+class FileWatcher(object):
+    """
+    Calls `callback(path)` from a background thread whenever one of `paths`
+    is modified or replaced.
+    """
+    def __init__(self, paths, callback):
+        self.paths = paths
+        self.callback = callback
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        raise NotImplementedError()
+
+
+class KqueueFileWatcher(FileWatcher):
+    FFLAGS = (
+        getattr(select, 'KQ_NOTE_WRITE', 0) | getattr(select, 'KQ_NOTE_EXTEND', 0) |
+        getattr(select, 'KQ_NOTE_RENAME', 0) | getattr(select, 'KQ_NOTE_DELETE', 0)
+    )
+
+    def __init__(self, paths, callback):
+        super(KqueueFileWatcher, self).__init__(paths, callback)
+        self.kq = select.kqueue()
+        self.fds = {}
+
+    def open(self, path):
+        # File being replaced with rename(2) may be briefly missing
+        while True:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                break
+            except FileNotFoundError:
+                time.sleep(POLL_INTERVAL)
+
+        self.fds[fd] = path
+        self.kq.control([select.kevent(
+            fd,
+            filter=select.KQ_FILTER_VNODE,
+            flags=select.KQ_EV_ADD | select.KQ_EV_ENABLE | select.KQ_EV_CLEAR,
+            fflags=self.FFLAGS
+        )], 0)
+
+    def run(self):
+        for path in self.paths:
+            self.open(path)
+
+        while True:
+            event, = self.kq.control(None, 1)
+            path = self.fds[event.ident]
+            if event.fflags & (select.KQ_NOTE_RENAME | select.KQ_NOTE_DELETE):
+                # Descriptor points to the old file now, start watching the new one
+                del self.fds[event.ident]
+                os.close(event.ident)
+                self.open(path)
+
+            self.callback(path)
+
+
+class PollingFileWatcher(FileWatcher):
+    def __init__(self, paths, callback, interval=POLL_INTERVAL):
+        super(PollingFileWatcher, self).__init__(paths, callback)
+        self.interval = interval
+        self.stats = {p: self.stat(p) for p in paths}
+
+    @staticmethod
+    def stat(path):
+        try:
+            st = os.stat(path)
+            return st.st_ino, st.st_size, st.st_mtime_ns
+        except OSError:
+            return None
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            for path in self.paths:
+                st = self.stat(path)
+                if st != self.stats[path]:
+                    self.stats[path] = st
+                    self.callback(path)
+
+
+def create_file_watcher(paths, callback):
+    if hasattr(select, 'kqueue'):
+        return KqueueFileWatcher(paths, callback)
+
+    return PollingFileWatcher(paths, callback)
+
+
+class FlatFileIndex(object):
+    """
+    Entries of a flat file keyed by their IDs, with hash indexes on unique
+    `fields` and reverse indexes on list valued `multi_fields`.
+    """
+    def __init__(self, fields, multi_fields=None):
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.indexes = {f: {} for f in fields}
+        self.multi_indexes = {f: {} for f in multi_fields or []}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def index(self, entry):
+        for field, index in self.indexes.items():
+            value = entry.get(field)
+            if value is not None:
+                index[value] = entry['id']
+
+        for field, index in self.multi_indexes.items():
+            for value in entry.get(field) or []:
+                index.setdefault(value, {})[entry['id']] = None
+
+    def unindex(self, entry):
+        for field, index in self.indexes.items():
+            value = entry.get(field)
+            if value is not None and index.get(value) == entry['id']:
+                del index[value]
+
+        for field, index in self.multi_indexes.items():
+            for value in entry.get(field) or []:
+                ids = index.get(value)
+                if ids is not None:
+                    ids.pop(entry['id'], None)
+                    if not ids:
+                        del index[value]
+
+    def update(self, entries):
+        """
+        Replaces the contents with `entries`, re-indexing only entries which
+        were added, removed or changed. Returns a tuple of their counts.
+        """
+        new = {e['id']: e for e in entries}
+        with self.lock:
+            removed = [e for id, e in self.entries.items() if id not in new]
+            added = [e for id, e in new.items() if id not in self.entries]
+            changed = [
+                (self.entries[id], e) for id, e in new.items()
+                if id in self.entries and self.entries[id] != e
+            ]
+
+            # Unindex everything first, so that entries swapping names don't clobber each other
+            for e in removed:
+                self.unindex(e)
+
+            for old, e in changed:
+                self.unindex(old)
+
+            for e in added:
+                self.index(e)
+
+            for old, e in changed:
+                self.index(e)
+
+            self.entries = new
+
+        return len(added), len(removed), len(changed)
+
+    def get(self, field, value):
+        with self.lock:
+            id = value if field == 'id' else self.indexes[field].get(value)
+            entry = self.entries.get(id)
+            return copy.copy(entry) if entry else None
+
+    def get_ids(self, field, value):
+        with self.lock:
+            return list(self.multi_indexes[field].get(value, []))
+
+    def values(self):
+        with self.lock:
+            return [copy.copy(e) for e in self.entries.values()]
+
+    def candidates(self, filter):
+        # Equality on an indexed field narrows the query down to a single entry
+        for i in filter:
+            if len(i) == 3 and i[1] == '=' and (i[0] == 'id' or i[0] in self.indexes):
+                entry = self.get(i[0], i[2])
+                return [entry] if entry else []
+
+        return self.values()
+
+
 class FlatFilePlugin(DirectoryServicePlugin):
+    watcher_factory = staticmethod(create_file_watcher)
+
     def __init__(self, context):
         self.context = context
-        self.passwd = []
-        self.group = []
+        self.passwd = FlatFileIndex(['username', 'uid', 'sid'], ['groups'])
+        self.group = FlatFileIndex(['name', 'gid', 'sid'])
         self.passwd_filename = None
         self.group_filename = None
-        self.watch_thread = None
+        self.watcher = None
 
-    def __load(self):
+    def __load_file(self, filename, index):
         try:
-            with open(self.passwd_filename, 'r') as f:
-                self.passwd = load(f)
+            with open(filename, 'r') as f:
+                added, removed, changed = index.update(load(f))
         except (IOError, ValueError) as err:
-            logger.warn('Cannot read {0}: {1}'.format(self.passwd_filename, str(err)))
+            logger.warn('Cannot read {0}: {1}'.format(filename, str(err)))
+            return
 
-        try:
-            with open(self.group_filename, 'r') as f:
-                self.group = load(f)
-        except (IOError, ValueError) as err:
-            logger.warn('Cannot read {0}: {1}'.format(self.group_filename, str(err)))
-
-    def __watch(self):
-        kq = select.kqueue()
-        passwd_fd = os.open(self.passwd_filename, os.O_RDONLY)
-        group_fd = os.open(self.group_filename, os.O_RDONLY)
-
-        ev = [
-            select.kevent(
-                passwd_fd,
-                filter=select.KQ_FILTER_VNODE, flags=select.KQ_EV_ADD | select.KQ_EV_ENABLE,
-                fflags=select.KQ_NOTE_WRITE | select.KQ_NOTE_EXTEND | select.KQ_NOTE_RENAME
-            ),
-            select.kevent(
-                group_fd,
-                filter=select.KQ_FILTER_VNODE, flags=select.KQ_EV_ADD | select.KQ_EV_ENABLE,
-                fflags=select.KQ_NOTE_WRITE | select.KQ_NOTE_EXTEND | select.KQ_NOTE_RENAME
-            )
-        ]
-
-        kq.control(ev, 0)
+        logger.debug('Loaded {0}: {1} added, {2} removed, {3} changed'.format(filename, added, removed, changed))
 
-        while True:
-            event, = kq.control(None, 1)
-            name = self.passwd_filename if event.ident == passwd_fd else self.group_filename
-            logger.warning('{0} was modified, reloading'.format(name))
-            self.__load()
+    def __load(self):
+        self.__load_file(self.passwd_filename, self.passwd)
+        self.__load_file(self.group_filename, self.group)
+
+    def __on_change(self, name):
+        logger.warning('{0} was modified, reloading'.format(name))
+        if name == self.passwd_filename:
+            self.__load_file(self.passwd_filename, self.passwd)
+        else:
+            self.__load_file(self.group_filename, self.group)
+
+    def __group(self, group):
+        if group:
+            # Membership is stored on user side, merge it with whatever group lists explicitly
+            members = group.get('members') or []
+            group['members'] = members + [i for i in self.passwd.get_ids('groups', group['id']) if i not in members]
+
+        return group
 
     def getpwent(self, filter=None, params=None):
         filter = filter or []
         filter.append(('uid', '!=', 0))
-        return query(self.passwd, *filter, **(params or {}))
+        return query(self.passwd.candidates(filter), *filter, **(params or {}))
 
     def getpwnam(self, name):
         if name == 'root':
             return None
 
-        return query(self.passwd, ('username', '=', name), single=True)
+        return self.passwd.get('username', name)
 
     def getpwuid(self, uid):
         if uid == 0:
             return None
 
-        return query(self.passwd, ('uid', '=', uid), single=True)
+        return self.passwd.get('uid', uid)
 
     def getpwuuid(self, uuid):
-        return query(self.passwd, ('id', '=', uuid), single=True)
+        return self.passwd.get('id', uuid)
 
     def getgrent(self, filter=None, params=None):
         filter = filter or []
         filter.append(('gid', '!=', 0))
-        return query(self.group, *filter, **(params or {}))
+        return query([self.__group(g) for g in self.group.candidates(filter)], *filter, **(params or {}))
 
     def getgrnam(self, name):
         if name == 'wheel':
             return None
 
-        return query(self.group, ('name', '=', name), single=True)
+        return self.__group(self.group.get('name', name))
 
     def getgrgid(self, gid):
         if gid == 0:
             return None
 
-        return query(self.group, ('gid', '=', gid), single=True)
+        return self.__group(self.group.get('gid', gid))
 
     def getgruuid(self, uuid):
-        return query(self.group, ('id', '=', uuid), single=True)
+        return self.__group(self.group.get('id', uuid))
 
     def change_password(self, username, password):
         try:
@@ -159,9 +339,9 @@ class FlatFilePlugin(DirectoryServicePlugin):
         self.passwd_filename = directory.parameters["passwd_file"]
         self.group_filename = directory.parameters["group_file"]
         self.__load()
-        if not self.watch_thread:
-            self.watch_thread = threading.Thread(target=self.__watch, daemon=True)
-            self.watch_thread.start()
+        if not self.watcher:
+            self.watcher = self.watcher_factory([self.passwd_filename, self.group_filename], self.__on_change)
+            self.watcher.start()
 
         directory.put_state(DirectoryState.BOUND)
 
@@ -42,6 +42,8 @@ from freenas.utils.query import get, contains
 
 
 TICKET_RENEW_LIFE = 30 * 86400  # 30 days
+PAGE_SIZE = 500
+PAGED_RESULTS_OID = '1.2.840.113556.1.4.319'
 logger = logging.getLogger(__name__)
 
 
@@ -74,15 +76,48 @@ class LDAPPlugin(DirectoryServicePlugin):
             'verify_certificate': True
         })
 
+    def get_response(self, id):
+        # Synchronous strategies return search status instead of message id
+        if isinstance(id, bool):
+            return self.conn.response, self.conn.result
+
+        return self.conn.get_response(id)
+
     def search(self, search_base, search_filter, attributes=None):
         if self.conn.closed:
             with self.bind_lock:
                 self.conn.bind()
 
         id = self.conn.search(search_base, search_filter, attributes=attributes or ldap3.ALL_ATTRIBUTES)
-        result, status = self.conn.get_response(id)
+        result, status = self.get_response(id)
         return result
 
+    def search_paged(self, search_base, search_filter, attributes=None, page_size=PAGE_SIZE):
+        """
+        Yields search results one RFC 2696 page at a time.
+        """
+        cookie = None
+        while True:
+            if self.conn.closed:
+                with self.bind_lock:
+                    self.conn.bind()
+
+            id = self.conn.search(
+                search_base,
+                search_filter,
+                attributes=attributes or ldap3.ALL_ATTRIBUTES,
+                paged_size=page_size,
+                paged_cookie=cookie
+            )
+
+            result, status = self.get_response(id)
+            yield [i for i in result if i['type'] == 'searchResEntry']
+
+            control = (status.get('controls') or {}).get(PAGED_RESULTS_OID)
+            cookie = control['value']['cookie'] if control else None
+            if not cookie:
+                return
+
     def search_one(self, *args, **kwargs):
         return first_or_default(None, self.search(*args, **kwargs))
 
@@ -103,25 +138,71 @@ class LDAPPlugin(DirectoryServicePlugin):
     def get_gecos(self, entry):
         pass
 
-    def convert_user(self, entry):
+    def index_groups(self, search_filter):
+        """
+        Builds gidNumber -> group ID and member -> [group ID] maps out of groups
+        matching the filter. Members are listed either by name in memberUid
+        (RFC 2307) or by DN in member (RFC 2307bis).
+        """
+        primary = {}
+        auxiliary = {}
+        for page in self.search_paged(self.group_dn, search_filter):
+            for i in page:
+                group = dict(i['attributes'])
+                id = self.get_id(group)
+                if contains(group, 'gidNumber'):
+                    primary.setdefault(int(get(group, 'gidNumber')), id)
+
+                for member in get(group, 'memberUid') or []:
+                    auxiliary.setdefault(member, []).append(id)
+
+                for member in get(group, 'member') or []:
+                    auxiliary.setdefault(member.lower(), []).append(id)
+
+        return primary, auxiliary
+
+    def get_memberships(self, entries):
+        """
+        Resolves primary and auxiliary groups of a batch of user entries with a
+        single group search.
+        """
+        if not entries:
+            return {}, {}
+
+        gids = set()
+        names = set()
+        dns = set()
+        for entry in entries:
+            attrs = entry['attributes']
+            if contains(attrs, 'gidNumber'):
+                gids.add(int(get(attrs, 'gidNumber')))
+
+            names.add(get(attrs, 'uid.0'))
+            dns.add(entry['dn'])
+
+        names.discard(None)
+        qb = LdapQueryBuilder()
+        return self.index_groups(qb.build_query([
+            ('objectclass', '=', 'posixGroup'),
+            ('or', [('gidNumber', '=', i) for i in gids] +
+                   [('memberUid', '=', i) for i in names] +
+                   [('member', '=', i) for i in dns])
+        ]))
+
+    def convert_user(self, entry, memberships=None):
+        if not entry:
+            return None
+
+        primary, auxiliary = memberships or self.get_memberships([entry])
+        dn = entry['dn']
         entry = dict(entry['attributes'])
         pwd_change_time = get(entry, 'sambaPwdLastSet')
+        group = primary.get(int(get(entry, 'gidNumber'))) if contains(entry, 'gidNumber') else None
         groups = []
-        group = None
-
-        if contains(entry, 'gidNumber'):
-            ret = self.search_one(
-                self.group_dn,
-                '(gidNumber={0})'.format(get(entry, 'gidNumber'))
-            )
 
-            if ret:
-                group = dict(ret['attributes'])
-
-        # Try to find any auxiliary groups
-        for i in self.search(self.group_dn, '(memberUid={0})'.format(get(entry, 'uid'))):
-            g = dict(i['attributes'])
-            groups.append(self.get_id(g))
+        for i in auxiliary.get(get(entry, 'uid.0'), []) + auxiliary.get(dn.lower(), []):
+            if i not in groups:
+                groups.append(i)
 
         return {
             'id': self.get_id(entry),
@@ -135,12 +216,15 @@ class LDAPPlugin(DirectoryServicePlugin):
             'nthash': get(entry, 'sambaNTPassword'),
             'lmhash': get(entry, 'sambaLMPassword'),
             'password_changed_at': datetime.utcfromtimestamp(int(pwd_change_time)) if pwd_change_time else None,
-            'group': self.get_id(group) if group else None,
+            'group': group,
             'groups': groups,
             'sudo': False
         }
 
     def convert_group(self, entry):
+        if not entry:
+            return None
+
         entry = dict(entry['attributes'])
         return {
             'id': self.get_id(entry),
@@ -153,8 +237,12 @@ class LDAPPlugin(DirectoryServicePlugin):
 
     def getpwent(self, filter=None, params=None):
         logger.debug('getpwent(filter={0}, params={0})'.format(filter, params))
-        result = self.search(self.user_dn, '(objectclass=posixAccount)')
-        return (self.convert_user(i) for i in result)
+        # Large groups would be sent over again for every page of users if memberships
+        # were resolved page by page, so index all of them upfront instead
+        memberships = self.index_groups('(objectclass=posixGroup)')
+        for page in self.search_paged(self.user_dn, '(objectclass=posixAccount)'):
+            for i in page:
+                yield self.convert_user(i, memberships)
 
     def getpwnam(self, name):
         logger.debug('getpwnam(name={0})'.format(name))
@@ -183,8 +271,9 @@ class LDAPPlugin(DirectoryServicePlugin):
 
     def getgrent(self, filter=None, params=None):
         logger.debug('getgrent(filter={0}, params={0})'.format(filter, params))
-        result = self.search(self.group_dn, '(objectclass=posixGroup)')
-        return (self.convert_group(i) for i in result)
+        for page in self.search_paged(self.group_dn, '(objectclass=posixGroup)'):
+            for i in page:
+                yield self.convert_group(i)
 
     def getgrnam(self, name):
         logger.debug('getgrnam(name={0})'.format(name))
@@ -33,10 +33,12 @@ from plugin import DirectoryServicePlugin, DirectoryState
 class LocalDatabasePlugin(DirectoryServicePlugin):
     def __init__(self, context):
         def flush_users(ev):
+            context.users_cache.flush_negative()
             for i in ev['ids']:
                 context.users_cache.flush(i)
 
         def flush_groups(ev):
+            context.groups_cache.flush_negative()
             for i in ev['ids']:
                 context.groups_cache.flush(i)
 
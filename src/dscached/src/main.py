@@ -40,7 +40,10 @@ import ipaddress
 import socket
 import netif
 from bsd import setproctitle
-from threading import RLock, Thread
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from queue import Queue, Empty, Full
+from threading import RLock, Lock, Thread, Event, get_ident
 from datetime import datetime, timedelta
 from datastore.config import ConfigStore
 from freenas.dispatcher.client import Client, ClientError
@@ -56,6 +59,14 @@ from plugin import DirectoryState
 NOGROUP_GID = 65533
 DEFAULT_CONFIGFILE = '/usr/local/etc/middleware.conf'
 DEFAULT_SOCKET_ADDRESS = 'unix:///var/run/dscached.sock'
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_NEGATIVE_TTL = 60
+DEFAULT_LOOKUP_TIMEOUT = 10
+LOOKUP_THREADS = 4
+LOCAL_DIRECTORY_TYPES = ('local', 'file')
+ENUMERATION_BUFFER = 1024
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 60
 AF_MAP = {
     socket.AF_INET: ipaddress.IPv4Address,
     socket.AF_INET6: ipaddress.IPv6Address
@@ -137,7 +148,7 @@ def annotate(user, directory, name_field, cache=None):
 
 
 class CacheItem(object):
-    __slots__ = ('id', 'uuid', 'names', 'value', 'directory', 'ttl', 'created_at', 'lock', 'destroyed')
+    __slots__ = ('id', 'uuid', 'names', 'value', 'directory', 'ttl', 'created_at')
 
     def __init__(self, id, uuid, names, value, directory, ttl):
         self.id = id
@@ -147,8 +158,6 @@ class CacheItem(object):
         self.directory = directory
         self.ttl = ttl
         self.created_at = datetime.utcnow()
-        self.lock = RLock()
-        self.destroyed = False
 
     @property
     def expired(self):
@@ -167,13 +176,79 @@ class CacheItem(object):
         })
 
 
-class TTLCacheStore(object):
+class InFlightLookup(object):
+    def __init__(self):
+        self.owner = get_ident()
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key: the first caller runs
+    the function, the others wait for and share its result.
+    """
     def __init__(self):
+        self.lock = RLock()
+        self.calls = {}
+        self.coalesced = 0
+
+    def call(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            if call and call.owner != get_ident():
+                self.coalesced += 1
+                leader = False
+            else:
+                # Recursive lookups of the same key from the leader thread just run again
+                call = InFlightLookup()
+                self.calls.setdefault(key, call)
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as err:
+            call.error = err
+            raise
+        finally:
+            with self.lock:
+                if self.calls.get(key) is call:
+                    del self.calls[key]
+
+            call.done.set()
+
+
+class IncompleteLookup(Exception):
+    """
+    Raised when nothing was found, but not every directory gave an answer,
+    so the miss must not be remembered.
+    """
+    pass
+
+
+class TTLCacheStore(object):
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, negative_ttl=DEFAULT_NEGATIVE_TTL):
         self.id_store = {}
         self.name_store = {}
-        self.uuid_store = {}
+        self.uuid_store = OrderedDict()
+        self.negative_store = OrderedDict()
+        self.lock = RLock()
+        self.inflight = SingleFlight()
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
         self.hits = 0
         self.misses = 0
+        self.negative_hits = 0
+        self.evictions = 0
 
     def __len__(self):
         return len(self.id_store)
@@ -181,63 +256,387 @@ class TTLCacheStore(object):
     def __getstate__(self):
         return {
             'size': len(self),
+            'max_size': self.max_size,
+            'negative_size': len(self.negative_store),
             'hits': self.hits,
-            'misses': self.misses
+            'misses': self.misses,
+            'negative_hits': self.negative_hits,
+            'coalesced': self.inflight.coalesced,
+            'evictions': self.evictions
         }
 
     def get(self, id=None, uuid=None, name=None):
-        if id is not None:
-            item = self.id_store.get(id)
-        elif uuid is not None:
-            item = self.uuid_store.get(uuid.lower())
-        elif name is not None:
-            item = self.name_store.get(name)
-        else:
-            raise AssertionError('Either id=, uuid= or name= parameter must be filled')
+        with self.lock:
+            if id is not None:
+                item = self.id_store.get(id)
+            elif uuid is not None:
+                item = self.uuid_store.get(uuid.lower())
+            elif name is not None:
+                item = self.name_store.get(name)
+            else:
+                raise AssertionError('Either id=, uuid= or name= parameter must be filled')
+
+            if item:
+                if item.expired:
+                    self.flush(item.uuid)
+                    self.misses += 1
+                    return
+
+                self.uuid_store.move_to_end(item.uuid)
+                self.hits += 1
+                return item
+
+            self.misses += 1
+            return
 
+    def lookup(self, field, value, resolve, skip_ad=False):
+        """
+        Returns cached item for given field (id, uuid or name) or calls
+        resolve() to find it in directories. Misses are remembered for
+        negative_ttl seconds, unless resolve() raised IncompleteLookup, and
+        concurrent lookups of the same value are resolved only once.
+        """
+        item = self.get(**{field: value})
         if item:
-            if item.expired:
-                self.flush(item.uuid)
-                self.misses += 1
+            if skip_ad and item.directory.plugin_type == 'winbind':
                 return
 
-            self.hits += 1
             return item
 
-        self.misses += 1
-        return
+        if self.get_negative(field, value, skip_ad):
+            return
+
+        def fill():
+            try:
+                item = resolve()
+            except IncompleteLookup:
+                return None
+
+            if item:
+                self.set(item)
+            else:
+                self.set_negative(field, value, skip_ad)
+
+            return item
+
+        return self.inflight.call((field, value, skip_ad), fill)
+
+    def get_negative(self, field, value, skip_ad=False):
+        key = (field, value)
+        with self.lock:
+            entry = self.negative_store.get(key)
+            if not entry:
+                return False
+
+            expires_at, partial = entry
+            if expires_at < time.monotonic():
+                del self.negative_store[key]
+                return False
+
+            # Miss recorded with skip_ad=True says nothing about AD
+            if partial and not skip_ad:
+                return False
+
+            self.negative_hits += 1
+            return True
+
+    def set_negative(self, field, value, skip_ad=False):
+        if not self.negative_ttl:
+            return
+
+        key = (field, value)
+        with self.lock:
+            entry = self.negative_store.get(key)
+            if skip_ad and entry and not entry[1]:
+                return
+
+            self.negative_store[key] = (time.monotonic() + self.negative_ttl, skip_ad)
+            self.negative_store.move_to_end(key)
+            while len(self.negative_store) > self.max_size:
+                self.negative_store.popitem(last=False)
+
+    def flush_negative(self):
+        with self.lock:
+            self.negative_store.clear()
 
     def flush(self, uuid):
-        item = self.uuid_store.get(uuid)
-        if item:
-            with item.lock:
-                if item.destroyed:
-                    return
+        with self.lock:
+            item = self.uuid_store.pop(uuid.lower(), None)
+            if not item:
+                return
 
-                for i in item.names:
+            for i in item.names:
+                if self.name_store.get(i) is item:
                     del self.name_store[i]
-                del self.uuid_store[item.uuid]
+
+            if self.id_store.get(item.id) is item:
                 del self.id_store[item.id]
 
     def query(self, filter=None, params=None):
         return query(self.id_store, *(filter or []), **(params or {}))
 
     def set(self, item):
-        with item.lock:
+        with self.lock:
+            self.flush(item.uuid)
             self.id_store[item.id] = item
             self.uuid_store[item.uuid] = item
             for i in item.names:
                 self.name_store[i] = item
+                self.negative_store.pop(('name', i), None)
+
+            self.negative_store.pop(('id', item.id), None)
+            self.negative_store.pop(('uuid', item.uuid), None)
+
+            while len(self.uuid_store) > self.max_size:
+                self.flush(next(iter(self.uuid_store)))
+                self.evictions += 1
 
     def expire(self):
-        for uuid, item in self.uuid_store.items():
-            if item.expired:
-                self.flush(uuid)
+        with self.lock:
+            for uuid, item in list(self.uuid_store.items()):
+                if item.expired:
+                    self.flush(uuid)
+
+            now = time.monotonic()
+            for key, (expires_at, _) in list(self.negative_store.items()):
+                if expires_at < now:
+                    del self.negative_store[key]
 
     def clear(self):
-        self.name_store.clear()
-        self.uuid_store.clear()
-        self.id_store.clear()
+        with self.lock:
+            self.name_store.clear()
+            self.uuid_store.clear()
+            self.id_store.clear()
+            self.negative_store.clear()
+
+
+class DirectoryStats(object):
+    def __init__(self):
+        self.lock = RLock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def __getstate__(self):
+        lookups = self.hits + self.misses + self.errors
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'avg_time': self.total_time / lookups if lookups else None,
+            'max_time': self.max_time
+        }
+
+    def record_timeout(self):
+        with self.lock:
+            self.timeouts += 1
+
+    def record(self, result, duration, error=False):
+        with self.lock:
+            if error:
+                self.errors += 1
+            elif result:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+            self.total_time += duration
+            self.max_time = max(self.max_time, duration)
+
+
+class CircuitBreaker(object):
+    """
+    Tracks consecutive failed lookups of a directory. After `threshold` failures
+    the breaker opens and the directory is skipped; once `cooldown` seconds pass,
+    a single lookup is let through and closes the breaker if it succeeds.
+    """
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.lock = Lock()
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = None
+
+    def __getstate__(self):
+        return {
+            'degraded': self.open,
+            'consecutive_failures': self.failures,
+            'trips': self.trips
+        }
+
+    @property
+    def open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+
+            now = time.monotonic()
+            if now - self.opened_at < self.cooldown:
+                return False
+
+            # Half-open: let this lookup through, the next one waits for another cooldown
+            self.opened_at = now
+            return True
+
+    def record(self, ok):
+        """
+        Returns True if the breaker opened or closed as a result.
+        """
+        with self.lock:
+            if ok:
+                self.failures = 0
+                if self.opened_at is None:
+                    return False
+
+                self.opened_at = None
+                return True
+
+            self.failures += 1
+            if self.opened_at is None and self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self.trips += 1
+                return True
+
+            return False
+
+    def reset(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+
+class LookupTimeout(Exception):
+    pass
+
+
+class DirectoryCall(object):
+    """
+    Lookup running in the lookup pool of its directory. The deadline starts
+    once the lookup starts running; a lookup still queued when the caller
+    gives up is cancelled and not held against the directory. Otherwise its
+    outcome is reported to the directory circuit breaker exactly once: either
+    when it completes or when the caller stops waiting for it, whichever
+    happens first.
+    """
+    def __init__(self, directory, method, *args):
+        self.directory = directory
+        self.timeout = directory.context.lookup_timeout
+        self.queued_until = time.monotonic() + self.timeout
+        self.deadline = None
+        self.started = Event()
+        self.lock = Lock()
+        self.settled = False
+        self.future = directory.executor.submit(self.run, method, *args)
+        self.future.add_done_callback(self.done)
+
+    def run(self, method, *args):
+        self.deadline = time.monotonic() + self.timeout
+        self.started.set()
+        return self.directory.lookup(method, *args)
+
+    def settle(self, error=None):
+        with self.lock:
+            if self.settled:
+                return
+
+            self.settled = True
+
+        if error == 'timeout':
+            self.directory.stats.record_timeout()
+
+        self.directory.report(error is None)
+
+    def done(self, future):
+        if future.cancelled():
+            return
+
+        if time.monotonic() > self.deadline:
+            self.settle('timeout')
+            return
+
+        self.settle('error' if future.exception() else None)
+
+    def result(self):
+        if not self.started.wait(max(0, self.queued_until - time.monotonic())):
+            if self.future.cancel():
+                raise LookupTimeout()
+
+            # Got picked up just now
+            self.started.wait()
+
+        try:
+            return self.future.result(max(0, self.deadline - time.monotonic()))
+        except FutureTimeoutError:
+            self.settle('timeout')
+            raise LookupTimeout()
+
+
+class DirectoryEnumeration(object):
+    """
+    Runs getpwent()/getgrent() of a single directory in a background thread,
+    buffering up to ENUMERATION_BUFFER entries ahead of the consumer.
+    """
+    def __init__(self, directory, method, filter, params, timeout):
+        self.directory = directory
+        self.method = method
+        self.filter = copy.deepcopy(filter)
+        self.params = copy.deepcopy(params)
+        self.timeout = timeout
+        self.queue = Queue(ENUMERATION_BUFFER)
+        self.cancelled = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return True
+            except Full:
+                continue
+
+        return False
+
+    def run(self):
+        try:
+            for entry in getattr(self.directory.instance, self.method)(self.filter, self.params):
+                if not self.put((True, entry)):
+                    return
+
+            self.put((False, None))
+        except BaseException as err:
+            self.put((False, err))
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def __iter__(self):
+        while True:
+            try:
+                more, value = self.queue.get(timeout=self.timeout)
+            except Empty:
+                self.cancel()
+                self.directory.stats.record_timeout()
+                self.directory.report(False)
+                raise LookupTimeout()
+
+            if not more:
+                if value:
+                    self.directory.report(False)
+                    raise value
+
+                self.directory.report(True)
+                return
+
+            yield value
 
 
 class Directory(object):
@@ -255,6 +654,9 @@ class Directory(object):
         self.status_code = 0
         self.status_message = None
         self.state = DirectoryState.DISABLED
+        self.stats = DirectoryStats()
+        self.breaker = CircuitBreaker()
+        self.executor = ThreadPoolExecutor(LOOKUP_THREADS)
 
         if definition['uid_range']:
             self.min_uid, self.max_uid = definition['uid_range']
@@ -296,9 +698,53 @@ class Directory(object):
             self.context.logger.error('Failed to configure {0}: {1}'.format(self.name, str(err)))
             self.context.logger.error('Stack trace: ', exc_info=True)
 
+    def lookup(self, method, *args):
+        started_at = time.monotonic()
+        try:
+            result = getattr(self.instance, method)(*args)
+        except BaseException:
+            self.stats.record(None, time.monotonic() - started_at, error=True)
+            raise
+
+        self.stats.record(result, time.monotonic() - started_at)
+        return result
+
+    @property
+    def local(self):
+        return self.plugin_type in LOCAL_DIRECTORY_TYPES
+
+    def allow(self):
+        # Local directories are never skipped, there is nothing to fall back to
+        return self.local or self.breaker.allow()
+
+    def report(self, ok):
+        if self.local or not self.breaker.record(ok):
+            return
+
+        if self.breaker.open:
+            self.context.logger.warning('Directory {0} degraded after {1} failed lookups, skipping it for {2} seconds'.format(
+                self.name,
+                self.breaker.failures,
+                self.breaker.cooldown
+            ))
+        else:
+            self.context.logger.info('Directory {0} recovered'.format(self.name))
+            for i in self.context.users_cache, self.context.groups_cache:
+                i.flush_negative()
+
+        self.context.client.emit_event('directory.changed', {
+            'operation': 'update',
+            'ids': [self.id]
+        })
+
     def put_state(self, state):
         self.context.logger.info('Directory {0} state: {1}'.format(self.name, state.name))
         self.state = state
+        self.breaker.reset()
+
+        # Anything not found so far might be found in this directory now
+        for i in self.context.users_cache, self.context.groups_cache:
+            i.flush_negative()
         self.context.client.emit_event('directory.changed', {
             'operation': 'update',
             'ids': [self.id]
@@ -346,7 +792,11 @@ class ManagementService(RpcService):
         return {
             'users': self.context.users_cache.__getstate__(),
             'groups': self.context.groups_cache.__getstate__(),
-            'hosts': self.context.hosts_cache.__getstate__()
+            'hosts': self.context.hosts_cache.__getstate__(),
+            'directories': {
+                d.name: extend(d.stats.__getstate__(), d.breaker.__getstate__())
+                for d in self.context.directories
+            }
         }
 
     def clean_cache(self):
@@ -381,6 +831,7 @@ class ManagementService(RpcService):
             # Directory was removed
             directory.enabled = False
             directory.configure()
+            directory.executor.shutdown(wait=False)
             self.context.directories.remove(directory)
             return
 
@@ -407,6 +858,7 @@ class ManagementService(RpcService):
 
         return {
             'state': directory.state.name,
+            'degraded': directory.breaker.open,
             'status_code': directory.status_code,
             'status_message': directory.status_message
         }
@@ -432,15 +884,14 @@ class AccountService(RpcService):
         origin_domain = pop_filter(filter, 'origin.domain')
         exclude_from_filter(filter, 'origin')
 
-        for d in self.context.get_searched_directories():
-            if skip_ad and d.plugin_type == 'winbind':
-                continue
-
-            if not test_filter(origin_directory, d.name) or not test_filter(origin_domain, d.domain_name):
-                continue
+        dirs = [
+            d for d in self.context.get_searched_directories()
+            if not (skip_ad and d.plugin_type == 'winbind') and
+            test_filter(origin_directory, d.name) and test_filter(origin_domain, d.domain_name)
+        ]
 
+        for d, result in self.context.enumerate_directories(dirs, 'getpwent', filter, params):
             try:
-                result = d.instance.getpwent(filter, params)
                 for user in result:
                     if not user:
                         continue
@@ -451,102 +902,67 @@ class AccountService(RpcService):
                         return
             except GeneratorExit:
                 return
-            except:
-                self.context.logger.error('Directory {0} exception during account iteration'.format(d.name), exc_info=True)
+            except LookupTimeout:
+                self.context.logger.warning('Directory {0} timed out during account iteration'.format(d.name))
                 continue
-
-    @accepts(int, bool)
-    def getpwuid(self, uid, skip_ad=False):
-        # Try the cache first
-        item = self.context.users_cache.get(id=uid)
-        if item:
-            if skip_ad and item.directory.plugin_type == 'winbind':
-                raise RpcException(errno.ENOENT, 'UID {0} not found'.format(uid))
-
-            return fix_passwords(item.annotated)
-
-        dirs = self.context.get_active_directories()
-
-        for d in dirs:
-            if skip_ad and d.plugin_type == 'winbind':
-                continue
-
-            try:
-                user = d.instance.getpwuid(uid)
             except:
+                self.context.logger.error('Directory {0} exception during account iteration'.format(d.name), exc_info=True)
                 continue
 
+    def resolve(self, method, value, dirs, skip_ad):
+        dirs = [d for d in dirs if not (skip_ad and d.plugin_type == 'winbind')]
+        for d, user in self.context.lookup_directories(dirs, method, value):
             if user:
                 resolve_primary_group(self.context, user)
                 aliases = alias(d, user, 'username')
-                item = CacheItem(user['uid'], user['id'], aliases, copy.copy(user), d, self.context.cache_ttl)
-                self.context.users_cache.set(item)
-                return fix_passwords(item.annotated)
+                return CacheItem(user['uid'], user['id'], aliases, copy.copy(user), d, self.context.cache_ttl)
 
-        raise RpcException(errno.ENOENT, 'UID {0} not found'.format(uid))
+    @accepts(int, bool)
+    def getpwuid(self, uid, skip_ad=False):
+        item = self.context.users_cache.lookup(
+            'id', uid,
+            lambda: self.resolve('getpwuid', uid, self.context.get_active_directories(), skip_ad),
+            skip_ad
+        )
 
-    @accepts(str, bool)
-    def getpwnam(self, user_name, skip_ad=False):
-        # Try the cache first
-        item = self.context.users_cache.get(name=user_name)
-        if item:
-            if skip_ad and item.directory.plugin_type == 'winbind':
-                raise RpcException(errno.ENOENT, 'User {0} not found'.format(user_name))
+        if not item:
+            raise RpcException(errno.ENOENT, 'UID {0} not found'.format(uid))
 
-            return fix_passwords(item.annotated)
+        return fix_passwords(item.annotated)
 
+    @accepts(str, bool)
+    def getpwnam(self, user_name, skip_ad=False):
+        name = user_name
         if '@' in user_name:
             # Fully qualified user name
-            user_name, domain_name = user_name.split('@', 1)
+            name, domain_name = user_name.split('@', 1)
             dirs = [self.context.get_directory_by_domain(domain_name)]
         else:
             dirs = self.context.get_searched_directories()
 
-        for d in dirs:
-            if skip_ad and d.plugin_type == 'winbind':
-                continue
-
-            try:
-                user = d.instance.getpwnam(user_name)
-            except:
-                continue
+        item = self.context.users_cache.lookup(
+            'name', user_name,
+            lambda: self.resolve('getpwnam', name, [d for d in dirs if d], skip_ad),
+            skip_ad
+        )
 
-            if user:
-                resolve_primary_group(self.context, user)
-                aliases = alias(d, user, 'username')
-                item = CacheItem(user['uid'], user['id'], aliases, copy.copy(user), d, self.context.cache_ttl)
-                self.context.users_cache.set(item)
-                return fix_passwords(item.annotated)
+        if not item:
+            raise RpcException(errno.ENOENT, 'User {0} not found'.format(user_name))
 
-        raise RpcException(errno.ENOENT, 'User {0} not found'.format(user_name))
+        return fix_passwords(item.annotated)
 
     @accepts(str, bool)
     def getpwuuid(self, uuid, skip_ad=False):
-        # Try the cache first
-        item = self.context.users_cache.get(uuid=uuid)
-        if item:
-            if skip_ad and item.directory.plugin_type == 'winbind':
-                raise RpcException(errno.ENOENT, 'UUID {0} not found'.format(uuid))
-
-            return fix_passwords(item.annotated)
-
-        for d in self.context.get_active_directories():
-            if skip_ad and d.plugin_type == 'winbind':
-                continue
-
-            try:
-                user = d.instance.getpwuuid(uuid)
-            except:
-                continue
+        item = self.context.users_cache.lookup(
+            'uuid', uuid.lower(),
+            lambda: self.resolve('getpwuuid', uuid, self.context.get_active_directories(), skip_ad),
+            skip_ad
+        )
 
-            if user:
-                resolve_primary_group(self.context, user)
-                aliases = alias(d, user, 'username')
-                item = CacheItem(user['uid'], user['id'], aliases, copy.copy(user), d, self.context.cache_ttl)
-                self.context.users_cache.set(item)
-                return fix_passwords(item.annotated)
+        if not item:
+            raise RpcException(errno.ENOENT, 'UUID {0} not found'.format(uuid))
 
-        raise RpcException(errno.ENOENT, 'UUID {0} not found'.format(uuid))
+        return fix_passwords(item.annotated)
 
     @accepts(str, bool, bool)
     def getgroupmembership(self, user_name, skip_ad=False, include_primary_group=False):
@@ -620,15 +1036,14 @@ class GroupService(RpcService):
         origin_domain = pop_filter(filter, 'origin.domain')
         exclude_from_filter(filter, 'origin')
 
-        for d in self.context.get_searched_directories():
-            if skip_ad and d.plugin_type == 'winbind':
-                continue
-
-            if not test_filter(origin_directory, d.name) or not test_filter(origin_domain, d.domain_name):
-                continue
+        dirs = [
+            d for d in self.context.get_searched_directories()
+            if not (skip_ad and d.plugin_type == 'winbind') and
+            test_filter(origin_directory, d.name) and test_filter(origin_domain, d.domain_name)
+        ]
 
+        for d, result in self.context.enumerate_directories(dirs, 'getgrent', filter, params):
             try:
-                result = d.instance.getgrent(filter, params)
                 for group in result:
                     if not group:
                         continue
@@ -638,99 +1053,66 @@ class GroupService(RpcService):
                         return
             except GeneratorExit:
                 return
+            except LookupTimeout:
+                self.context.logger.warning('Directory {0} timed out during group iteration'.format(d.name))
+                continue
             except:
                 self.context.logger.error('Directory {0} exception during group iteration'.format(d.name), exc_info=True)
                 continue
 
+    def resolve(self, method, value, dirs, skip_ad):
+        dirs = [d for d in dirs if not (skip_ad and d.plugin_type == 'winbind')]
+        for d, group in self.context.lookup_directories(dirs, method, value):
+            if group:
+                aliases = alias(d, group, 'name')
+                return CacheItem(group['gid'], group['id'], aliases, copy.copy(group), d, self.context.cache_ttl)
+
     @accepts(str, bool)
     def getgrnam(self, name, skip_ad=False):
-        # Try the cache first
-        item = self.context.groups_cache.get(name=name)
-        if item:
-            if skip_ad and item.directory.plugin_type == 'winbind':
-                raise RpcException(errno.ENOENT, 'Group {0} not found'.format(name))
-
-            return item.annotated
-
+        group_name = name
         if '@' in name:
             # Fully qualified group name
-            name, domain_name = name.split('@', 1)
+            group_name, domain_name = name.split('@', 1)
             dirs = [self.context.get_directory_by_domain(domain_name)]
         else:
             dirs = self.context.get_searched_directories()
 
-        for d in dirs:
-            if skip_ad and d.plugin_type == 'winbind':
-                continue
-
-            try:
-                group = d.instance.getgrnam(name)
-            except:
-                continue
+        item = self.context.groups_cache.lookup(
+            'name', name,
+            lambda: self.resolve('getgrnam', group_name, [d for d in dirs if d], skip_ad),
+            skip_ad
+        )
 
-            if group:
-                aliases = alias(d, group, 'name')
-                item = CacheItem(group['gid'], group['id'], aliases, copy.copy(group), d, self.context.cache_ttl)
-                self.context.groups_cache.set(item)
-                return item.annotated
+        if not item:
+            raise RpcException(errno.ENOENT, 'Group {0} not found'.format(name))
 
-        raise RpcException(errno.ENOENT, 'Group {0} not found'.format(name))
+        return item.annotated
 
     @accepts(int, bool)
     def getgrgid(self, gid, skip_ad=False):
-        # Try the cache first
-        item = self.context.groups_cache.get(id=gid)
-        if item:
-            if skip_ad and item.directory.plugin_type == 'winbind':
-                raise RpcException(errno.ENOENT, 'Group {0} not found'.format(gid))
-
-            return item.annotated
-
-        dirs = self.context.get_active_directories()
-
-        for d in dirs:
-            if skip_ad and d.plugin_type == 'winbind':
-                continue
-
-            try:
-                group = d.instance.getgrgid(gid)
-            except:
-                continue
+        item = self.context.groups_cache.lookup(
+            'id', gid,
+            lambda: self.resolve('getgrgid', gid, self.context.get_active_directories(), skip_ad),
+            skip_ad
+        )
 
-            if group:
-                aliases = alias(d, group, 'name')
-                item = CacheItem(group['gid'], group['id'], aliases, copy.copy(group), d, self.context.cache_ttl)
-                self.context.groups_cache.set(item)
-                return item.annotated
+        if not item:
+            raise RpcException(errno.ENOENT, 'GID {0} not found'.format(gid))
 
-        raise RpcException(errno.ENOENT, 'GID {0} not found'.format(gid))
+        return item.annotated
 
     @accepts(str, bool)
     def getgruuid(self, uuid, skip_ad=False):
-        # Try the cache first
-        item = self.context.groups_cache.get(uuid=uuid)
-        if item:
-            if skip_ad and item.directory.plugin_type == 'winbind':
-                raise RpcException(errno.ENOENT, 'UUID {0} not found'.format(uuid))
-
-            return item.annotated
+        item = self.context.groups_cache.lookup(
+            'uuid', uuid.lower(),
+            lambda: self.resolve('getgruuid', uuid, self.context.get_active_directories(), skip_ad),
+            skip_ad
+        )
 
-        for d in self.context.get_active_directories():
-            if skip_ad and d.plugin_type == 'winbind':
-                continue
+        if not item:
+            raise RpcException(errno.ENOENT, 'UUID {0} not found'.format(uuid))
 
-            try:
-                group = d.instance.getgruuid(uuid)
-            except:
-                continue
-
-            if group:
-                aliases = alias(d, group, 'name')
-                item = CacheItem(group['gid'], group['id'], aliases, copy.copy(group), d, self.context.cache_ttl)
-                self.context.groups_cache.set(item)
-                return item.annotated
-
-        raise RpcException(errno.ENOENT, 'UUID {0} not found'.format(uuid))
+        return item.annotated
 
 
 class HostService(RpcService):
@@ -804,6 +1186,7 @@ class Main(object):
         self.groups_cache = TTLCacheStore()
         self.hosts_cache = TTLCacheStore()
         self.cache_ttl = 7200
+        self.lookup_timeout = DEFAULT_LOOKUP_TIMEOUT
         self.search_order = []
         self.cache_enumerations = True
         self.cache_lookups = True
@@ -830,6 +1213,66 @@ class Main(object):
     def get_search_order(self):
         return self.search_order
 
+    def lookup_directories(self, dirs, method, *args):
+        """
+        Runs the lookup in all directories at once and yields (directory, result)
+        pairs in the order of `dirs`. Directories which fail or don't answer within
+        lookup_timeout are skipped, so are the ones with an open circuit breaker.
+        Every directory has its own lookup pool, so a stalled one cannot hold up
+        lookups in the others. Callers stop iterating at the first authoritative
+        answer and leave the remaining lookups to finish in the background.
+
+        If a directory failed, timed out or was skipped, IncompleteLookup is
+        raised once all the others have been yielded, so that a miss is only
+        remembered when every directory has answered it.
+        """
+        calls = []
+        incomplete = False
+        for d in dirs:
+            if d.allow():
+                calls.append(DirectoryCall(d, method, *args))
+            else:
+                incomplete = True
+
+        for call in calls:
+            try:
+                result = call.result()
+            except LookupTimeout:
+                self.logger.warning('Directory {0} timed out during {1} lookup'.format(call.directory.name, method))
+                incomplete = True
+                continue
+            except BaseException as err:
+                self.logger.warning('Directory {0} failed during {1} lookup: {2}'.format(
+                    call.directory.name,
+                    method,
+                    str(err)
+                ))
+                incomplete = True
+                continue
+
+            yield call.directory, result
+
+        if incomplete:
+            raise IncompleteLookup()
+
+    def enumerate_directories(self, dirs, method, filter, params):
+        """
+        Starts enumerating all directories at once and yields (directory, iterator)
+        pairs in the order of `dirs`. While the consumer drains one directory, the
+        following ones are already being prefetched.
+        """
+        enumerations = [
+            DirectoryEnumeration(d, method, filter, params, self.lookup_timeout)
+            for d in dirs if d.allow()
+        ]
+
+        try:
+            for i in enumerations:
+                yield i.directory, iter(i)
+        finally:
+            for i in enumerations:
+                i.cancel()
+
     def get_directory_by_domain(self, domain_name):
         return first_or_default(lambda d: d.domain_name == domain_name, self.directories)
 
@@ -958,6 +1401,13 @@ class Main(object):
     def load_config(self):
         self.search_order = self.configstore.get('directory.search_order')
         self.cache_ttl = self.configstore.get('directory.cache_ttl')
+        self.lookup_timeout = self.configstore.get('directory.lookup_timeout') or DEFAULT_LOOKUP_TIMEOUT
+        for i in self.users_cache, self.groups_cache, self.hosts_cache:
+            i.max_size = self.configstore.get('directory.cache_size') or DEFAULT_CACHE_SIZE
+            i.negative_ttl = self.configstore.get('directory.cache_negative_ttl')
+            if i.negative_ttl is None:
+                i.negative_ttl = DEFAULT_NEGATIVE_TTL
+
         self.cache_enumerations = self.configstore.get('directory.cache_enumerations')
         self.cache_lookups = self.configstore.get('directory.cache_lookups')
 
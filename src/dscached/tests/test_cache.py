@@ -0,0 +1,423 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+import os
+import sys
+import time
+import types
+import unittest
+import threading
+from collections import Counter
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# py-bsd and py-netif are FreeBSD only; the cache doesn't touch either
+for name in ('bsd', 'netif'):
+    try:
+        __import__(name)
+    except ImportError:
+        module = types.ModuleType(name)
+        module.setproctitle = mock.Mock()
+        sys.modules[name] = module
+
+import main
+from main import Directory, DirectoryState, Main, RpcException
+
+
+USERS = [
+    {'id': 'a3c1f4e6-0000-4000-8000-00000000{0:04d}'.format(i), 'uid': 1000 + i, 'gid': 1000, 'username': 'user{0}'.format(i)}
+    for i in range(10)
+]
+
+
+class FakeDirectoryPlugin(object):
+    def __init__(self, context):
+        self.calls = Counter()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def configure(self, enable, directory):
+        return None
+
+    def get_kerberos_realm(self, parameters):
+        return None
+
+    def lookup(self, method, field, value):
+        self.calls[method] += 1
+        self.gate.wait()
+        return next((dict(u) for u in USERS if u[field] == value), None)
+
+    def getpwnam(self, name):
+        return self.lookup('getpwnam', 'username', name)
+
+    def getpwuid(self, uid):
+        return self.lookup('getpwuid', 'uid', uid)
+
+    def getpwuuid(self, uuid):
+        return self.lookup('getpwuuid', 'id', uuid)
+
+    def getpwent(self, filter=None, params=None):
+        self.calls['getpwent'] += 1
+        self.gate.wait()
+        return (dict(u) for u in USERS)
+
+
+class RemoteDirectoryPlugin(FakeDirectoryPlugin):
+    def lookup(self, method, field, value):
+        user = super(RemoteDirectoryPlugin, self).lookup(method, field, value)
+        if user:
+            user['username'] = user['username'].replace('user', 'remote')
+
+        return user
+
+    def getpwnam(self, name):
+        if not name.startswith('remote'):
+            self.calls['getpwnam'] += 1
+            return None
+
+        return self.lookup('getpwnam', 'username', name.replace('remote', 'user'))
+
+
+class TestAccountCache(unittest.TestCase):
+    def setUp(self):
+        self.context = Main()
+        self.context.plugins['fake'] = FakeDirectoryPlugin
+        self.context.search_order = ['fake']
+        self.directory = Directory(self.context, {
+            'id': 'fake',
+            'name': 'fake',
+            'type': 'fake',
+            'parameters': {},
+            'enabled': True,
+            'enumerate': True,
+            'uid_range': None,
+            'gid_range': None
+        })
+
+        self.directory.state = DirectoryState.BOUND
+        self.context.directories.append(self.directory)
+        self.plugin = self.directory.instance
+        self.cache = self.context.users_cache
+        self.accounts = self.context.account_service
+
+    def test_positive(self):
+        self.assertEqual(self.accounts.getpwnam('user1')['uid'], 1001)
+        self.assertEqual(self.accounts.getpwnam('user1')['uid'], 1001)
+        self.assertEqual(self.accounts.getpwuid(1001)['username'], 'user1')
+        self.assertEqual(self.accounts.getpwuuid(USERS[1]['id'].upper())['username'], 'user1')
+        self.assertEqual(self.plugin.calls['getpwnam'], 1)
+        self.assertEqual(self.plugin.calls['getpwuid'], 0)
+        self.assertEqual(self.plugin.calls['getpwuuid'], 0)
+
+    def test_negative(self):
+        for i in range(5):
+            with self.assertRaises(RpcException):
+                self.accounts.getpwnam('nobody')
+
+        self.assertEqual(self.plugin.calls['getpwnam'], 1)
+        self.assertEqual(self.cache.negative_hits, 4)
+
+        self.cache.flush_negative()
+        with self.assertRaises(RpcException):
+            self.accounts.getpwnam('nobody')
+
+        self.assertEqual(self.plugin.calls['getpwnam'], 2)
+
+    def test_negative_ttl(self):
+        self.cache.negative_ttl = 0.05
+        with self.assertRaises(RpcException):
+            self.accounts.getpwuid(5000)
+
+        time.sleep(0.1)
+        with self.assertRaises(RpcException):
+            self.accounts.getpwuid(5000)
+
+        self.assertEqual(self.plugin.calls['getpwuid'], 2)
+
+    def test_negative_skip_ad(self):
+        # A miss while skipping AD must not hide the account from a full lookup
+        with self.assertRaises(RpcException):
+            self.accounts.getpwnam('nobody', True)
+
+        with self.assertRaises(RpcException):
+            self.accounts.getpwnam('nobody')
+
+        with self.assertRaises(RpcException):
+            self.accounts.getpwnam('nobody', True)
+
+        self.assertEqual(self.plugin.calls['getpwnam'], 2)
+
+    def test_negative_on_error(self):
+        # A directory failing to answer is not the same as not finding anything
+        with mock.patch.object(self.plugin, 'getpwnam', side_effect=OSError('connection reset')):
+            with self.assertRaises(RpcException):
+                self.accounts.getpwnam('user1')
+
+        self.assertFalse(self.cache.get_negative('name', 'user1'))
+        self.assertEqual(self.accounts.getpwnam('user1')['uid'], 1001)
+
+    def test_negative_dropped_on_set(self):
+        self.cache.set_negative('name', 'user2')
+        self.accounts.getpwuid(1002)
+        self.assertEqual(self.accounts.getpwnam('user2')['uid'], 1002)
+        self.assertEqual(self.cache.negative_hits, 0)
+        self.assertEqual(self.plugin.calls['getpwnam'], 0)
+
+    def test_coalescing(self):
+        self.plugin.gate.clear()
+        results = []
+
+        def lookup():
+            results.append(self.accounts.getpwnam('user3')['uid'])
+
+        threads = [threading.Thread(target=lookup) for i in range(20)]
+        for t in threads:
+            t.start()
+
+        while self.plugin.calls['getpwnam'] == 0:
+            time.sleep(0.01)
+
+        time.sleep(0.1)
+        self.plugin.gate.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results, [1003] * 20)
+        self.assertEqual(self.plugin.calls['getpwnam'], 1)
+
+    def test_coalesced_miss(self):
+        self.plugin.gate.clear()
+        errors = []
+
+        def lookup():
+            try:
+                self.accounts.getpwuid(4000)
+            except RpcException as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=lookup) for i in range(10)]
+        for t in threads:
+            t.start()
+
+        time.sleep(0.1)
+        self.plugin.gate.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(errors), 10)
+        self.assertEqual(self.plugin.calls['getpwuid'], 1)
+
+    def test_lru(self):
+        self.cache.max_size = 3
+        for i in range(3):
+            self.accounts.getpwuid(1000 + i)
+
+        # Touch user0 so that user1 becomes least recently used
+        self.accounts.getpwuid(1000)
+        self.accounts.getpwuid(1003)
+
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertIsNotNone(self.cache.get(id=1000))
+        self.assertIsNone(self.cache.get(id=1001))
+        self.assertIsNone(self.cache.get(name='user1'))
+
+    def test_expire(self):
+        self.accounts.getpwuid(1000)
+        self.accounts.getpwuid(1001)
+        self.cache.get(id=1000).ttl = -1
+        self.cache.expire()
+        self.assertIsNone(self.cache.get(id=1000))
+        self.assertIsNotNone(self.cache.get(id=1001))
+
+    def test_directory_stats(self):
+        self.accounts.getpwnam('user1')
+        self.accounts.getpwnam('user1')
+        with self.assertRaises(RpcException):
+            self.accounts.getpwnam('nobody')
+
+        stats = main.ManagementService(self.context).get_cache_stats()
+        self.assertEqual(stats['directories']['fake']['hits'], 1)
+        self.assertEqual(stats['directories']['fake']['misses'], 1)
+        self.assertIsNotNone(stats['directories']['fake']['avg_time'])
+        self.assertEqual(stats['users']['negative_size'], 1)
+
+
+
+class TestDirectoryFanOut(unittest.TestCase):
+    def setUp(self):
+        self.context = Main()
+        self.context.client = mock.Mock()
+        self.context.lookup_timeout = 0.2
+        self.context.plugins['fake'] = FakeDirectoryPlugin
+        self.context.plugins['remote'] = RemoteDirectoryPlugin
+        self.context.search_order = ['remote', 'fake']
+        self.remote = self.add_directory('remote')
+        self.local = self.add_directory('fake')
+        self.accounts = self.context.account_service
+
+    def tearDown(self):
+        for d in self.context.directories:
+            d.instance.gate.set()
+
+    def add_directory(self, type):
+        directory = Directory(self.context, {
+            'id': type,
+            'name': type,
+            'type': type,
+            'parameters': {},
+            'enabled': True,
+            'enumerate': True,
+            'uid_range': None,
+            'gid_range': None
+        })
+
+        directory.state = DirectoryState.BOUND
+        self.context.directories.append(directory)
+        return directory
+
+    def test_priority(self):
+        # Both directories know uid 1001, the one searched first wins
+        self.assertEqual(self.accounts.getpwuid(1001)['username'], 'remote1')
+        self.assertEqual(self.accounts.getpwnam('user2')['origin']['directory'], 'fake')
+        self.assertEqual(self.remote.instance.calls['getpwnam'], 1)
+        self.assertEqual(self.local.instance.calls['getpwnam'], 1)
+
+    def test_short_circuit(self):
+        # Answer of the first directory doesn't wait for the slower ones
+        self.local.instance.gate.clear()
+        started_at = time.monotonic()
+        self.assertEqual(self.accounts.getpwnam('remote3')['uid'], 1003)
+        self.assertLess(time.monotonic() - started_at, 0.1)
+        self.assertEqual(self.local.stats.timeouts, 0)
+
+    def test_deadline(self):
+        self.remote.instance.gate.clear()
+        started_at = time.monotonic()
+        self.assertEqual(self.accounts.getpwuid(1004)['origin']['directory'], 'fake')
+        self.assertLess(time.monotonic() - started_at, 0.5)
+        self.assertEqual(self.remote.stats.timeouts, 1)
+        self.assertFalse(self.remote.breaker.open)
+
+    def test_deadline_miss(self):
+        # Directory which timed out might know the uid, the miss is not remembered
+        self.remote.instance.gate.clear()
+        with self.assertRaises(RpcException):
+            self.accounts.getpwuid(5000)
+
+        self.assertFalse(self.context.users_cache.get_negative('id', 5000))
+        self.remote.instance.gate.set()
+        with self.assertRaises(RpcException):
+            self.accounts.getpwuid(5000)
+
+        self.assertTrue(self.context.users_cache.get_negative('id', 5000))
+        self.assertEqual(self.remote.instance.calls['getpwuid'], 2)
+
+    def test_circuit_breaker(self):
+        self.remote.breaker.cooldown = 0.3
+        self.remote.instance.gate.clear()
+        for i in range(main.BREAKER_THRESHOLD):
+            self.accounts.getpwuid(1000 + i)
+
+        status = main.ManagementService(self.context).get_status('remote')
+        self.assertTrue(status['degraded'])
+
+        # Degraded directory isn't asked at all
+        calls = self.remote.instance.calls['getpwuid']
+        started_at = time.monotonic()
+        self.assertEqual(self.accounts.getpwuid(1005)['username'], 'user5')
+        self.assertLess(time.monotonic() - started_at, 0.1)
+        self.assertEqual(self.remote.instance.calls['getpwuid'], calls)
+        with self.assertRaises(RpcException):
+            self.accounts.getpwuid(5000)
+
+        self.assertFalse(self.context.users_cache.get_negative('id', 5000))
+
+        # A single successful lookup after cooldown closes the breaker
+        self.remote.instance.gate.set()
+        time.sleep(0.3)
+        self.assertEqual(self.accounts.getpwuid(1006)['username'], 'remote6')
+        self.assertFalse(self.remote.breaker.open)
+        self.assertEqual(self.remote.breaker.trips, 1)
+        self.assertEqual(self.context.client.emit_event.call_count, 2)
+
+    def test_queued_lookups(self):
+        # Lookups waiting behind stalled ones are not held against the directory
+        self.remote.breaker.threshold = 100
+        self.remote.instance.gate.clear()
+        dirs = self.context.get_searched_directories()
+        results = []
+
+        def lookup():
+            names = []
+            try:
+                for d, r in self.context.lookup_directories(dirs, 'getpwuid', 1001):
+                    names.append(d.name)
+            except main.IncompleteLookup:
+                pass
+
+            results.append(names)
+
+        threads = [threading.Thread(target=lookup) for i in range(3 * main.LOOKUP_THREADS)]
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results, [['fake']] * len(threads))
+        self.assertEqual(self.remote.stats.timeouts, main.LOOKUP_THREADS)
+        self.assertEqual(self.remote.breaker.failures, main.LOOKUP_THREADS)
+        self.assertEqual(self.local.stats.timeouts, 0)
+        self.assertEqual(self.local.breaker.failures, 0)
+
+    def test_local_directory(self):
+        # There is nothing to fall back to, local directories are never skipped
+        self.context.plugins['file'] = FakeDirectoryPlugin
+        local = self.add_directory('file')
+        local.instance.gate.clear()
+        for i in range(main.BREAKER_THRESHOLD + 1):
+            with self.assertRaises(main.IncompleteLookup):
+                list(self.context.lookup_directories([local], 'getpwuid', 1000))
+
+        self.assertEqual(local.stats.timeouts, main.BREAKER_THRESHOLD + 1)
+        self.assertFalse(local.breaker.open)
+        self.assertTrue(local.allow())
+
+    def test_enumeration(self):
+        users = list(self.accounts.query())
+        self.assertEqual([u['origin']['directory'] for u in users], ['remote'] * 10 + ['fake'] * 10)
+
+        self.remote.instance.gate.clear()
+        users = list(self.accounts.query())
+        self.assertEqual([u['origin']['directory'] for u in users], ['fake'] * 10)
+        self.assertEqual(self.remote.stats.timeouts, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'plugins'))
+
+from FlatFilePlugin import FlatFileIndex, FlatFilePlugin, PollingFileWatcher
+
+
+def make_users(count, groups=None):
+    return [
+        {
+            'id': 'user-{0}'.format(i),
+            'uid': 1000 + i,
+            'username': 'user{0}'.format(i),
+            'sid': 'S-1-5-21-1-2-3-{0}'.format(1000 + i),
+            'groups': groups or []
+        }
+        for i in range(count)
+    ]
+
+
+class TestFlatFileIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = FlatFileIndex(['username', 'uid', 'sid'], ['groups'])
+        self.users = make_users(100, ['group-1'])
+        self.index.update(self.users)
+
+    def test_lookup(self):
+        self.assertEqual(self.index.get('username', 'user5')['uid'], 1005)
+        self.assertEqual(self.index.get('uid', 1006)['username'], 'user6')
+        self.assertEqual(self.index.get('sid', 'S-1-5-21-1-2-3-1007')['username'], 'user7')
+        self.assertEqual(self.index.get('id', 'user-8')['uid'], 1008)
+        self.assertIsNone(self.index.get('username', 'nobody'))
+        self.assertEqual(len(self.index.get_ids('groups', 'group-1')), 100)
+
+    def test_copies(self):
+        self.index.get('username', 'user1')['username'] = 'changed'
+        self.assertIsNotNone(self.index.get('username', 'user1'))
+
+    def test_incremental_update(self):
+        users = make_users(100, ['group-1'])
+        del users[0]
+        users[1]['username'] = 'renamed'
+        users[2]['groups'] = ['group-2']
+        users.append({'id': 'user-new', 'uid': 2000, 'username': 'new', 'groups': ['group-2']})
+
+        with mock.patch.object(self.index, 'index', wraps=self.index.index) as index:
+            self.assertEqual(self.index.update(users), (1, 1, 2))
+            self.assertEqual(index.call_count, 3)
+
+        self.assertIsNone(self.index.get('username', 'user0'))
+        self.assertIsNone(self.index.get('uid', 1000))
+        self.assertIsNone(self.index.get('username', 'user2'))
+        self.assertEqual(self.index.get('username', 'renamed')['uid'], 1002)
+        self.assertEqual(self.index.get('uid', 2000)['username'], 'new')
+        self.assertEqual(len(self.index.get_ids('groups', 'group-1')), 98)
+        self.assertCountEqual(self.index.get_ids('groups', 'group-2'), ['user-3', 'user-new'])
+        self.assertEqual(len(self.index), 100)
+
+    def test_swap_names(self):
+        users = make_users(2)
+        self.index.update(copy.deepcopy(users))
+        users[0]['username'], users[1]['username'] = users[1]['username'], users[0]['username']
+        self.index.update(users)
+        self.assertEqual(self.index.get('username', 'user0')['id'], 'user-1')
+        self.assertEqual(self.index.get('username', 'user1')['id'], 'user-0')
+
+    def test_candidates(self):
+        self.assertEqual(len(self.index.candidates([('uid', '>', 0)])), 100)
+        self.assertEqual(self.index.candidates([('uid', '!=', 0), ('username', '=', 'user3')])[0]['uid'], 1003)
+        self.assertEqual(self.index.candidates([('username', '=', 'nobody')]), [])
+
+
+class TestFlatFilePlugin(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.passwd_file = os.path.join(self.tmpdir, 'passwd.json')
+        self.group_file = os.path.join(self.tmpdir, 'group.json')
+        self.write(self.passwd_file, make_users(10, ['group-1']))
+        self.write(self.group_file, [
+            {'id': 'group-0', 'gid': 0, 'name': 'wheel', 'members': []},
+            {'id': 'group-1', 'gid': 1001, 'name': 'staff', 'members': ['user-42']}
+        ])
+
+        # Watch files by polling, so that the test runs on any OS
+        mock.patch.object(
+            FlatFilePlugin, 'watcher_factory',
+            staticmethod(lambda paths, callback: PollingFileWatcher(paths, callback, interval=0.02))
+        ).start()
+
+        self.plugin = FlatFilePlugin(mock.Mock())
+        self.plugin.configure(True, mock.Mock(parameters={
+            'passwd_file': self.passwd_file,
+            'group_file': self.group_file
+        }))
+
+    def tearDown(self):
+        mock.patch.stopall()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, filename, entries):
+        # Replace the file the same way change_password() does
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(entries, f)
+
+        os.rename(filename + '.tmp', filename)
+
+    def wait_for(self, predicate):
+        deadline = time.monotonic() + 2
+        while not predicate():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_lookups(self):
+        self.assertEqual(self.plugin.getpwnam('user1')['uid'], 1001)
+        self.assertEqual(self.plugin.getpwuid(1002)['username'], 'user2')
+        self.assertEqual(self.plugin.getgrnam('staff')['gid'], 1001)
+        self.assertIsNone(self.plugin.getgrgid(0))
+        self.assertEqual(
+            self.plugin.getgruuid('group-1')['members'],
+            ['user-42'] + ['user-{0}'.format(i) for i in range(10)]
+        )
+
+    def test_reload(self):
+        users = make_users(10, ['group-1'])
+        users[3]['username'] = 'renamed'
+        self.write(self.passwd_file, users)
+        self.wait_for(lambda: self.plugin.getpwnam('renamed'))
+        self.assertIsNone(self.plugin.getpwnam('user3'))
+
+        # Watcher keeps following the file after it was replaced
+        self.write(self.passwd_file, users[:5])
+        self.wait_for(lambda: not self.plugin.getpwuid(1009))
+        self.assertEqual(len(self.plugin.getgruuid('group-1')['members']), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+import os
+import sys
+import types
+import unittest
+from unittest import mock
+
+try:
+    import ldap3
+except ImportError:
+    # ldap3 comes from ports on FreeNAS; nothing to run the mock server with otherwise
+    raise unittest.SkipTest('ldap3 is not installed')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'plugins'))
+
+try:
+    import krb5
+except ImportError:
+    # py-krb5 is FreeBSD only; LDAP searches don't need kerberos
+    krb5 = types.ModuleType('krb5')
+    krb5.KrbException = Exception
+    sys.modules['krb5'] = krb5
+
+import LDAPPlugin
+from LDAPPlugin import LDAPPlugin as Plugin
+
+
+BASE_DN = 'dc=example,dc=com'
+USER_DN = 'ou=users,' + BASE_DN
+GROUP_DN = 'ou=groups,' + BASE_DN
+N_USERS = 4800
+N_GROUPS = 250
+
+
+def user_dn(i):
+    return 'uid=user{0},{1}'.format(i, USER_DN)
+
+
+def group_dn(i):
+    return 'cn=group{0},{1}'.format(i, GROUP_DN)
+
+
+def primary_gid(i):
+    return 10000 + i % N_GROUPS
+
+
+def auxiliary_gids(i):
+    # Even groups list members by name (RFC 2307), odd ones by DN (RFC 2307bis)
+    return sorted({10000 + (i * 7) % N_GROUPS, 10000 + (i * 13 + 1) % N_GROUPS} - {primary_gid(i)})
+
+
+def seed(conn):
+    members = {}
+    for i in range(N_USERS):
+        for gid in auxiliary_gids(i):
+            members.setdefault(gid, []).append(i)
+
+        conn.strategy.add_entry(user_dn(i), {
+            'objectClass': ['top', 'posixAccount', 'inetOrgPerson'],
+            'uid': 'user{0}'.format(i),
+            'cn': 'User {0}'.format(i),
+            'sn': 'User',
+            'uidNumber': 20000 + i,
+            'gidNumber': primary_gid(i),
+            'homeDirectory': '/home/user{0}'.format(i)
+        })
+
+    for gid in range(10000, 10000 + N_GROUPS):
+        attrs = {
+            'objectClass': ['top', 'posixGroup'],
+            'cn': 'group{0}'.format(gid - 10000),
+            'gidNumber': gid
+        }
+
+        if gid % 2:
+            attrs['member'] = [user_dn(i) for i in members.get(gid, [])]
+        else:
+            attrs['memberUid'] = ['user{0}'.format(i) for i in members.get(gid, [])]
+
+        conn.strategy.add_entry(group_dn(gid - 10000), attrs)
+
+
+class TestLDAPPlugin(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        server = ldap3.Server('fake', get_info=ldap3.OFFLINE_SLAPD_2_4)
+        cls.conn = ldap3.Connection(
+            server,
+            user='cn=admin,' + BASE_DN,
+            password='secret',
+            client_strategy=ldap3.MOCK_SYNC
+        )
+
+        cls.conn.strategy.add_entry('cn=admin,' + BASE_DN, {'userPassword': 'secret', 'sn': 'admin'})
+        seed(cls.conn)
+        cls.conn.bind()
+
+    def setUp(self):
+        with mock.patch.object(Plugin, 'bind'):
+            self.plugin = Plugin(mock.Mock())
+
+        self.plugin.conn = self.conn
+        self.plugin.parameters = {'base_dn': BASE_DN}
+        self.plugin.base_dn = BASE_DN
+        self.plugin.user_dn = USER_DN
+        self.plugin.group_dn = GROUP_DN
+        self.search = mock.patch.object(self.conn, 'search', wraps=self.conn.search).start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def group_ids(self, gids):
+        return {self.plugin.get_id({'gidNumber': gid}) for gid in gids}
+
+    def assertUser(self, user, i):
+        self.assertEqual(user['username'], 'user{0}'.format(i))
+        self.assertEqual(user['uid'], 20000 + i)
+        self.assertEqual(user['group'], self.plugin.get_id({'gidNumber': primary_gid(i)}))
+        self.assertEqual(set(user['groups']), self.group_ids(auxiliary_gids(i)))
+        self.assertEqual(len(user['groups']), len(auxiliary_gids(i)))
+
+    def test_getpwent(self):
+        users = list(self.plugin.getpwent())
+        self.assertEqual(len(users), N_USERS)
+        for user in users:
+            self.assertUser(user, user['uid'] - 20000)
+
+        # One search per page of users and groups, no per-user group searches
+        pages = -(-N_USERS // LDAPPlugin.PAGE_SIZE) + -(-N_GROUPS // LDAPPlugin.PAGE_SIZE)
+        self.assertEqual(self.search.call_count, pages)
+        for call in self.search.call_args_list:
+            self.assertEqual(call[1]['paged_size'], LDAPPlugin.PAGE_SIZE)
+
+    def test_getpwent_streaming(self):
+        # Only the group index and first page of users get fetched before first user comes out
+        user = next(self.plugin.getpwent())
+        self.assertUser(user, user['uid'] - 20000)
+        self.assertEqual(self.search.call_count, 2)
+
+    def test_getgrent(self):
+        groups = list(self.plugin.getgrent())
+        self.assertEqual(sorted(g['gid'] for g in groups), list(range(10000, 10000 + N_GROUPS)))
+        self.assertEqual(self.search.call_count, 1)
+
+    def test_lookups(self):
+        self.assertUser(self.plugin.getpwnam('user42'), 42)
+        self.assertEqual(self.search.call_count, 2)
+        self.assertUser(self.plugin.getpwuid(20043), 43)
+        self.assertIsNone(self.plugin.getpwnam('nobody'))
+        self.assertIsNone(self.plugin.getpwuid(1))
+        self.assertEqual(self.plugin.getgrgid(10005)['name'], 'group5')
+        self.assertIsNone(self.plugin.getgrnam('nogroup'))
+
+
+if __name__ == '__main__':
+    unittest.main()
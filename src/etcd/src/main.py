@@ -34,7 +34,8 @@ import json
 import errno
 import datastore
 import time
-import imp
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import renderers
 from bsd import setproctitle
 from datastore.config import ConfigStore
@@ -46,6 +47,7 @@ from freenas.serviced import checkin
 
 
 DEFAULT_CONFIGFILE = '/usr/local/etc/middleware.conf'
+RENDER_WORKERS = 8
 TEMPLATE_RENDERERS = {
     '.mako': renderers.MakoTemplateRenderer,
     '.py': renderers.PythonRenderer,
@@ -53,6 +55,84 @@ TEMPLATE_RENDERERS = {
 }
 
 
+def write_file(path, text):
+    """
+    Atomically replaces contents of file at `path` with `text`, unless it
+    already has that contents. Returns whether the file was written.
+    """
+    data = text.encode('utf-8')
+    try:
+        st = os.stat(path)
+        if st.st_size == len(data):
+            with open(path, 'rb') as fd:
+                if fd.read() == data:
+                    return False
+    except FileNotFoundError:
+        st = None
+
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.{0}.'.format(os.path.basename(path)))
+    try:
+        with open(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if st:
+            os.chmod(tmppath, st.st_mode & 0o7777)
+            os.chown(tmppath, st.st_uid, st.st_gid)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmppath, 0o666 & ~umask)
+
+        os.rename(tmppath, path)
+    except:
+        os.unlink(tmppath)
+        raise
+
+    return True
+
+
+class RenderPlan(object):
+    """
+    Files and plugins reachable from a set of groups, with nested groups
+    flattened and each file, plugin and group visited only once. Order of
+    first appearance is kept.
+    """
+    def __init__(self, datastore):
+        self.datastore = datastore
+        self.groups = []
+        self.files = []
+        self.plugins = []
+
+    def add_file(self, name):
+        if name not in self.files:
+            self.files.append(name)
+
+    def add_plugin(self, name):
+        if name not in self.plugins:
+            self.plugins.append(name)
+
+    def add_group(self, name):
+        if name in self.groups:
+            return
+
+        group = self.datastore.get_one('etcd.groups', ('name', '=', name))
+        if not group:
+            raise RpcException(errno.ENOENT, 'Group {0} not found'.format(name))
+
+        self.groups.append(name)
+        for i in group['dependencies']:
+            typ, fname = i.split(':')
+
+            if typ == 'file':
+                self.add_file(fname)
+            elif typ == 'plugin':
+                self.add_plugin(fname)
+            elif typ == 'group':
+                self.add_group(fname)
+
+
 class ManagementService(RpcService):
     def __init__(self, ctx):
         self.context = ctx
@@ -71,60 +151,113 @@ class FileGenerationService(RpcService):
         self.datastore = ctx.datastore
 
     def generate_all(self):
+        plan = RenderPlan(self.datastore)
         for group in self.datastore.query('etcd.groups'):
-            self.generate_group(group['name'])
+            plan.add_group(group['name'])
 
-    def generate_file(self, filename):
-        if filename not in self.context.managed_files.keys():
-            return
+        return self.execute(plan)
 
-        text = self.context.generate_file(filename)
-        filepath = os.path.join(self.context.root, filename)
-        try:
-            with open(filepath, 'w', encoding='utf-8') as fd:
-                fd.write(text)
-        except FileNotFoundError as e:
-            self.context.logger.error('Failed to open {0}: {1}'.format(filepath, e), exc_info=True)
-            return
-
-        self.context.emit_event('etcd.file_generated', {
-            'filename': filepath,
-        })
+    def generate_file(self, filename):
+        plan = RenderPlan(self.datastore)
+        plan.add_file(filename)
+        return self.execute(plan)
 
     def generate_plugin(self, name):
         if name not in self.context.managed_files.keys():
-            return
+            return False
 
+        pname = os.path.basename(name)
         try:
-            pname = os.path.basename(name)
-            plugin = imp.load_source(pname, self.context.managed_files[name])
+            plugin = self.context.renderers['.py'].load_plugin(self.context.managed_files[name])
         except:
             self.context.logger.error('Invalid plugin source file: {0}'.format(name), exc_info=True)
-            return
+            return False
 
         if not hasattr(plugin, 'run'):
             self.context.logger.error('Invalid plugin source {0}, no run method'.format(pname))
-            return
+            return False
 
         try:
             plugin.run(self.context)
         except Exception as err:
             self.context.logger.error('Cannot run plugin {0}: {1}'.format(name, str(err)), exc_info=True)
+            return False
+
+        return True
 
     def generate_group(self, name):
-        group = self.datastore.get_one('etcd.groups', ('name', '=', name))
-        if not group:
-            raise RpcException(errno.ENOENT, 'Group {0} not found'.format(name))
+        plan = RenderPlan(self.datastore)
+        plan.add_group(name)
+        return self.execute(plan)
 
-        for i in group['dependencies']:
-            typ, fname = i.split(':')
+    def render_file(self, filename):
+        filepath = os.path.join(self.context.root, filename)
+        try:
+            text = self.context.render_file(filename)
+        except Exception as e:
+            self.context.logger.warn('Cannot generate file {0}: {1}'.format(filename, str(e)))
+            text = "# FILE GENERATION FAILED: {0}\n".format(str(e))
+            failed = True
+        else:
+            failed = False
 
-            if typ == 'file':
-                self.generate_file(fname)
-            elif typ == 'plugin':
-                self.generate_plugin(fname)
-            elif typ == 'group':
-                self.generate_group(fname)
+        try:
+            if not write_file(filepath, text):
+                return filepath, 'failed' if failed else 'unchanged'
+        except FileNotFoundError as e:
+            self.context.logger.error('Failed to open {0}: {1}'.format(filepath, e), exc_info=True)
+            return filepath, 'failed'
+
+        self.context.emit_event('etcd.file_generated', {
+            'filename': filepath,
+        })
+
+        return filepath, 'failed' if failed else 'generated'
+
+    def timed(self, fn, *args):
+        started_at = time.monotonic()
+        return fn(*args), time.monotonic() - started_at
+
+    def execute(self, plan):
+        """
+        Renders all files of the plan concurrently, then runs its plugins
+        one by one, since those may act on the generated files. Returns
+        paths of generated, unchanged and failed files together with names
+        of plugins run and time spent on each of them.
+        """
+        started_at = time.monotonic()
+        result = {
+            'generated': [],
+            'unchanged': [],
+            'failed': [],
+            'plugins': [],
+            'timings': {},
+            'elapsed': 0
+        }
+
+        files = [f for f in plan.files if f in self.context.managed_files]
+        for (filepath, status), elapsed in self.context.render_executor.map(lambda f: self.timed(self.render_file, f), files):
+            result[status].append(filepath)
+            result['timings'][filepath] = elapsed
+
+        for name in plan.plugins:
+            if name not in self.context.managed_files:
+                continue
+
+            ok, elapsed = self.timed(self.generate_plugin, name)
+            result['plugins' if ok else 'failed'].append(name)
+            result['timings'][name] = elapsed
+
+        result['elapsed'] = time.monotonic() - started_at
+        self.context.logger.debug('Generated {0}: {1} changed, {2} unchanged, {3} failed in {4:.2f}s'.format(
+            ', '.join(plan.groups) or ', '.join(plan.files),
+            len(result['generated']),
+            len(result['unchanged']),
+            len(result['failed']),
+            result['elapsed']
+        ))
+
+        return result
 
     def get_managed_files(self):
         return self.context.managed_files
@@ -146,6 +279,7 @@ class Main(object):
         self.plugin_dirs = []
         self.renderers = {}
         self.managed_files = {}
+        self.render_executor = ThreadPoolExecutor(RENDER_WORKERS)
 
     def init_datastore(self):
         try:
@@ -220,7 +354,7 @@ class Main(object):
                     self.managed_files[name] = abspath
                     self.logger.info('Adding managed file %s [%s]', name, ext)
 
-    def generate_file(self, file_path):
+    def render_file(self, file_path):
         if file_path not in self.managed_files.keys():
             raise RpcException(errno.ENOENT, 'No such file')
 
@@ -229,12 +363,7 @@ class Main(object):
         if ext not in self.renderers.keys():
             raise RuntimeError("Can't find renderer for {0}".format(file_path))
 
-        renderer = self.renderers[ext]
-        try:
-            return renderer.render_template(template_path)
-        except Exception as e:
-            self.logger.warn('Cannot generate file {0}: {1}'.format(file_path, str(e)))
-            return "# FILE GENERATION FAILED: {0}\n".format(str(e))
+        return self.renderers[ext].render_template(template_path)
 
     def emit_event(self, name, params):
         self.client.emit_event(name, params)
@@ -26,11 +26,51 @@
 #####################################################################
 
 
+import hashlib
+import os
+import threading
+import types
 from mako import exceptions
 from mako.template import Template
 from datastore.config import ConfigStore
 
 
+class SourceCache(object):
+    """
+    Keeps objects built from source files by `loader` until the file
+    changes. Modification time and size are checked on every access; the
+    object is rebuilt only if the contents hash changed as well.
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+
+    def get(self, path):
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry[0] == stamp:
+                self.hits += 1
+                return entry[2]
+
+        with open(path, 'rb') as f:
+            source = f.read()
+
+        digest = hashlib.sha256(source).digest()
+        loaded = not entry or entry[1] != digest
+        obj = self.loader(path, source) if loaded else entry[2]
+
+        with self.lock:
+            self.loads += loaded
+            self.entries[path] = (stamp, digest, obj)
+
+        return obj
+
+
 class TemplateFunctions:
     @staticmethod
     def disclaimer(comment_style='#'):
@@ -40,6 +80,7 @@ class TemplateFunctions:
 class MakoTemplateRenderer(object):
     def __init__(self, context):
         self.context = context
+        self.templates = SourceCache(lambda path, source: Template(text=source.decode('utf-8'), filename=path))
 
     def get_template_context(self):
         return {
@@ -51,7 +92,7 @@ class MakoTemplateRenderer(object):
 
     def render_template(self, path):
         try:
-            tmpl = Template(filename=path)
+            tmpl = self.templates.get(path)
             return tmpl.render(**self.get_template_context())
         except:
             self.context.logger.debug('Failed to render mako template: {0}'.format(
@@ -63,6 +104,19 @@ class MakoTemplateRenderer(object):
 class PythonRenderer(object):
     def __init__(self, context):
         self.context = context
+        self.modules = SourceCache(self.load_module)
+
+    @staticmethod
+    def load_module(path, source):
+        # Plugins are kept out of sys.modules, their names are not unique
+        name = os.path.splitext(os.path.basename(path))[0]
+        module = types.ModuleType(name)
+        module.__file__ = path
+        exec(compile(source, path, 'exec'), module.__dict__)
+        return module
+
+    def load_plugin(self, path):
+        return self.modules.get(path)
 
 
 class ShellTemplateRenderer(object):
@@ -88,21 +88,29 @@ class LoggingService(RpcService):
             self.context.cv.notify_all()
 
     def push(self, entry):
+        self.push_many([entry])
+
+    def push_many(self, entries):
         creds = get_sender().credentials
-        if creds:
-            entry['pid'] = creds['pid']
-            entry['uid'] = creds['uid']
-            entry['gid'] = creds['gid']
+        identifiers = {}
+        for entry in entries:
+            if creds:
+                entry['pid'] = creds['pid']
+                entry['uid'] = creds['uid']
+                entry['gid'] = creds['gid']
+
+            if 'identifier' not in entry:
+                pid = entry['pid']
+                if pid not in identifiers:
+                    try:
+                        identifiers[pid] = kinfo_getproc(pid).command
+                    except OSError:
+                        identifiers[pid] = 'unknown'
 
-        if 'identifier' not in entry:
-            try:
-                proc = kinfo_getproc(entry['pid'])
-                entry['identifier'] = proc.command
-            except OSError:
-                entry['identifier'] = 'unknown'
+                entry['identifier'] = identifiers[pid]
 
-        entry['source'] = 'rpc'
-        self.context.push(entry)
+            entry['source'] = 'rpc'
+            self.context.push(entry)
 
     @generator
     def query_boots(self, filter=None, params=None):
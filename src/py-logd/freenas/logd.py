@@ -27,8 +27,12 @@
 
 import os
 import sys
+import enum
+import time
 import logging
+import threading
 import traceback
+import collections
 from datetime import datetime
 from freenas.dispatcher.client import Client
 
@@ -41,40 +45,214 @@ PRIORITY_MAP = {
     logging.CRITICAL: 'CRIT'
 }
 
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+FLUSH_TIMEOUT = 10
+
+
+class OverflowPolicy(enum.Enum):
+    DROP_OLDEST = 'DROP_OLDEST'
+    DROP_NEWEST = 'DROP_NEWEST'
+    BLOCK = 'BLOCK'
+
+
+class BufferedRecord(object):
+    __slots__ = ('created', 'levelno', 'message', 'thread_name', 'thread', 'name', 'pathname', 'lineno', 'exception', 'repeats')
+
+    def __init__(self, record):
+        self.created = record.created
+        self.levelno = record.levelno
+        self.message = record.getMessage()
+        self.thread_name = record.threadName
+        self.thread = record.thread
+        self.name = record.name
+        self.pathname = record.pathname
+        self.lineno = record.lineno
+        self.exception = ''.join(traceback.format_exception(*record.exc_info)) if record.exc_info else None
+        self.repeats = 0
+
+    def same_as(self, other):
+        return \
+            self.exception is None and \
+            other.exception is None and \
+            self.message == other.message and \
+            self.levelno == other.levelno and \
+            self.pathname == other.pathname and \
+            self.lineno == other.lineno
+
 
 class LogdLogHandler(logging.Handler):
-    def __init__(self, level=logging.NOTSET, address=None, ident=None):
+    def __init__(
+        self, level=logging.NOTSET, address=None, ident=None, queue_size=QUEUE_SIZE,
+        batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, overflow=OverflowPolicy.DROP_OLDEST
+    ):
         super(LogdLogHandler, self).__init__(level)
         self.address = address or 'unix:///var/run/logd.sock'
         self.ident = ident or os.path.basename(sys.executable)
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.buffer = collections.deque()
+        self.cv = threading.Condition()
+        self.pending = 0
+        self.flushing = False
+        self.closing = False
+        self.dropped = 0
+        self.coalesced = 0
+        self.reported_dropped = 0
+        self.reported_coalesced = 0
         self.client = Client()
         self.client.connect(self.address)
+        self.thread = threading.Thread(target=self.drain, name='LogdLogHandler', daemon=True)
+        self.thread.start()
 
     def emit(self, record):
         try:
-            if not self.client.connected:
-                self.client.connect(self.address)
-
-            item = {
-                'timestamp': datetime.utcfromtimestamp(record.created),
-                'priority': PRIORITY_MAP.get(record.levelno, 'INFO'),
-                'message': record.getMessage(),
-                'identifier': self.ident,
-                'thread': record.threadName,
-                'tid': record.thread,
-                'module_name': record.name,
-                'source_language': 'python',
-                'source_file': record.pathname,
-                'source_line': record.lineno,
-            }
+            item = BufferedRecord(record)
+            with self.cv:
+                if self.closing:
+                    return
 
-            if record.exc_info:
-                item['exception'] = ''.join(traceback.format_exception(*record.exc_info))
+                if self.buffer and self.buffer[-1].same_as(item):
+                    self.buffer[-1].repeats += 1
+                    self.coalesced += 1
+                    return
 
-            self.client.call_async('logd.logging.push', None, item)
+                if len(self.buffer) >= self.queue_size:
+                    if not self.make_room():
+                        self.dropped += 1
+                        return
+
+                self.buffer.append(item)
+                if len(self.buffer) >= self.batch_size:
+                    self.cv.notify_all()
         except:
             self.handleError(record)
 
+    def make_room(self):
+        # Must run locked
+        if self.overflow == OverflowPolicy.DROP_OLDEST:
+            self.buffer.popleft()
+            self.dropped += 1
+            return True
+
+        if self.overflow == OverflowPolicy.BLOCK and threading.current_thread() is not self.thread:
+            return self.cv.wait_for(lambda: len(self.buffer) < self.queue_size or self.closing, FLUSH_TIMEOUT) \
+                and not self.closing
+
+        return False
+
+    def drain(self):
+        while True:
+            with self.cv:
+                self.cv.wait_for(
+                    lambda: len(self.buffer) >= self.batch_size or self.flushing or self.closing,
+                    self.flush_interval
+                )
+
+                batch = [self.buffer.popleft() for _ in range(min(len(self.buffer), self.batch_size))]
+                self.pending = len(batch)
+                closing = self.closing
+                report = self.report()
+                self.cv.notify_all()
+
+            try:
+                items = [self.make_item(i) for i in batch]
+                if report:
+                    items.append(report)
+
+                if items:
+                    if not self.client.connected:
+                        self.client.connect(self.address)
+
+                    self.client.call_async('logd.logging.push_many', None, items)
+            except:
+                # Nowhere to log that, records are lost
+                pass
+
+            with self.cv:
+                self.pending = 0
+                if not self.buffer:
+                    self.flushing = False
+
+                self.cv.notify_all()
+                if closing and not self.buffer:
+                    return
+
+    def report(self):
+        # Must run locked
+        dropped = self.dropped - self.reported_dropped
+        coalesced = self.coalesced - self.reported_coalesced
+        if not dropped:
+            return None
+
+        self.reported_dropped = self.dropped
+        self.reported_coalesced = self.coalesced
+        return {
+            'timestamp': datetime.utcnow(),
+            'priority': 'WARNING',
+            'message': 'Log buffer overflow: {0} records dropped, {1} coalesced'.format(dropped, coalesced),
+            'identifier': self.ident,
+            'module_name': __name__,
+            'source_language': 'python'
+        }
+
+    def make_item(self, record):
+        message = record.message
+        if record.repeats:
+            message = '{0} (repeated {1} times)'.format(message, record.repeats + 1)
+
+        item = {
+            'timestamp': datetime.utcfromtimestamp(record.created),
+            'priority': PRIORITY_MAP.get(record.levelno, 'INFO'),
+            'message': message,
+            'identifier': self.ident,
+            'thread': record.thread_name,
+            'tid': record.thread,
+            'module_name': record.name,
+            'source_language': 'python',
+            'source_file': record.pathname,
+            'source_line': record.lineno,
+        }
+
+        if record.exception:
+            item['exception'] = record.exception
+
+        return item
+
+    @property
+    def stats(self):
+        with self.cv:
+            return {
+                'queued': len(self.buffer),
+                'dropped': self.dropped,
+                'coalesced': self.coalesced
+            }
+
+    def flush(self):
+        if threading.current_thread() is self.thread:
+            return
+
+        deadline = time.monotonic() + FLUSH_TIMEOUT
+        with self.cv:
+            while self.buffer or self.pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                self.flushing = True
+                self.cv.notify_all()
+                self.cv.wait(remaining)
+
     def close(self):
+        with self.cv:
+            self.closing = True
+            self.cv.notify_all()
+
+        if self.thread.is_alive() and threading.current_thread() is not self.thread:
+            self.thread.join(FLUSH_TIMEOUT)
+
         super(LogdLogHandler, self).close()
         self.client.disconnect()
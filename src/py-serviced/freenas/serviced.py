@@ -25,64 +25,198 @@
 #
 #####################################################################
 
+import os
+import time
+import errno
 from threading import Lock
-from freenas.dispatcher.client import Client
+from freenas.dispatcher.client import Client, ClientError
 from freenas.dispatcher.rpc import RpcException
 
 
 SERVICED_SOCKET = 'unix:///var/run/serviced.sock'
-_client = Client()
+NEGATIVE_CACHE_TTL = 5
+_client = None
+_client_pid = None
+_subscribed = False
+_event_callback = None
 _lock = Lock()
+_cache = {}
+_cache_lock = Lock()
 
 
 class ServicedException(RpcException):
     pass
 
 
-def checkin():
+def _on_event(name, args):
+    if name.startswith('serviced.job.'):
+        _invalidate(name, args)
+
+    callback = _event_callback
+    if callback:
+        callback(name, args)
+
+
+def _on_error(reason, **kwargs):
+    if reason in (ClientError.CONNECTION_CLOSED, ClientError.LOGOUT):
+        # Events might have been missed while disconnected
+        _flush_cache()
+
+
+def _invalidate(name, args):
+    job_id = args.get('ID')
+    pid = args.get('PID')
+    with _cache_lock:
+        for key, (job, timestamp) in list(_cache.items()):
+            if job is None:
+                # A newly started job might own a pid we have seen before
+                if name == 'serviced.job.started' or key[0] == pid:
+                    del _cache[key]
+                continue
+
+            if job['ID'] == job_id or (pid is not None and key[0] == pid):
+                del _cache[key]
+
+
+def _flush_cache():
+    with _cache_lock:
+        _cache.clear()
+
+
+def _cache_get(pid, fuzzy):
+    with _cache_lock:
+        entry = _cache.get((pid, fuzzy))
+        if not entry:
+            return False, None
+
+        job, timestamp = entry
+        if job is None and time.monotonic() - timestamp > NEGATIVE_CACHE_TTL:
+            del _cache[(pid, fuzzy)]
+            return False, None
+
+        return True, job
+
+
+def _cache_put(pid, fuzzy, job):
+    with _cache_lock:
+        _cache[(pid, fuzzy)] = (job, time.monotonic())
+
+
+def _get_client():
+    # Must run locked
+    global _client, _client_pid, _subscribed
+
+    if _client and _client.connected and _client_pid == os.getpid():
+        return _client
+
+    if _client and _client_pid == os.getpid():
+        _client.disconnect()
+
+    # After fork() the parent's connection cannot be shared, since serviced
+    # identifies the calling job by the peer credentials of the socket
+    _flush_cache()
+    _client = Client()
+    _client.on_error(_on_error)
+    _client.on_event(_on_event)
+    _client.connect(SERVICED_SOCKET)
+    _client_pid = os.getpid()
+    _subscribed = False
+    return _client
+
+
+def _get_subscribed_client():
+    # Must run locked
+    global _subscribed
+
+    client = _get_client()
+    if not _subscribed:
+        client.subscribe_events('serviced.*')
+        _subscribed = True
+
+    return client
+
+
+def _call(method, *args, subscribe=False):
     with _lock:
-        try:
-            _client.connect(SERVICED_SOCKET)
-            return _client.call_sync('serviced.job.checkin')
-        except RpcException as err:
-            raise ServicedException(err.code, err.message, err.extra)
-        finally:
-            _client.disconnect()
+        for attempt in range(2):
+            try:
+                client = _get_subscribed_client() if subscribe else _get_client()
+                return client.call_sync(method, *args)
+            except RpcException as err:
+                raise ServicedException(err.code, err.message, err.extra)
+            except OSError:
+                # Stale connection, try once more with a fresh one
+                if _client:
+                    _client.disconnect()
+
+                if attempt:
+                    raise
+
+
+def checkin():
+    return _call('serviced.job.checkin')
 
 
 def push_status(status):
-    with _lock:
-        try:
-            _client.connect(SERVICED_SOCKET)
-            return _client.call_sync('serviced.job.push_status', status)
-        except RpcException as err:
-            raise ServicedException(err.code, err.message, err.extra)
-        finally:
-            _client.disconnect()
+    return _call('serviced.job.push_status', status)
 
 
 def subscribe(callback):
+    global _event_callback
+
     with _lock:
         try:
-            _client.connect(SERVICED_SOCKET)
-            _client.subscribe_events('serviced.*')
-            _client.on_event(callback)
+            _event_callback = callback
+            _get_subscribed_client()
         except RpcException as err:
             raise ServicedException(err.code, err.message, err.extra)
 
 
 def get_job_by_pid(pid, fuzzy=False):
-    with _lock:
+    found, job = _cache_get(pid, fuzzy)
+    if not found:
         try:
-            _client.connect(SERVICED_SOCKET)
-            return _client.call_sync('serviced.job.get_by_pid', pid, fuzzy)
-        except RpcException as err:
-            raise ServicedException(err.code, err.message, err.extra)
-        finally:
-            _client.disconnect()
+            job = _call('serviced.job.get_by_pid', pid, fuzzy, subscribe=True)
+        except ServicedException as err:
+            if err.code != errno.ENOENT:
+                raise
+
+            job = None
+
+        _cache_put(pid, fuzzy, job)
+
+    if job is None:
+        raise ServicedException(errno.ENOENT, 'Job for PID {0} not found'.format(pid))
+
+    return dict(job)
+
+
+def get_jobs_by_pids(pids, fuzzy=False):
+    result = {}
+    missing = []
+    for pid in pids:
+        found, job = _cache_get(pid, fuzzy)
+        if found:
+            result[pid] = job
+        else:
+            missing.append(pid)
+
+    if missing:
+        jobs = _call('serviced.job.get_by_pids', missing, fuzzy, subscribe=True)
+        for pid, job in zip(missing, jobs):
+            _cache_put(pid, fuzzy, job)
+            result[pid] = job
+
+    return {pid: dict(job) if job else None for pid, job in result.items()}
 
 
 def unsubscribe():
+    global _event_callback, _subscribed
+
     with _lock:
-        _client.on_event = None
-        _client.disconnect()
+        _event_callback = None
+        if _client:
+            _client.disconnect()
+
+        _subscribed = False
+        _flush_cache()
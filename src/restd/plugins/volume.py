@@ -1,14 +1,18 @@
 from base import CRUDBase, ItemResource, Resource
 
 
+# Space usage of volumes, datasets and snapshots changes without change events
+
 class DatasetCRUD(CRUDBase):
     name = 'dataset'
     namespace = 'volume.dataset'
+    cacheable = False
 
 
 class SnapshotCRUD(CRUDBase):
     name = 'snapshot'
     namespace = 'volume.snapshot'
+    cacheable = False
 
     def get_update_method_name(self):
         return None
@@ -28,6 +32,7 @@ class VolumeItemResource(ItemResource):
 
 class VolumeCRUD(CRUDBase):
     namespace = 'volume'
+    cacheable = False
     item_class = VolumeItemResource
     item_resources = (
         VolumeUpgradeResource,
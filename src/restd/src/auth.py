@@ -0,0 +1,269 @@
+import binascii
+import errno
+import hashlib
+import hmac
+import os
+import time
+
+from freenas.dispatcher.rpc import RpcException
+
+
+CREDENTIAL_TTL = 60
+CREDENTIAL_HASH_ROUNDS = 1000
+SESSION_TTL = 600
+SESSION_MAX_AGE = 3600
+ACCOUNT_CHECK_INTERVAL = 10
+MAX_SESSIONS_PER_USER = 64
+MAX_IDLE_CONNECTIONS = 8
+IDLE_TIMEOUT = 300
+
+
+class CredentialCache(object):
+    """
+    Remembers recently verified passwords as salted hashes, so that repeated
+    requests with the same credentials skip password verification in the
+    dispatcher. Plain text passwords are never kept.
+    """
+    def __init__(self, ttl=CREDENTIAL_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def hash(password, salt):
+        return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, CREDENTIAL_HASH_ROUNDS)
+
+    def check(self, username, password):
+        entry = self.entries.get(username)
+        if entry:
+            salt, digest, expires_at = entry
+            if expires_at > time.monotonic() and hmac.compare_digest(digest, self.hash(password, salt)):
+                self.hits += 1
+                return True
+
+        self.misses += 1
+        return False
+
+    def put(self, username, password):
+        if self.ttl <= 0:
+            return
+
+        salt = os.urandom(16)
+        self.entries[username] = (salt, self.hash(password, salt), time.monotonic() + self.ttl)
+
+    def invalidate(self, username=None):
+        if username:
+            self.entries.pop(username, None)
+            return
+
+        self.entries.clear()
+
+
+class SessionStore(object):
+    """
+    Opaque session tokens handed out to clients after successful password
+    authentication. Sessions are renewed on every use and expire after
+    `ttl` seconds of inactivity, but never live longer than `max_age`
+    seconds, after which the password has to be verified again.
+
+    Every password login gets a token of its own, so that a single one can
+    be revoked without logging out other clients of the same user. Only the
+    newest `max_per_user` sessions of a user are kept.
+    """
+    def __init__(self, ttl=SESSION_TTL, max_age=SESSION_MAX_AGE, max_per_user=MAX_SESSIONS_PER_USER):
+        self.ttl = ttl
+        self.max_age = max_age
+        self.max_per_user = max_per_user
+        self.sessions = {}
+        self.by_user = {}
+
+    def issue(self, username):
+        now = time.monotonic()
+        tokens = self.by_user.setdefault(username, [])
+        for i in [t for t in tokens if self.sessions[t][1] <= now]:
+            self.revoke_token(i)
+
+        while len(tokens) >= self.max_per_user:
+            self.revoke_token(tokens[0])
+
+        token = binascii.hexlify(os.urandom(32)).decode('ascii')
+        self.sessions[token] = (username, now + self.ttl, now + self.max_age)
+        self.by_user.setdefault(username, []).append(token)
+        return token
+
+    def lookup(self, token):
+        session = self.sessions.get(token)
+        if not session:
+            return None
+
+        username, expires_at, max_expires_at = session
+        now = time.monotonic()
+        if expires_at <= now:
+            self.revoke_token(token)
+            return None
+
+        self.sessions[token] = (username, min(now + self.ttl, max_expires_at), max_expires_at)
+        return username
+
+    def revoke_token(self, token):
+        username, _, _ = self.sessions.pop(token, (None, None, None))
+        tokens = self.by_user.get(username)
+        if tokens is None:
+            return
+
+        tokens.remove(token)
+        if not tokens:
+            del self.by_user[username]
+
+    def revoke(self, username=None):
+        for token, (user, _, _) in list(self.sessions.items()):
+            if username is None or user == username:
+                self.revoke_token(token)
+
+
+class ConnectionPool(object):
+    """
+    Idle dispatcher connections, already logged in, keyed by the user they
+    are logged in as.
+    """
+    def __init__(self, max_idle=MAX_IDLE_CONNECTIONS, idle_timeout=IDLE_TIMEOUT):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+
+    def acquire(self, username):
+        idle = self.idle.get(username)
+        while idle:
+            client, released_at = idle.pop()
+            if client.connected and released_at + self.idle_timeout > time.monotonic():
+                return client
+
+            client.disconnect()
+
+        return None
+
+    def release(self, username, client):
+        if not client.connected:
+            return
+
+        idle = self.idle.setdefault(username, [])
+        if len(idle) >= self.max_idle:
+            client.disconnect()
+            return
+
+        idle.append((client, time.monotonic()))
+
+    def clear(self, username=None):
+        for user in list(self.idle):
+            if username is None or user == username:
+                for client, _ in self.idle.pop(user):
+                    client.disconnect()
+
+    def __len__(self):
+        return sum(len(i) for i in self.idle.values())
+
+
+class Authenticator(object):
+    """
+    Hands out dispatcher connections logged in as the requesting user.
+
+    Passwords get verified by the dispatcher only when not found in the
+    credential cache. Once a user has been authenticated, new connections
+    for it log in over the local socket without password check and are
+    pooled for subsequent requests. `setup` gets called for every newly
+    logged in connection.
+
+    Such logins are not noticed by directory services, so before handing
+    one out the account is looked up again with `lookup_account` (at most
+    once per `check_interval` seconds per user). Accounts which are gone,
+    locked or have password login disabled lose their cached credentials,
+    sessions and pooled connections.
+    """
+    def __init__(self, client_factory, credential_ttl=CREDENTIAL_TTL, session_ttl=SESSION_TTL,
+                 session_max_age=SESSION_MAX_AGE, setup=None, lookup_account=None,
+                 check_interval=ACCOUNT_CHECK_INTERVAL):
+        self.client_factory = client_factory
+        self.setup = setup
+        self.lookup_account = lookup_account
+        self.check_interval = check_interval
+        self.credentials = CredentialCache(credential_ttl)
+        self.sessions = SessionStore(session_ttl, session_max_age)
+        self.pool = ConnectionPool()
+        self.verified = {}
+
+    def login_password(self, username, password):
+        if self.credentials.check(username, password):
+            return self.connect(username)
+
+        client = self.client_factory()
+        try:
+            client.login_user(username, password, check_password=True)
+            if self.setup:
+                self.setup(client)
+        except:
+            client.disconnect()
+            raise
+
+        self.credentials.put(username, password)
+        return client
+
+    def login_token(self, token):
+        username = self.sessions.lookup(token)
+        if not username:
+            raise RpcException(errno.EACCES, 'Invalid or expired session token')
+
+        return username, self.connect(username)
+
+    def verify(self, username):
+        if not self.lookup_account:
+            return
+
+        now = time.monotonic()
+        verified_at = self.verified.get(username)
+        if verified_at and verified_at + self.check_interval > now:
+            return
+
+        try:
+            account = self.lookup_account(username)
+        except RpcException as err:
+            if err.code != errno.ENOENT:
+                raise
+
+            account = None
+
+        if not account or account.get('locked') or account.get('password_disabled'):
+            self.invalidate(username)
+            raise RpcException(errno.EACCES, 'User {0} is no longer allowed to log in'.format(username))
+
+        self.verified[username] = now
+
+    def connect(self, username):
+        self.verify(username)
+        client = self.pool.acquire(username)
+        if client:
+            return client
+
+        client = self.client_factory()
+        try:
+            client.login_user(username, '', check_password=False)
+            if self.setup:
+                self.setup(client)
+        except:
+            client.disconnect()
+            raise
+
+        return client
+
+    def release(self, username, client):
+        self.pool.release(username, client)
+
+    def invalidate(self, username=None):
+        if username:
+            self.verified.pop(username, None)
+        else:
+            self.verified.clear()
+
+        self.credentials.invalidate(username)
+        self.sessions.revoke(username)
+        self.pool.clear(username)
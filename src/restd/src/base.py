@@ -1,9 +1,13 @@
 import falcon
+import hashlib
+import itertools
+import json
 import logging
 import pprint
 
 from freenas.dispatcher.rpc import RpcException
 
+from serializers import is_stream
 from swagger import normalize_schema
 
 log = logging.getLogger('restd.base')
@@ -79,6 +83,12 @@ class RPC(object):
         log.debug('Calling RPC {0} with args {1} {2}'.format(self.name, args, urlparams))
         try:
             result = self.dispatcher.call_sync(self.name, *args, **urlparams)
+            if is_stream(result):
+                # Errors of streamed calls surface with the first item, get them before the response starts
+                result = iter(result)
+                result = itertools.chain([next(result)], result)
+        except StopIteration:
+            result = iter([])
         except RpcException as e:
             raise falcon.HTTPBadRequest(e.message, str(e))
         return result
@@ -291,10 +301,54 @@ class ResourceQueryMixin:
         return [args, urlparams], {}
 
 
+def etag_matches(header, etag):
+    if not header:
+        return False
+
+    tags = [i.strip() for i in header.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
 class EntityResource(Resource, ResourceQueryMixin):
 
+    cacheable = True
+
+    def get_etag(self, req):
+        """
+        Collection results only change together with entity-subscriber
+        generation of the queried namespace, so it is enough to identify
+        the generation, the requesting user and the query.
+
+        Namespaces without a change event, or with entities changing
+        without one (`cacheable` is False), get no ETag at all.
+        """
+        if not self.cacheable:
+            return None
+
+        if not self.get or not self.get.startswith('rpc:') or not self.get.endswith('.query'):
+            return None
+
+        generation = self.rest.get_generation(self.get[4:-6])
+        if generation is None:
+            return None
+
+        key = json.dumps([self.rest.epoch, generation, req.context.get('username'), req.relative_uri])
+        return '"{0}"'.format(hashlib.sha1(key.encode('utf-8')).hexdigest())
+
     def do(self, method, req, resp, *args, **kwargs):
+        etag = None
+        if method == 'get':
+            # Generation has to be taken before querying, changes made meanwhile will invalidate the ETag
+            etag = self.get_etag(req)
+            if etag and etag_matches(req.get_header('If-None-Match'), etag):
+                resp.set_header('ETag', etag)
+                resp.status = falcon.HTTP_304
+                return None
+
         rv = super(EntityResource, self).do(method, req, resp, *args, **kwargs)
+        if etag:
+            resp.set_header('ETag', etag)
+
         if method == 'post':
             typ, name = self._get_type_name(self.post)
             if rv and typ != 'atask':
@@ -453,6 +507,7 @@ class CRUDBase(object):
 
     name = None
     namespace = None
+    cacheable = True
 
     entity_get = None
     entity_post = None
@@ -484,6 +539,7 @@ class CRUDBase(object):
             'name': self.name or self.namespace.replace('.', '/'),
             'get': get,
             'post': post,
+            'cacheable': self.cacheable,
         })(rest)
         self.item = type('{0}ItemResource'.format(self.__class__.__name__), (self.item_class, ), {
             'get': get,
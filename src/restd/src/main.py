@@ -8,6 +8,7 @@ import importlib.machinery
 import json
 import logging
 import os
+import re
 import signal
 import sys
 import time
@@ -19,7 +20,8 @@ from freenas.serviced import checkin
 
 from gevent.pywsgi import WSGIHandler, WSGIServer
 
-from serializers import JsonEncoder
+from auth import Authenticator
+from serializers import JsonEncoder, is_stream, stream_json
 from swagger import SwaggerResource
 
 
@@ -62,37 +64,50 @@ class JSONTranslator(object):
 
     def process_response(self, req, resp, resource):
         if 'result' in req.context:
-            resp.body = JsonEncoder(indent=True).encode(req.context['result'])
+            result = req.context['result']
+            if is_stream(result):
+                resp.stream = stream_json(result, JsonEncoder(indent=True))
+                return
+
+            resp.body = JsonEncoder(indent=True).encode(result)
 
 
 class AuthMiddleware(object):
 
+    def __init__(self, authenticator):
+        self.authenticator = authenticator
+
     def process_request(self, req, resp):
         # Do not require auth to access index
         if req.relative_uri == '/':
             return
 
         auth = req.get_header("Authorization")
-        if auth is None or not auth.startswith('Basic '):
+        if auth is None or not auth.startswith(('Basic ', 'Token ')):
             raise falcon.HTTPUnauthorized(
                 'Authorization token required',
-                'Provide a Basic Authentication header',
-                ['Basic realm="FreeNAS"'],
-            )
-        try:
-            username, password = base64.b64decode(auth[6:]).decode('utf8').split(':', 1)
-        except binascii.Error:
-            raise falcon.HTTPUnauthorized(
-                'Invalid Authorization token',
-                'Provide a valid Basic Authentication header',
+                'Provide a Basic Authentication header or a session token',
                 ['Basic realm="FreeNAS"'],
             )
 
         try:
-            client = Client()
-            client.connect('unix:')
-            client.login_user(username, password, check_password=True)
+            if auth.startswith('Token '):
+                username, client = self.authenticator.login_token(auth[6:].strip())
+            else:
+                try:
+                    username, password = base64.b64decode(auth[6:]).decode('utf8').split(':', 1)
+                except (binascii.Error, UnicodeDecodeError, ValueError):
+                    raise falcon.HTTPUnauthorized(
+                        'Invalid Authorization token',
+                        'Provide a valid Basic Authentication header',
+                        ['Basic realm="FreeNAS"'],
+                    )
+
+                client = self.authenticator.login_password(username, password)
+                resp.set_header('X-Auth-Token', self.authenticator.sessions.issue(username))
+
             req.context['client'] = client
+            req.context['username'] = username
         except RpcException as e:
             if e.code == errno.EACCES:
                 raise falcon.HTTPUnauthorized(
@@ -104,7 +119,24 @@ class AuthMiddleware(object):
 
     def process_response(self, req, resp, resource):
         if 'client' in req.context:
-            req.context['client'].disconnect()
+            if resp.stream is not None:
+                # Streamed result is still being read from the connection
+                resp.stream = self.release_after(resp.stream, req.context['username'], req.context['client'])
+                return
+
+            self.authenticator.release(req.context['username'], req.context['client'])
+
+    def release_after(self, stream, username, client):
+        finished = False
+        try:
+            yield from stream
+            finished = True
+        finally:
+            if finished:
+                self.authenticator.release(username, client)
+            else:
+                # Rest of the streamed result would be left pending on the connection
+                client.disconnect()
 
 
 class RESTApi(object):
@@ -118,8 +150,16 @@ class RESTApi(object):
         self._used_schemas = set()
         self._services = {}
         self._tasks = {}
+        self.epoch = None
+        self.event_types = set()
+        self.generations = {}
+        self.authenticator = Authenticator(
+            self.create_client,
+            setup=self.setup_client,
+            lookup_account=self.lookup_account
+        )
         self.api = falcon.API(middleware=[
-            AuthMiddleware(),
+            AuthMiddleware(self.authenticator),
             JSONTranslator(),
         ])
         self.api.add_route('/', SwaggerResource(self))
@@ -132,9 +172,59 @@ class RESTApi(object):
                 self.logger.warning('Connection to dispatcher lost')
                 self.connect()
 
+        def on_account_changed(args):
+            # Cached credentials, sessions and pooled logins may be stale now
+            self.authenticator.invalidate()
+
         self.dispatcher = Client()
         self.dispatcher.on_error(on_error)
+        self.dispatcher.on_event(self.on_event)
         self.connect()
+        self.dispatcher.register_event_handler('user.changed', on_account_changed)
+        self.dispatcher.register_event_handler('group.changed', on_account_changed)
+
+    def create_client(self):
+        client = Client()
+        client.connect('unix:')
+        return client
+
+    def lookup_account(self, username):
+        return self.dispatcher.call_sync('dscached.account.getpwnam', username)
+
+    def setup_client(self, client):
+        client.call_sync('management.enable_features', ['streaming_responses'])
+
+    def on_event(self, name, args):
+        if name == 'server.event.added':
+            self.event_types.add(args['name'])
+            return
+
+        if name == 'server.event.removed':
+            self.event_types.discard(args['name'])
+            self.epoch = binascii.hexlify(os.urandom(8)).decode('ascii')
+            return
+
+        match = re.match(r'^entity-subscriber\.([\.\w]+)\.changed$', name)
+        if match and match.group(1) in self.generations:
+            self.generations[match.group(1)] += 1
+
+    def get_generation(self, namespace):
+        """
+        Returns a counter which changes whenever entities of `namespace` do.
+        Namespaces are subscribed to on first use, when None is returned,
+        since changes racing with the subscription could go unnoticed.
+        None is returned as well for namespaces which have no change event,
+        their generation would never change.
+        """
+        if '{0}.changed'.format(namespace) not in self.event_types:
+            return None
+
+        if namespace not in self.generations:
+            self.generations[namespace] = 0
+            self.dispatcher.subscribe_events('entity-subscriber.{0}.changed'.format(namespace))
+            return None
+
+        return self.generations[namespace]
 
     def init_metadata(self):
         self._tasks = self.dispatcher.call_sync('discovery.get_tasks')
@@ -160,6 +250,13 @@ class RESTApi(object):
             try:
                 self.dispatcher.connect('unix:')
                 self.dispatcher.login_service('restd')
+                # Changes might have been missed while disconnected, invalidate all ETags handed out
+                self.epoch = binascii.hexlify(os.urandom(8)).decode('ascii')
+                self.dispatcher.subscribe_events('server.event.added', 'server.event.removed')
+                self.event_types = set(self.dispatcher.call_sync('management.get_event_types'))
+                for namespace in self.generations:
+                    self.dispatcher.subscribe_events('entity-subscriber.{0}.changed'.format(namespace))
+
                 return
             except (OSError, RpcException) as err:
                 self.logger.warning('Cannot connect to dispatcher: {0}, retrying in 1 second'.format(str(err)))
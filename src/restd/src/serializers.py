@@ -3,8 +3,48 @@ from datetime import datetime
 import json
 
 
+STREAM_CHUNK_SIZE = 65536
+
+
 class JsonEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, datetime):
             return str(obj)
         return json.JSONEncoder.default(self, obj)
+
+
+def is_stream(result):
+    return hasattr(result, '__iter__') and not isinstance(result, (str, bytes, list, tuple, dict))
+
+
+def stream_json(iterable, encoder, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Encodes items of `iterable` as a JSON array, yielding chunks of about
+    `chunk_size` bytes as items arrive. Output is the same as encoding the
+    whole list at once with `encoder`.
+    """
+    indent = ' ' * encoder.indent if isinstance(encoder.indent, int) else encoder.indent
+    chunk = []
+    size = 0
+    first = True
+
+    for item in iterable:
+        data = encoder.encode(item)
+        if indent is not None:
+            data = indent + data.replace('\n', '\n' + indent)
+
+        data = ('[' if first else encoder.item_separator) + ('\n' if indent is not None else '') + data
+        first = False
+        chunk.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield ''.join(chunk).encode('utf-8')
+            chunk = []
+            size = 0
+
+    if first:
+        chunk.append('[]')
+    else:
+        chunk.append('\n]' if indent is not None else ']')
+
+    yield ''.join(chunk).encode('utf-8')
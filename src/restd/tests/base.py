@@ -44,6 +44,18 @@ class CRUDTestCase(RESTTestCase):
         self.assertIsInstance(data, list)
         return r
 
+    def test_050_retrieve_not_modified(self):
+        # First query of a collection only subscribes to its changes
+        self.client.get(self.name)
+        r = self.client.get(self.name)
+        self.assertEqual(r.status_code, 200, msg=r.text)
+        if 'ETag' not in r.headers:
+            self.skipTest('Collection is not backed by a query method')
+
+        r = self.client.get(self.name, headers={'If-None-Match': r.headers['ETag']})
+        self.assertEqual(r.status_code, 304, msg=r.text)
+        return r
+
     def test_060_update(self):
         identifier, data = self.get_update_ident_data()
         r = self.client.put(self.name + '/id/' + identifier, data)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Load test of restd authentication layer.
+
+Drives the restd WSGI middleware stack in-process against a stub dispatcher
+which simulates connection setup and password verification latency, and
+reports request rate together with how many connections, logins and password
+checks the dispatcher had to handle.
+
+    ./loadtest.py --requests 5000 --concurrency 50 --users 10
+    ./loadtest.py --legacy    # new connection and password check per request
+    ./loadtest.py --token     # authenticate with session tokens
+"""
+import argparse
+import base64
+import errno
+import os
+import sys
+import time
+from collections import Counter
+
+import falcon
+import falcon.testing
+import gevent
+import gevent.pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from freenas.dispatcher.rpc import RpcException
+from auth import Authenticator
+from main import AuthMiddleware, JSONTranslator
+
+
+class StubDispatcher(object):
+    def __init__(self, users, connect_delay, check_delay):
+        self.users = users
+        self.connect_delay = connect_delay
+        self.check_delay = check_delay
+        self.stats = Counter()
+
+    def create_client(self):
+        client = StubClient(self)
+        client.connect('unix:')
+        return client
+
+
+class StubClient(object):
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.connected = False
+        self.username = None
+
+    def connect(self, url):
+        gevent.sleep(self.dispatcher.connect_delay)
+        self.dispatcher.stats['connects'] += 1
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def login_user(self, username, password, check_password=False):
+        self.dispatcher.stats['logins'] += 1
+        if check_password:
+            # Stands in for PAM/crypt verification through dscached
+            gevent.sleep(self.dispatcher.check_delay)
+            self.dispatcher.stats['password_checks'] += 1
+            if self.dispatcher.users.get(username) != password:
+                raise RpcException(errno.EACCES, 'Incorrect username or password')
+
+        self.username = username
+
+    def call_sync(self, method, *args):
+        self.dispatcher.stats['calls'] += 1
+        return {'method': method, 'username': self.username}
+
+
+class WhoAmIResource(object):
+    def on_get(self, req, resp):
+        req.context['result'] = req.context['client'].call_sync('session.whoami')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000, help='Total number of requests')
+    parser.add_argument('--concurrency', type=int, default=50, help='Number of concurrent clients')
+    parser.add_argument('--users', type=int, default=10, help='Number of distinct users')
+    parser.add_argument('--connect-delay', type=float, default=0.002, help='Simulated connect time')
+    parser.add_argument('--check-delay', type=float, default=0.05, help='Simulated password check time')
+    parser.add_argument('--legacy', action='store_true', help='Disable credential cache and connection pool')
+    parser.add_argument('--token', action='store_true', help='Use session tokens after first request')
+    args = parser.parse_args()
+
+    users = {'user{0}'.format(i): 'password{0}'.format(i) for i in range(args.users)}
+    dispatcher = StubDispatcher(users, args.connect_delay, args.check_delay)
+    authenticator = Authenticator(dispatcher.create_client, credential_ttl=0 if args.legacy else 60)
+    if args.legacy:
+        authenticator.pool.max_idle = 0
+
+    api = falcon.API(middleware=[AuthMiddleware(authenticator), JSONTranslator()])
+    api.add_route('/whoami', WhoAmIResource())
+    tokens = {}
+    statuses = Counter()
+
+    def request(i):
+        username = 'user{0}'.format(i % args.users)
+        if args.token and username in tokens:
+            auth = 'Token {0}'.format(tokens[username])
+        else:
+            auth = 'Basic {0}'.format(base64.b64encode('{0}:{1}'.format(username, users[username]).encode()).decode())
+
+        result = falcon.testing.StartResponseMock()
+        environ = falcon.testing.create_environ('/whoami', headers={'Authorization': auth})
+        b''.join(api(environ, result))
+        statuses[result.status] += 1
+        token = result.headers_dict.get('x-auth-token')
+        if token:
+            tokens[username] = token
+
+    pool = gevent.pool.Pool(args.concurrency)
+    started_at = time.monotonic()
+    pool.map(request, range(args.requests))
+    elapsed = time.monotonic() - started_at
+
+    print('{0} requests in {1:.2f}s, {2:.0f} req/s'.format(args.requests, elapsed, args.requests / elapsed))
+    print('HTTP statuses: {0}'.format(dict(statuses)))
+    print('Dispatcher: {0}'.format(dict(dispatcher.stats)))
+    print('Credential cache: {0} hits, {1} misses'.format(
+        authenticator.credentials.hits,
+        authenticator.credentials.misses
+    ))
+    print('Idle pooled connections: {0}'.format(len(authenticator.pool)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import os
+import sys
+import time
+import json
+import argparse
+import operator
+import pytz
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.util import datetime_to_utc_timestamp, utc_timestamp_to_datetime
+from store import FreeNASJobStore
+
+
+OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<=': lambda a, b: a is not None and a <= b,
+}
+
+
+def job(*args, **kwargs):
+    pass
+
+
+class MemoryDatastore(object):
+    """
+    Minimal stand-in for the calendar_tasks collection. Documents are
+    serialized on the way in and copied on the way out, as they would be
+    when going through the database.
+    """
+    def __init__(self):
+        self.documents = {}
+
+    def query(self, collection, *conditions, sort=None, single=False):
+        result = [
+            dict(d) for d in self.documents.values()
+            if all(OPERATORS[op](d.get(field), value) for field, op, value in conditions)
+        ]
+
+        if sort:
+            result.sort(key=lambda d: (d[sort] is None, d[sort] or 0))
+
+        if single:
+            return result[0] if result else None
+
+        return result
+
+    def get_by_id(self, collection, id):
+        document = self.documents.get(id)
+        return dict(document) if document else None
+
+    def insert(self, collection, document):
+        self.documents[document['id']] = json.loads(json.dumps(document))
+
+    def update(self, collection, id, document):
+        self.documents[id] = json.loads(json.dumps(document))
+
+    def delete(self, collection, id):
+        del self.documents[id]
+
+    def close(self):
+        pass
+
+
+class DatastoreScanJobStore(FreeNASJobStore):
+    """
+    Previous behavior: every scheduler wakeup queries the datastore and
+    rebuilds the jobs.
+    """
+    def load(self):
+        pass
+
+    def lookup_job(self, job_id):
+        document = self.ds.get_by_id('calendar_tasks', job_id)
+        return self._reconstitute_job(document) if document else None
+
+    def get_due_jobs(self, now):
+        return self._get_jobs(('next_run_time', '<=', datetime_to_utc_timestamp(now)))
+
+    def get_next_run_time(self):
+        document = self.ds.query('calendar_tasks', ('next_run_time', '!=', None), sort='next_run_time', single=True)
+        return utc_timestamp_to_datetime(document['next_run_time']) if document else None
+
+    def get_all_jobs(self):
+        jobs = self._get_jobs()
+        self._fix_paused_jobs_sorting(jobs)
+        return jobs
+
+    def update_job(self, job):
+        self.ds.update('calendar_tasks', job.id, self._serialize_job(job))
+
+
+def generate_document(idx, now):
+    return {
+        'id': 'job-{0}'.format(idx),
+        'name': 'Snapshot tank/dataset{0}'.format(idx),
+        'next_run_time': now + 60 + idx % 86400,
+        'task': 'volume.snapshot_dataset',
+        'args': ['tank/dataset{0}'.format(idx), True, 14 * 86400, 'auto', False],
+        'enabled': True,
+        'hidden': False,
+        'protected': False,
+        'schedule': {'second': '0', 'minute': str(idx % 60), 'hour': str(idx // 60 % 24)}
+    }
+
+
+def process_jobs(store, now):
+    # What BaseScheduler._process_jobs() asks of the job store on every wakeup
+    for j in store.get_due_jobs(now):
+        j._modify(next_run_time=j.trigger.get_next_fire_time(j.next_run_time, now))
+        store.update_job(j)
+
+    return store.get_next_run_time()
+
+
+def measure(fn, *args, rounds=1):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark calendar task job store operations')
+    parser.add_argument('--jobs', type=int, default=10000)
+    parser.add_argument('--due', type=int, default=100, help='Jobs due at the measured wakeup')
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    scheduler = BackgroundScheduler(timezone=pytz.utc)
+    now = int(time.time())
+
+    for klass in (DatastoreScanJobStore, FreeNASJobStore):
+        ds = MemoryDatastore()
+        for idx in range(args.jobs):
+            ds.insert('calendar_tasks', generate_document(idx, now))
+
+        store = klass(ds)
+        load = measure(store.start, scheduler, 'default')
+        idle = measure(process_jobs, store, datetime.fromtimestamp(now, pytz.utc), rounds=args.rounds)
+        due = measure(process_jobs, store, datetime.fromtimestamp(now + 60 + args.due - 1, pytz.utc))
+        all_jobs = measure(store.get_all_jobs, rounds=args.rounds)
+
+        print('{0}: load {1:.3f}s, idle wakeup {2:.2f}ms, wakeup with {3} due jobs {4:.2f}ms, get_all_jobs {5:.2f}ms'.format(
+            klass.__name__,
+            load,
+            idle * 1000,
+            args.due,
+            due * 1000,
+            all_jobs * 1000
+        ))
+
+        if klass is FreeNASJobStore:
+            print('Consistency check: {0}'.format(store.check_consistency()))
+
+
+if __name__ == '__main__':
+    main()
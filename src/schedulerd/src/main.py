@@ -193,6 +193,10 @@ class ManagementService(RpcService):
             run_date=datetime.now(timezone.utc)
         )
 
+    @private
+    def check_consistency(self, repair=False):
+        return self.context.jobstore.check_consistency(repair)
+
 
 class Context(object):
     def __init__(self):
@@ -203,6 +207,7 @@ class Context(object):
         self.configstore = None
         self.client = None
         self.scheduler = None
+        self.jobstore = None
         self.active_tasks = {}
 
     def init_datastore(self):
@@ -226,8 +231,8 @@ class Context(object):
         self.connect()
 
     def init_scheduler(self):
-        store = FreeNASJobStore()
-        self.scheduler = BackgroundScheduler(jobstores={'default': store, 'temp': MemoryJobStore()}, timezone=pytz.utc)
+        self.jobstore = FreeNASJobStore()
+        self.scheduler = BackgroundScheduler(jobstores={'default': self.jobstore, 'temp': MemoryJobStore()}, timezone=pytz.utc)
         self.scheduler.start()
 
     def connect(self):
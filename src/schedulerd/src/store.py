@@ -26,6 +26,10 @@
 #####################################################################
 
 import time
+import json
+import heapq
+import itertools
+import threading
 from apscheduler.jobstores.base import BaseJobStore, JobLookupError, ConflictingIdError
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.util import datetime_to_utc_timestamp, utc_timestamp_to_datetime
@@ -34,58 +38,191 @@ from datastore import get_datastore, DuplicateKeyException, DatastoreException
 
 
 class FreeNASJobStore(BaseJobStore):
-    def __init__(self):
-        self.ds = get_datastore()
+    """
+    Job store persisting jobs in the calendar_tasks collection.
+
+    Jobs are loaded once when the scheduler starts and kept in memory,
+    together with a heap of next run times; every change is written through
+    to the datastore. Each heap entry carries a sequence number and only the
+    latest one pushed for a job is live. Entries left behind by updated or
+    removed jobs are skipped when encountered and dropped once they
+    outnumber live ones.
+    """
+    def __init__(self, datastore=None):
+        self.ds = datastore or get_datastore()
         self._scheduler = None
         self._jobstore_alias = None
+        self._lock = threading.RLock()
+        self._jobs = {}
+        self._heap = []
+        self._seq = itertools.count()
 
     def start(self, scheduler, alias):
-        self._scheduler = scheduler
+        super(FreeNASJobStore, self).start(scheduler, alias)
         self._jobstore_alias = alias
+        self.load()
 
     @property
     def connection(self):
         return self.ds
 
+    def load(self):
+        with self._lock:
+            self._jobs = {}
+            self._heap = []
+            for job in self._get_jobs():
+                self._put(job)
+
     def lookup_job(self, job_id):
-        document = self.ds.get_by_id('calendar_tasks', job_id)
-        return self._reconstitute_job(document) if document else None
+        with self._lock:
+            entry = self._jobs.get(job_id)
+            return entry[0] if entry else None
 
     def get_due_jobs(self, now):
         timestamp = datetime_to_utc_timestamp(now)
-        return self._get_jobs(('next_run_time', '<=', timestamp))
+        jobs = []
+        with self._lock:
+            for ts, seq, id in self._iter_heap():
+                if ts > timestamp:
+                    break
+
+                jobs.append(self._jobs[id][0])
+
+        return jobs
 
     def get_next_run_time(self):
-        document = self.ds.query('calendar_tasks', ('next_run_time', '!=', None), sort='next_run_time', single=True)
-        return utc_timestamp_to_datetime(document['next_run_time']) if document else None
+        with self._lock:
+            while self._heap and not self._is_live(self._heap[0]):
+                heapq.heappop(self._heap)
+
+            return utc_timestamp_to_datetime(self._heap[0][0]) if self._heap else None
 
     def get_all_jobs(self):
-        jobs = self._get_jobs()
+        with self._lock:
+            jobs = [e[0] for e in sorted(self._jobs.values(), key=lambda e: (e[1] is None, e[1] or 0, e[0].id))]
+
         self._fix_paused_jobs_sorting(jobs)
         return jobs
 
     def add_job(self, job):
-        try:
-            self.ds.insert('calendar_tasks', self._serialize_job(job))
-        except DuplicateKeyException:
-            raise ConflictingIdError(job.id)
+        with self._lock:
+            if job.id in self._jobs:
+                raise ConflictingIdError(job.id)
+
+            try:
+                self.ds.insert('calendar_tasks', self._serialize_job(job))
+            except DuplicateKeyException:
+                raise ConflictingIdError(job.id)
+
+            self._put(job)
 
     def update_job(self, job):
-        self.ds.update('calendar_tasks', job.id, self._serialize_job(job))
+        with self._lock:
+            if job.id not in self._jobs:
+                raise JobLookupError(job.id)
+
+            self.ds.update('calendar_tasks', job.id, self._serialize_job(job))
+            self._put(job)
 
     def remove_job(self, job_id):
-        try:
-            self.ds.delete('calendar_tasks', job_id)
-        except DatastoreException:
-            raise JobLookupError(job_id)
+        with self._lock:
+            if job_id not in self._jobs:
+                raise JobLookupError(job_id)
+
+            try:
+                self.ds.delete('calendar_tasks', job_id)
+            except DatastoreException:
+                raise JobLookupError(job_id)
+
+            del self._jobs[job_id]
+            self._compact()
 
     def remove_all_jobs(self):
-        for i in self.get_all_jobs():
-            self.ds.delete('calendar_tasks', i.id)
+        with self._lock:
+            for i in list(self._jobs):
+                self.ds.delete('calendar_tasks', i)
+
+            self._jobs.clear()
+            self._heap = []
 
     def shutdown(self):
         self.ds.close()
 
+    def check_consistency(self, repair=False):
+        """
+        Compares jobs kept in memory with the datastore. Returns ids of jobs
+        missing from memory, jobs no longer in the datastore and jobs which
+        differ. With `repair`, jobs are reloaded from the datastore.
+        """
+        with self._lock:
+            stored = {d['id']: d for d in self.ds.query('calendar_tasks')}
+            result = {
+                'missing': sorted(set(stored) - set(self._jobs)),
+                'stale': sorted(set(self._jobs) - set(stored)),
+                'mismatched': sorted(
+                    id for id, (job, ts, seq) in self._jobs.items()
+                    if id in stored and not self._same_job(self._serialize_job(job), stored[id])
+                )
+            }
+
+            if repair and any(result.values()):
+                self._logger.warning('Reloading jobs, store is inconsistent with datastore: {0}'.format(result))
+                self.load()
+
+            return result
+
+    def _same_job(self, serialized, document):
+        try:
+            stored = self._serialize_job(self._reconstitute_job(document))
+        except:
+            return False
+
+        # Fresh installs store 1 as next run time, see _reconstitute_job()
+        if document['next_run_time'] == 1:
+            stored['next_run_time'] = serialized['next_run_time']
+
+        return json.dumps(stored, sort_keys=True) == json.dumps(serialized, sort_keys=True)
+
+    def _put(self, job):
+        ts = datetime_to_utc_timestamp(job.next_run_time)
+        old = self._jobs.get(job.id)
+        if old and old[1] == ts:
+            self._jobs[job.id] = (job, ts, old[2])
+            return
+
+        # A fresh sequence number retires every entry pushed for the job before,
+        # even one with the same run time (paused and resumed within a period)
+        seq = next(self._seq)
+        self._jobs[job.id] = (job, ts, seq)
+        if ts is not None:
+            heapq.heappush(self._heap, (ts, seq, job.id))
+
+        self._compact()
+
+    def _is_live(self, entry):
+        job = self._jobs.get(entry[2])
+        return job is not None and job[2] == entry[1]
+
+    def _iter_heap(self):
+        # Walks the heap in order without popping, live entries only
+        if not self._heap:
+            return
+
+        frontier = [(self._heap[0], 0)]
+        while frontier:
+            entry, idx = heapq.heappop(frontier)
+            if self._is_live(entry):
+                yield entry
+
+            for child in (2 * idx + 1, 2 * idx + 2):
+                if child < len(self._heap):
+                    heapq.heappush(frontier, (self._heap[child], child))
+
+    def _compact(self):
+        if len(self._heap) > 2 * len(self._jobs) + 64:
+            self._heap = [e for e in self._heap if self._is_live(e)]
+            heapq.heapify(self._heap)
+
     def _serialize_job(self, job):
         schedule = {f.name: str(f) for f in job.trigger.fields}
         return {
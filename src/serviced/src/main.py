@@ -39,23 +39,34 @@ import pwd
 import grp
 import bsd
 import contextlib
-from threading import Thread, Condition, Timer, RLock
+from collections import namedtuple
+from threading import Thread, Condition, Timer, RLock, Lock
 from freenas.dispatcher.rpc import RpcContext, RpcService, RpcException, generator, get_sender
 from freenas.dispatcher.client import Client, ClientError
 from freenas.dispatcher.server import Server
-from freenas.utils import configure_logging, first_or_default, query as q
+from freenas.utils import configure_logging, query as q
 from freenas.utils.trace_logger import TRACE
 
 
 DEFAULT_SOCKET_ADDRESS = 'unix:///var/run/serviced.sock'
 BOOTSTRAP_JOB = ['/usr/local/sbin/servicectl', 'bootstrap']
-MAX_EVENTS = 16
+MAX_EVENTS = 256
 SHUTDOWN_TIMEOUT = 60
 BASE_ENV = {
     'PATH': '/sbin:/bin:/usr/sbin:/usr/bin',
     'HOME': '/'
 }
 
+# Values match <sys/event.h>, so that event loop can be driven without kqueue
+NOTE_EXIT = getattr(select, 'KQ_NOTE_EXIT', 0x80000000)
+NOTE_FORK = getattr(select, 'KQ_NOTE_FORK', 0x40000000)
+NOTE_EXEC = getattr(select, 'KQ_NOTE_EXEC', 0x20000000)
+NOTE_TRACK = getattr(select, 'KQ_NOTE_TRACK', 0x00000001)
+NOTE_CHILD = getattr(select, 'KQ_NOTE_CHILD', 0x00000004)
+
+
+ProcEvent = namedtuple('ProcEvent', ['pid', 'fflags', 'data'])
+
 
 def daemonize():
     try:
@@ -92,6 +103,48 @@ def daemonize():
     os.dup2(log, sys.stderr.fileno())
 
 
+class KqueueEventSource(object):
+    def __init__(self):
+        self.kq = select.kqueue()
+        self.lock = Lock()
+        self.changes = []
+
+    def track(self, pid):
+        ev = select.kevent(
+            pid,
+            select.KQ_FILTER_PROC,
+            select.KQ_EV_ADD | select.KQ_EV_ENABLE,
+            NOTE_EXIT | NOTE_EXEC | NOTE_FORK | NOTE_TRACK,
+            0, 0
+        )
+
+        # Must be registered before the process gets a chance to fork
+        self.kq.control([ev], 0)
+
+    def untrack(self, pid):
+        ev = select.kevent(
+            pid,
+            select.KQ_FILTER_PROC,
+            select.KQ_EV_DELETE,
+            0, 0, 0
+        )
+
+        # Submitted together with next poll() call
+        with self.lock:
+            self.changes.append(ev)
+
+    def poll(self, max_events):
+        with self.lock:
+            changes, self.changes = self.changes, []
+
+        # Failed changes (eg. process already gone) come back as EV_ERROR events
+        return [
+            ProcEvent(ev.ident, ev.fflags, ev.data)
+            for ev in self.kq.control(changes, max_events)
+            if ev.filter == select.KQ_FILTER_PROC and not ev.flags & select.KQ_EV_ERROR
+        ]
+
+
 class JobState(enum.Enum):
     UNKNOWN = 'UNKNOWN'
     STARTING = 'STARTING'
@@ -110,14 +163,14 @@ class Job(object):
         self.one_shot = False
         self.logger = None
         self.id = None
-        self.label = None
+        self._label = None
         self.parent = None
         self.provides = set()
         self.requires = set()
         self.state = JobState.UNKNOWN
         self.program = None
         self.program_arguments = []
-        self.pid = None
+        self._pid = None
         self.pgid = None
         self.sid = None
         self.plist = None
@@ -142,9 +195,27 @@ class Job(object):
         self.respawns = 0
         self.cv = Condition()
 
+    @property
+    def pid(self):
+        return self._pid
+
+    @pid.setter
+    def pid(self, value):
+        self.context.reindex_pid(self, self._pid, value)
+        self._pid = value
+
+    @property
+    def label(self):
+        return self._label
+
+    @label.setter
+    def label(self, value):
+        self.context.reindex_label(self, self._label, value)
+        self._label = value
+
     @property
     def children(self):
-        return (j for j in self.context.jobs if j.parent is self)
+        return (j for j in self.context.jobs.values() if j.parent is self)
 
     def load(self, plist):
         self.state = JobState.STOPPED
@@ -168,7 +239,7 @@ class Job(object):
         self.umask = plist.get('Umask')
         self.logger = logging.getLogger('Job:{0}'.format(self.label))
 
-        if first_or_default(lambda j: j.label == self.label, self.context.jobs.values()):
+        if self.label in self.context.jobs_by_label:
             raise RpcException(errno.EEXIST, 'Job with label {0} already exists'.format(self.label))
 
         if not self.program:
@@ -203,7 +274,7 @@ class Job(object):
 
     def unload(self):
         self.logger.info('Unloading job')
-        del self.context.jobs[self.id]
+        self.context.remove_job(self)
 
     def start(self):
         with self.cv:
@@ -312,10 +383,10 @@ class Job(object):
         })
 
     def pid_event(self, ev):
-        if ev.fflags & select.KQ_NOTE_EXEC:
+        if ev.fflags & NOTE_EXEC:
             self.pid_exec(ev)
 
-        if ev.fflags & select.KQ_NOTE_EXIT:
+        if ev.fflags & NOTE_EXIT:
             self.pid_exit(ev)
 
     def pid_exec(self, ev):
@@ -357,7 +428,6 @@ class Job(object):
 
         with self.cv:
             self.logger.info('Job has exited with code {0}'.format(ev.data))
-            self.pid = None
             self.last_exit_code = ev.data
 
             if self.state == JobState.STOPPING:
@@ -369,14 +439,17 @@ class Job(object):
                     self.failure_reason = 'Process died with exit code {0}'.format(self.last_exit_code)
                     self.set_state(JobState.ERROR)
 
+            # Cleared only after state change, so that events still carry the PID
+            self.pid = None
             if self.anonymous:
-                del self.context.jobs[self.id]
+                self.context.remove_job(self)
 
     def set_state(self, new_state):
         # Must run locked
         if self.state != JobState.RUNNING and new_state == JobState.RUNNING:
             self.context.emit_event('serviced.job.started', {
                 'ID': self.id,
+                'PID': self.pid,
                 'Label': self.label,
                 'Anonymous': self.anonymous
             })
@@ -384,6 +457,7 @@ class Job(object):
         if self.state != JobState.STOPPED and new_state == JobState.STOPPED:
             self.context.emit_event('serviced.job.stopped', {
                 'ID': self.id,
+                'PID': self.pid,
                 'Label': self.label,
                 'Anonymous': self.anonymous
             })
@@ -391,7 +465,19 @@ class Job(object):
         if self.state != JobState.ERROR and new_state == JobState.ERROR:
             self.context.emit_event('serviced.job.error', {
                 'ID': self.id,
+                'PID': self.pid,
+                'Label': self.label,
+                'Reason': self.failure_reason,
+                'Anonymous': self.anonymous
+            })
+
+        if self.state != new_state:
+            # Covers transitions without a dedicated event above, like STARTING, STOPPING or ENDED
+            self.context.emit_event('serviced.job.state_changed', {
+                'ID': self.id,
+                'PID': self.pid,
                 'Label': self.label,
+                'State': new_state.name,
                 'Reason': self.failure_reason,
                 'Anonymous': self.anonymous
             })
@@ -461,12 +547,11 @@ class JobService(RpcService):
     def load(self, plist):
         job = Job(self.context)
         job.load(plist)
-        with self.context.lock:
-            self.context.jobs[job.id] = job
+        self.context.add_job(job)
 
     def unload(self, name_or_id):
         with self.context.lock:
-            job = first_or_default(lambda j: j.label == name_or_id or j.id == name_or_id, self.context.jobs.values())
+            job = self.context.job_by_name(name_or_id)
             if not job:
                 raise RpcException(errno.ENOENT, 'Job {0} not found'.format(name_or_id))
 
@@ -475,7 +560,7 @@ class JobService(RpcService):
 
     def start(self, name_or_id, wait=False):
         with self.context.lock:
-            job = first_or_default(lambda j: j.label == name_or_id or j.id == name_or_id, self.context.jobs.values())
+            job = self.context.job_by_name(name_or_id)
             if not job:
                 raise RpcException(errno.ENOENT, 'Job {0} not found'.format(name_or_id))
 
@@ -485,7 +570,7 @@ class JobService(RpcService):
 
     def stop(self, name_or_id, wait=False):
         with self.context.lock:
-            job = first_or_default(lambda j: j.label == name_or_id or j.id == name_or_id, self.context.jobs.values())
+            job = self.context.job_by_name(name_or_id)
             if not job:
                 raise RpcException(errno.ENOENT, 'Job {0} not found'.format(name_or_id))
 
@@ -499,7 +584,7 @@ class JobService(RpcService):
 
     def send_signal(self, name_or_id, signo):
         with self.context.lock:
-            job = first_or_default(lambda j: j.label == name_or_id or j.id == name_or_id, self.context.jobs.values())
+            job = self.context.job_by_name(name_or_id)
             if not job:
                 raise RpcException(errno.ENOENT, 'Job {0} not found'.format(name_or_id))
 
@@ -507,7 +592,7 @@ class JobService(RpcService):
 
     def get(self, name_or_id):
         with self.context.lock:
-            job = first_or_default(lambda j: j.label == name_or_id or j.id == name_or_id, self.context.jobs.values())
+            job = self.context.job_by_name(name_or_id)
             if not job:
                 raise RpcException(errno.ENOENT, 'Job {0} not found'.format(name_or_id))
 
@@ -515,27 +600,21 @@ class JobService(RpcService):
 
     def get_by_pid(self, pid, fuzzy=False):
         with self.context.lock:
-            def match(j):
-                return j.pid == pid
-
-            def fuzzy_match(j):
-                if j.parent and j.parent.pid == pid:
-                    return True
-
-                return j.pid == pid
-
-            job = first_or_default(fuzzy_match if fuzzy else match, self.context.jobs.values())
-            if job.parent:
-                job = job.parent
-
+            job = self.context.owner_job_by_pid(pid, fuzzy)
             if not job:
                 raise RpcException(errno.ENOENT, 'Job for PID {0} not found'.format(pid))
 
         return job.__getstate__()
 
+    def get_by_pids(self, pids, fuzzy=False):
+        with self.context.lock:
+            jobs = [self.context.owner_job_by_pid(pid, fuzzy) for pid in pids]
+
+        return [job.__getstate__() if job else None for job in jobs]
+
     def wait(self, name_or_id, states):
         with self.context.lock:
-            job = first_or_default(lambda j: j.label == name_or_id or j.id == name_or_id, self.context.jobs.values())
+            job = self.context.job_by_name(name_or_id)
             if not job:
                 raise RpcException(errno.ENOENT, 'Job {0} not found'.format(name_or_id))
 
@@ -561,13 +640,16 @@ class JobService(RpcService):
 
 
 class Context(object):
-    def __init__(self):
+    def __init__(self, event_source=None):
         self.server = None
         self.client = None
         self.jobs = {}
+        self.jobs_by_pid = {}
+        self.jobs_by_label = {}
         self.provides = set()
         self.lock = RLock()
-        self.kq = select.kqueue()
+        self.index_lock = Lock()
+        self.events = event_source or KqueueEventSource()
         self.devnull = os.open('/dev/null', os.O_RDWR)
         self.logger = logging.getLogger('Context')
         self.rpc = RpcContext()
@@ -609,65 +691,98 @@ class Context(object):
         if targets:
             Timer(2, doit).start()
 
+    def add_job(self, job):
+        with self.index_lock:
+            self.jobs[job.id] = job
+            if job.pid:
+                self.jobs_by_pid[job.pid] = job
+
+            if job.label:
+                self.jobs_by_label[job.label] = job
+
+    def remove_job(self, job):
+        with self.index_lock:
+            self.jobs.pop(job.id, None)
+            if self.jobs_by_pid.get(job.pid) is job:
+                del self.jobs_by_pid[job.pid]
+
+            if self.jobs_by_label.get(job.label) is job:
+                del self.jobs_by_label[job.label]
+
+    def reindex_pid(self, job, old, new):
+        self.reindex(self.jobs_by_pid, job, old, new)
+
+    def reindex_label(self, job, old, new):
+        self.reindex(self.jobs_by_label, job, old, new)
+
+    def reindex(self, index, job, old, new):
+        with self.index_lock:
+            # Jobs are indexed only after they get registered by add_job()
+            if self.jobs.get(job.id) is not job:
+                return
+
+            if old is not None and index.get(old) is job:
+                del index[old]
+
+            if new is not None:
+                index[new] = job
+
+    def job_by_name(self, name_or_id):
+        return self.jobs.get(name_or_id) or self.jobs_by_label.get(name_or_id)
+
     def job_by_pid(self, pid):
-        job = first_or_default(lambda j: j.pid == pid, self.jobs.values())
+        return self.jobs_by_pid.get(pid)
+
+    def owner_job_by_pid(self, pid, fuzzy=False):
+        # Anonymous jobs always resolve to the job which spawned them, so
+        # fuzzy matching is implied by the pid index
+        job = self.job_by_pid(pid)
+        if job and job.parent:
+            job = job.parent
+
         return job
 
     def event_loop(self):
         while True:
             with contextlib.suppress(InterruptedError):
-                for ev in self.kq.control(None, MAX_EVENTS):
-                    self.logger.log(TRACE, 'New event: {0}'.format(ev))
-                    if ev.filter == select.KQ_FILTER_PROC:
-                        job = self.job_by_pid(ev.ident)
-                        if job:
-                            job.pid_event(ev)
-                            continue
-
-                        if ev.fflags & select.KQ_NOTE_CHILD:
-                            if ev.fflags & select.KQ_NOTE_EXIT:
-                                continue
-
-                            pjob = self.job_by_pid(ev.data)
-                            if not pjob:
-                                self.untrack_pid(ev.ident)
-                                continue
-
-                            # Stop tracking at session ID boundary
-                            try:
-                                if pjob.pgid != os.getpgid(ev.ident):
-                                    self.untrack_pid(ev.ident)
-                                    continue
-                            except ProcessLookupError:
-                                continue
-
-                            with self.lock:
-                                job = Job(self)
-                                job.load_anonymous(pjob, ev.ident)
-                                self.jobs[job.id] = job
-                                self.logger.info('Added job {0}'.format(job.label))
+                self.process_events(self.events.poll(MAX_EVENTS))
+
+    def process_events(self, events):
+        for ev in events:
+            self.logger.log(TRACE, 'New event: {0}'.format(ev))
+            job = self.job_by_pid(ev.pid)
+            if job:
+                job.pid_event(ev)
+                continue
+
+            if ev.fflags & NOTE_CHILD:
+                if ev.fflags & NOTE_EXIT:
+                    continue
+
+                pjob = self.job_by_pid(ev.data)
+                if not pjob:
+                    self.untrack_pid(ev.pid)
+                    continue
+
+                # Stop tracking at session ID boundary
+                try:
+                    if pjob.pgid != os.getpgid(ev.pid):
+                        self.untrack_pid(ev.pid)
+                        continue
+                except ProcessLookupError:
+                    continue
 
-    def track_pid(self, pid):
-        ev = select.kevent(
-            pid,
-            select.KQ_FILTER_PROC,
-            select.KQ_EV_ADD | select.KQ_EV_ENABLE,
-            select.KQ_NOTE_EXIT | select.KQ_NOTE_EXEC | select.KQ_NOTE_FORK | select.KQ_NOTE_TRACK,
-            0, 0
-        )
+                with self.lock:
+                    job = Job(self)
+                    job.load_anonymous(pjob, ev.pid)
+                    self.add_job(job)
+                    self.logger.info('Added job {0}'.format(job.label))
 
-        self.kq.control([ev], 0)
+    def track_pid(self, pid):
+        self.events.track(pid)
 
     def untrack_pid(self, pid):
-        ev = select.kevent(
-            pid,
-            select.KQ_FILTER_PROC,
-            select.KQ_EV_DELETE,
-            0, 0, 0
-        )
-
-        with contextlib.suppress(FileNotFoundError):
-            self.kq.control([ev], 0)
+        self.events.untrack(pid)
 
     def emit_event(self, name, args):
         self.server.broadcast_event(name, args)
@@ -698,7 +813,7 @@ class Context(object):
                     'RunAtLoad': True,
                 })
 
-                self.jobs[job.id] = job
+                self.add_job(job)
 
         Thread(target=doit).start()
 
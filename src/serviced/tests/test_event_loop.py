@@ -0,0 +1,150 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+import os
+import sys
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+try:
+    import bsd
+except ImportError:
+    # py-bsd is FreeBSD only; event loop itself needs just kinfo_getproc()
+    bsd = types.ModuleType('bsd')
+    bsd.kinfo_getproc = mock.Mock(side_effect=LookupError)
+    sys.modules['bsd'] = bsd
+
+import main
+from main import Context, Job, JobState, ProcEvent, NOTE_CHILD, NOTE_EXEC, NOTE_EXIT, NOTE_FORK
+
+
+class FakeEventSource(object):
+    def __init__(self):
+        self.tracked = set()
+        self.untracked = []
+
+    def track(self, pid):
+        self.tracked.add(pid)
+
+    def untrack(self, pid):
+        self.tracked.discard(pid)
+        self.untracked.append(pid)
+
+
+class TestEventLoop(unittest.TestCase):
+    def setUp(self):
+        self.events = FakeEventSource()
+        self.context = Context(event_source=self.events)
+        self.context.server = mock.Mock()
+        self.parent = self.add_job('org.freenas.test', os.getpid())
+        self.parent.pgid = os.getpgid(0)
+
+    def add_job(self, label, pid):
+        job = Job(self.context)
+        job.id = label + '.id'
+        job.label = label
+        job.logger = mock.Mock()
+        job.state = JobState.RUNNING
+        job.parent = None
+        self.context.add_job(job)
+        job.pid = pid
+        return job
+
+    def test_indexes(self):
+        self.assertIs(self.context.job_by_pid(os.getpid()), self.parent)
+        self.assertIs(self.context.job_by_name('org.freenas.test'), self.parent)
+        self.assertIs(self.context.job_by_name('org.freenas.test.id'), self.parent)
+
+        self.parent.pid = 1234
+        self.assertIsNone(self.context.job_by_pid(os.getpid()))
+        self.assertIs(self.context.job_by_pid(1234), self.parent)
+
+        self.parent.label = 'org.freenas.renamed'
+        self.assertIsNone(self.context.job_by_name('org.freenas.test'))
+        self.assertIs(self.context.job_by_name('org.freenas.renamed'), self.parent)
+
+        self.context.remove_job(self.parent)
+        self.assertIsNone(self.context.job_by_pid(1234))
+        self.assertIsNone(self.context.job_by_name('org.freenas.renamed'))
+
+    def test_anonymous_child(self):
+        child_pid = os.getpid()
+        self.parent.pid = 1000
+
+        self.context.process_events([ProcEvent(child_pid, NOTE_CHILD | NOTE_FORK, 1000)])
+        child = self.context.job_by_pid(child_pid)
+        self.assertTrue(child.anonymous)
+        self.assertIs(child.parent, self.parent)
+        self.assertIs(self.context.owner_job_by_pid(child_pid), self.parent)
+        self.assertIs(self.context.job_by_name(child.label), child)
+
+        self.context.process_events([ProcEvent(child_pid, NOTE_EXIT, 0)])
+        self.assertIsNone(self.context.job_by_pid(child_pid))
+        self.assertNotIn(child.id, self.context.jobs)
+        self.assertEqual(list(self.context.jobs.values()), [self.parent])
+
+    def test_untracked_child(self):
+        self.context.process_events([
+            ProcEvent(4000, NOTE_CHILD | NOTE_FORK, 3999),
+            ProcEvent(4001, NOTE_CHILD | NOTE_EXEC | NOTE_EXIT, 3999)
+        ])
+
+        self.assertEqual(self.events.untracked, [4000])
+        self.assertEqual(len(self.context.jobs), 1)
+
+    def test_exit(self):
+        self.parent.pid = 1000
+        with mock.patch.object(main.os, 'waitpid'):
+            self.context.process_events([ProcEvent(1000, NOTE_EXIT, 1)])
+
+        self.assertEqual(self.parent.state, JobState.ERROR)
+        self.assertIsNone(self.parent.pid)
+        self.assertIsNone(self.context.job_by_pid(1000))
+        self.assertEqual(self.context.server.broadcast_event.call_args_list, [
+            mock.call('serviced.job.error', {
+                'ID': self.parent.id,
+                'PID': 1000,
+                'Label': self.parent.label,
+                'Reason': 'Process died with exit code 1',
+                'Anonymous': False
+            }),
+            mock.call('serviced.job.state_changed', {
+                'ID': self.parent.id,
+                'PID': 1000,
+                'Label': self.parent.label,
+                'State': 'ERROR',
+                'Reason': 'Process died with exit code 1',
+                'Anonymous': False
+            })
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()